@@ -0,0 +1,352 @@
+"""
+Coordinate and topology backends for dna_param.
+
+Functions of dna_param only need a selection-like object with
+get(attribute) -> per atom values for 'name','resname','resid','segname','chain',
+'element','occupancy','beta','x','y','z' (what VMD atomsel provides),
+plus optionally coords() -> (n_atoms,3) array and set_frame(frame).
+
+Two implementations are here:
+Structure - pure NumPy, topology and coordinates come from a PDB file,
+frames from a DCD file (see dcd_reader.py) or an array, no VMD needed.
+VMDSelection - thin adapter around a VMD atomsel, VMD modules are imported
+only when it is used, so that dna_param itself can be imported in plain Python.
+SharedFrames holds frames copied once from VMD (see share_frames) in a shared
+memory-mapped file, so worker processes need neither VMD nor their own copy of the trajectory.
+
+Usage:
+DNA=Structure.from_pdb('only_nucl_init.pdb').nucleic()
+DNA.load_dcd('md.dcd')
+DNA.set_frame(5)
+df=X3DNA_analyze(DNA,reff)
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from dcd_reader import DCDReader
+from dna_geometry import RESNAME_TO_BASE
+
+#Per atom attributes that a backend has to provide through get
+TOPOLOGY_ATTRIBUTES=('name','resname','resid','segname','chain','element','occupancy','beta')
+COORD_ATTRIBUTES=('x','y','z')
+
+#Attributes with numeric values, the rest are strings
+_NUMERIC=set(['resid','occupancy','beta'])
+
+
+def vmd_goto(frame):
+	"""
+	Makes frame current in VMD, the VMD module is imported on the first call
+	"""
+	from animate import goto
+	goto(frame)
+
+
+class Structure(object):
+	"""
+	NumPy backend: topology arrays plus coordinates of the current frame.
+
+	Attributes
+	----------
+	topology - dict attribute -> per atom array (see TOPOLOGY_ATTRIBUTES).
+	n_atoms - number of atoms.
+	frame - current frame, None if coordinates were set directly.
+	trajectory - DCDReader or (n_frames,n_system_atoms,3) array, or None.
+	atom_index - positions of the atoms in the trajectory frames (for selections).
+	"""
+
+	def __init__(self,names,resnames,resids,segids=None,chains=None,elements=None,occupancy=None,beta=None,xyz=None):
+		n=len(names)
+		blank=np.array(['']*n,dtype=object)
+		self.topology={
+			'name':np.array([str(x).strip() for x in names],dtype=object),
+			'resname':np.array([str(x).strip() for x in resnames],dtype=object),
+			'resid':np.asarray(resids,dtype=np.int64),
+			'segname':blank.copy() if segids is None else np.array([str(x).strip() for x in segids],dtype=object),
+			'chain':blank.copy() if chains is None else np.array([str(x).strip() for x in chains],dtype=object),
+			'element':blank.copy() if elements is None else np.array([str(x).strip() for x in elements],dtype=object),
+			'occupancy':np.ones(n) if occupancy is None else np.asarray(occupancy,dtype=float),
+			'beta':np.zeros(n) if beta is None else np.asarray(beta,dtype=float),
+		}
+		self.n_atoms=n
+		self.xyz=np.zeros((n,3)) if xyz is None else np.asarray(xyz,dtype=float)
+		self.frame=None
+		self.trajectory=None
+		self.atom_index=np.arange(n)
+
+	@classmethod
+	def from_selection(cls,selection):
+		"""
+		Copies topology and current coordinates of any selection with get (e.g. VMD atomsel)
+		"""
+		get=selection.get
+		return(cls(get('name'),get('resname'),get('resid'),segids=get('segname'),chains=get('chain'),elements=get('element'),
+			occupancy=get('occupancy'),beta=get('beta'),xyz=np.column_stack([get('x'),get('y'),get('z')])))
+
+	@classmethod
+	def from_pdb(cls,filename):
+		"""
+		Reads ATOM and HETATM records of a PDB file (the first model only)
+		"""
+		names=[];resnames=[];resids=[];chains=[];segids=[];elements=[];occ=[];beta=[];xyz=[]
+		with open(filename,'r') as f:
+			for line in f:
+				if line.startswith('ENDMDL'):
+					break
+				if not (line.startswith('ATOM') or line.startswith('HETATM')):
+					continue
+				line=line.rstrip('\n').ljust(80)
+				names.append(line[12:16])
+				resnames.append(line[17:21])
+				chains.append(line[21])
+				resids.append(int(line[22:26]))
+				xyz.append((float(line[30:38]),float(line[38:46]),float(line[46:54])))
+				occ.append(float(line[54:60]) if line[54:60].strip() else 1.0)
+				beta.append(float(line[60:66]) if line[60:66].strip() else 0.0)
+				segids.append(line[72:76])
+				elements.append(line[76:78])
+		return(cls(names,resnames,resids,segids=segids,chains=chains,elements=elements,occupancy=occ,beta=beta,xyz=np.array(xyz)))
+
+	def __len__(self):
+		return(self.n_atoms)
+
+	def get(self,attribute):
+		"""
+		Returns per atom values like VMD atomsel.get: a list for topology, an array for x, y and z
+		"""
+		if attribute in COORD_ATTRIBUTES:
+			return(self.coords()[:,COORD_ATTRIBUTES.index(attribute)])
+		values=self.topology[attribute]
+		return(values.tolist() if attribute not in _NUMERIC else values)
+
+	def set(self,attribute,values):
+		"""
+		Sets per atom values like VMD atomsel.set
+		"""
+		if attribute in COORD_ATTRIBUTES:
+			self.xyz=self.coords().copy()
+			self.trajectory=None
+			self.xyz[:,COORD_ATTRIBUTES.index(attribute)]=values
+		elif attribute in _NUMERIC:
+			self.topology[attribute]=np.asarray(values,dtype=self.topology[attribute].dtype)
+		else:
+			self.topology[attribute]=np.array([str(x) for x in values],dtype=object)
+
+	def coords(self):
+		"""
+		Returns (n_atoms,3) coordinates of the current frame
+		"""
+		if self.trajectory is None:
+			return(self.xyz)
+		return(np.asarray(self.trajectory[self.frame],dtype=np.float64)[self.atom_index])
+
+	def set_coords(self,xyz):
+		"""
+		Sets coordinates directly, detaching the trajectory
+		"""
+		xyz=np.asarray(xyz,dtype=float)
+		if xyz.shape!=(self.n_atoms,3):
+			raise ValueError('Expected (%d,3) coordinates, got %s'%(self.n_atoms,xyz.shape))
+		self.trajectory=None
+		self.frame=None
+		self.xyz=xyz
+
+	def load_dcd(self,filename):
+		"""
+		Attaches a DCD trajectory of the whole system (or of exactly these atoms),
+		frames are numbered from 0 as in the file. Returns the DCDReader.
+		"""
+		return(self.load_trajectory(DCDReader(filename)))
+
+	def load_trajectory(self,trajectory):
+		"""
+		Attaches frames: DCDReader, SharedFrames or (n_frames,n_atoms,3) array,
+		the current frame is set to the first one.
+		"""
+		n_system=trajectory.n_atoms if hasattr(trajectory,'n_atoms') else np.shape(trajectory)[1]
+		if self.n_atoms and self.atom_index.max()>=n_system:
+			raise ValueError('Trajectory has fewer atoms than the structure')
+		self.trajectory=trajectory
+		self.frame=trajectory.frames[0] if isinstance(trajectory,SharedFrames) else 0
+		return(trajectory)
+
+	@property
+	def n_frames(self):
+		return(1 if self.trajectory is None else len(self.trajectory))
+
+	def set_frame(self,frame):
+		"""
+		Makes frame current, like goto in VMD
+		"""
+		if self.trajectory is None:
+			raise ValueError('No trajectory loaded')
+		self.frame=frame
+
+	def select(self,mask):
+		"""
+		Returns a new Structure of a subset of atoms, mask - bool array or indices.
+		The trajectory is shared, not copied.
+		"""
+		idx=np.arange(self.n_atoms)[mask]
+		top=self.topology
+		sub=Structure(top['name'][idx],top['resname'][idx],top['resid'][idx],segids=top['segname'][idx],chains=top['chain'][idx],
+			elements=top['element'][idx],occupancy=top['occupancy'][idx],beta=top['beta'][idx],xyz=self.xyz[idx])
+		sub.trajectory=self.trajectory
+		sub.frame=self.frame
+		sub.atom_index=self.atom_index[idx]
+		return(sub)
+
+	def nucleic(self):
+		"""
+		Returns a selection of nucleotides (residue names known to dna_geometry)
+		"""
+		return(self.select(np.array([r in RESNAME_TO_BASE for r in self.topology['resname']],dtype=bool)))
+
+	def __repr__(self):
+		return('<Structure: %d atoms, %d frames>'%(self.n_atoms,self.n_frames))
+
+
+class SharedFrames(object):
+	"""
+	Coordinates of selected frames in a memory-mapped file, by default on /dev/shm,
+	so that any number of worker processes read the same physical pages.
+	Pickling sends only the file name, the receiving process maps the file read-only,
+	so it works with fork and spawn start methods alike.
+	Frames are addressed by their labels (e.g. VMD frame numbers), not by position.
+
+	Usage:
+	with SharedFrames(range(1,nf),n_atoms) as buf:
+		buf[frame]=xyz
+	"""
+
+	def __init__(self,frames,n_atoms,directory=None):
+		"""
+		frames - frame labels, n_atoms - atoms per frame.
+		directory - where the file is created, /dev/shm if present, else the system temporary directory.
+		"""
+		self.frames=list(frames)
+		self.n_atoms=n_atoms
+		if directory is None:
+			directory='/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+		fd,self.filename=tempfile.mkstemp(prefix='dna_frames_',suffix='.f32',dir=directory)
+		os.close(fd)
+		self.owner=True
+		self._open('w+')
+
+	def _open(self,mode):
+		self._rows=dict((f,i) for i,f in enumerate(self.frames))
+		shape=(max(1,len(self.frames)),self.n_atoms,3)
+		self.array=np.memmap(self.filename,dtype=np.float32,mode=mode,shape=shape)
+
+	def __getstate__(self):
+		return({'frames':self.frames,'n_atoms':self.n_atoms,'filename':self.filename})
+
+	def __setstate__(self,state):
+		self.__dict__.update(state)
+		self.owner=False
+		self._open('r')
+
+	def __len__(self):
+		return(len(self.frames))
+
+	def __getitem__(self,frame):
+		return(self.array[self._rows[frame]])
+
+	def __setitem__(self,frame,xyz):
+		self.array[self._rows[frame]]=xyz
+
+	def unlink(self):
+		"""
+		Removes the file, done by the process that created it
+		"""
+		self.array=None
+		if self.owner and os.path.exists(self.filename):
+			os.remove(self.filename)
+
+	def __enter__(self):
+		return(self)
+
+	def __exit__(self,*exc):
+		self.unlink()
+
+
+def copy_frames(selection,frames,set_frame=None,directory=None):
+	"""
+	Copies coordinates of selection in the given frames into a new SharedFrames and returns it.
+	set_frame - function that makes a frame current, selection.set_frame or VMD goto by default.
+	The caller should call .unlink() of the result when done.
+	"""
+	if set_frame is None:
+		set_frame=getattr(selection,'set_frame',vmd_goto)
+	frames=list(frames)
+	buf=SharedFrames(frames,len(selection.get('name')),directory=directory)
+	for frame in frames:
+		set_frame(frame)
+		get=selection.get
+		buf[frame]=np.column_stack([get('x'),get('y'),get('z')])
+	buf.array.flush()
+	return(buf)
+
+def share_frames(selection,frames,set_frame=None,directory=None):
+	"""
+	Copies coordinates of selection in the given frames into SharedFrames
+	and returns a Structure that reads its frames from there.
+	set_frame - function that makes a frame current, selection.set_frame or VMD goto by default.
+	The caller should call .trajectory.unlink() of the result when done.
+	"""
+	structure=Structure.from_selection(selection)
+	structure.load_trajectory(copy_frames(selection,frames,set_frame=set_frame,directory=directory))
+	return(structure)
+
+def maps_frames(selection):
+	"""
+	Whether selection reads its frames from a memory-mapped file (DCDReader or SharedFrames),
+	which worker processes map themselves instead of getting a copy
+	"""
+	return(isinstance(getattr(selection,'trajectory',None),(DCDReader,SharedFrames)))
+
+
+class VMDSelection(object):
+	"""
+	Adapter around a VMD atomsel with the same interface as Structure.
+	VMD is imported only when an instance is created.
+
+	VMDSelection('nucleic',molid=0) selects atoms, VMDSelection(atomsel_object) wraps an existing selection.
+	"""
+
+	def __init__(self,selection,molid=0,frame=None):
+		if isinstance(selection,str):
+			from atomsel import atomsel
+			selection=atomsel(selection,molid=molid) if frame is None else atomsel(selection,molid=molid,frame=frame)
+		self.atomsel=selection
+
+	def get(self,attribute):
+		return(self.atomsel.get(attribute))
+
+	def set(self,attribute,values):
+		self.atomsel.set(attribute,values)
+
+	def coords(self):
+		get=self.atomsel.get
+		return(np.column_stack([get('x'),get('y'),get('z')]))
+
+	def set_frame(self,frame):
+		vmd_goto(frame)
+
+	def write(self,fmt,filename):
+		self.atomsel.write(fmt,filename)
+
+	def __len__(self):
+		return(len(self.atomsel))
+
+
+def as_backend(selection):
+	"""
+	Returns selection itself if it implements coords and set_frame,
+	otherwise assumes it is a VMD atomsel and wraps it into VMDSelection
+	"""
+	if hasattr(selection,'coords') and hasattr(selection,'set_frame'):
+		return(selection)
+	return(VMDSelection(selection))
@@ -0,0 +1,171 @@
+"""
+Memory-mapped reader of CHARMM/NAMD DCD trajectories.
+
+The header is parsed once, then the whole file is memory-mapped with NumPy.
+Since all frames in a DCD have the same size, any frame can be located
+by its index, and coordinates are returned as zero-copy float32 views
+of shape (n_atoms,3) for a frame and (n_frames,n_atoms,3) for a slice.
+Nothing is read from disk until the values are actually used.
+
+Usage:
+dcd=DCDReader('md.dcd')
+xyz=dcd[5]          # (n_atoms,3) view
+block=dcd[1:10:2]   # (5,n_atoms,3) view
+xyz=np.array(dcd[5]) # if a contiguous copy is needed
+
+Files with fixed atoms (NAMNF!=0) are not supported.
+"""
+import os
+import struct
+
+import numpy as np
+
+
+class DCDReader(object):
+	"""
+	Random access to frames of a DCD file.
+
+	Attributes
+	----------
+	filename - path to the file.
+	n_atoms - number of atoms.
+	n_frames - number of complete frames in the file (deduced from file size).
+	istart, nsavc, delta - as in the header.
+	title - title lines from the header.
+	has_unitcell - whether each frame has the unit cell record.
+	"""
+
+	def __init__(self,filename):
+		self.filename=filename
+		self._parse_header()
+		self._mmap=np.memmap(filename,dtype=np.uint8,mode='r')
+		self.n_frames=max(0,(len(self._mmap)-self._first_frame)//self._frame_size)
+
+	def __getstate__(self):
+		#only the file name is sent to other processes, they map the file themselves
+		return({'filename':self.filename})
+
+	def __setstate__(self,state):
+		self.__init__(state['filename'])
+
+	def _parse_header(self):
+		with open(self.filename,'rb') as f:
+			head=f.read(4)
+			if len(head)<4:
+				raise ValueError('%s is not a DCD file'%self.filename)
+			for endian in '<>':
+				if struct.unpack(endian+'i',head)[0]==84:
+					break
+			else:
+				raise ValueError('%s is not a DCD file or uses 64-bit record markers'%self.filename)
+			self._endian=endian
+			e=endian
+
+			block=f.read(84)
+			if block[:4]!=b'CORD':
+				raise ValueError('%s is not a coordinate DCD file'%self.filename)
+			icntrl=struct.unpack(e+'20i',block[4:84])
+			self._check_marker(f,84)
+			charmm=icntrl[19]!=0
+			self.nset=icntrl[0]
+			self.istart=icntrl[1]
+			self.nsavc=icntrl[2]
+			namnf=icntrl[8]
+			if charmm:
+				self.delta=struct.unpack(e+'f',block[40:44])[0]
+				self.has_unitcell=icntrl[10]!=0
+				has_4d=icntrl[11]!=0
+			else:
+				self.delta=struct.unpack(e+'d',block[40:48])[0]
+				self.has_unitcell=False
+				has_4d=False
+			if namnf!=0:
+				raise ValueError('DCD files with fixed atoms are not supported')
+			if has_4d:
+				raise ValueError('DCD files with 4th dimension are not supported')
+
+			size=struct.unpack(e+'i',f.read(4))[0]
+			ntitle=struct.unpack(e+'i',f.read(4))[0]
+			self.title=[f.read(80).decode('ascii','replace').split('\x00')[0].rstrip() for i in range(ntitle)]
+			self._check_marker(f,size)
+
+			self._check_marker(f,4)
+			self.n_atoms=struct.unpack(e+'i',f.read(4))[0]
+			self._check_marker(f,4)
+			self._first_frame=f.tell()
+
+		#record layout of one frame, each record is wrapped by 4-byte length markers
+		self._cell_size=(4+48+4) if self.has_unitcell else 0
+		self._coord_size=4+4*self.n_atoms+4
+		self._frame_size=self._cell_size+3*self._coord_size
+
+	def _check_marker(self,f,expected):
+		marker=struct.unpack(self._endian+'i',f.read(4))[0]
+		if marker!=expected:
+			raise ValueError('Corrupted DCD header in %s'%self.filename)
+
+	def __len__(self):
+		return(self.n_frames)
+
+	def __getitem__(self,key):
+		if isinstance(key,slice):
+			return(self.frames(key.start,key.stop,key.step))
+		return(self.frame(key))
+
+	def __iter__(self):
+		for i in range(self.n_frames):
+			yield self.frame(i)
+
+	def _index(self,i):
+		i=int(i)
+		if i<0:
+			i+=self.n_frames
+		if i<0 or i>=self.n_frames:
+			raise IndexError('frame %d out of range, trajectory has %d frames'%(i,self.n_frames))
+		return(i)
+
+	def frame(self,i):
+		"""
+		Returns coordinates of frame i as a read-only (n_atoms,3) float32 view into the file.
+		"""
+		i=self._index(i)
+		offset=self._first_frame+i*self._frame_size+self._cell_size+4
+		return(np.ndarray((self.n_atoms,3),dtype=self._endian+'f4',buffer=self._mmap,offset=offset,
+			strides=(4,self._coord_size)))
+
+	def frames(self,first=None,last=None,step=None):
+		"""
+		Returns coordinates of frames first:last:step as a read-only (n,n_atoms,3) float32 view into the file.
+		The arguments are those of a slice: negative first and last count from the end, step may be negative.
+		"""
+		first,last,step=slice(first,last,step).indices(self.n_frames)
+		idx=range(first,last,step)
+		n=len(idx)
+		if n==0:
+			return(np.empty((0,self.n_atoms,3),dtype=self._endian+'f4'))
+		start=self._index(idx[0])
+		self._index(idx[-1])
+		offset=self._first_frame+start*self._frame_size+self._cell_size+4
+		return(np.ndarray((n,self.n_atoms,3),dtype=self._endian+'f4',buffer=self._mmap,offset=offset,
+			strides=(step*self._frame_size,4,self._coord_size)))
+
+	def unitcell(self,i):
+		"""
+		Returns the unit cell record of frame i as stored in the file:
+		A, gamma, B, beta, alpha, C (angles as cosines in newer NAMD/CHARMM files).
+		None if the file has no unit cell information.
+		"""
+		if not self.has_unitcell:
+			return(None)
+		i=self._index(i)
+		offset=self._first_frame+i*self._frame_size+4
+		return(np.ndarray((6,),dtype=self._endian+'f8',buffer=self._mmap,offset=offset))
+
+	def close(self):
+		"""
+		Releases the memory map, views obtained before keep it alive until they are deleted.
+		"""
+		self._mmap=None
+
+	def __repr__(self):
+		return('<DCDReader %s: %d frames, %d atoms>'%(os.path.basename(self.filename),self.n_frames,self.n_atoms))
@@ -0,0 +1,467 @@
+"""
+Benchmarks of the parsers, the per-frame analysis and the trajectory throughput.
+
+- parsers work on synthetic files in the formats of X3DNA (find_pair .inp, bp_step.par, ref_frames.dat,
+backbone.tor), Curves+ (.lis) and NACCESS (.asa) in bench_data/ (names in BENCH_FILES). They are not
+outputs of the programs: the values were computed with the in-process engines for a model of a 12 bp
+CGCGAATTCGCG duplex and written in the layouts of the programs, with the headers and sections
+the parsers have to skip. Recorded outputs can be given with --data under the same names,
+- I/O (PDB load and write, DCD frames) and the vectorized engines run on md.dcd,
+- the pipeline group times the native per-frame analysis and analyze_trajectory over md.dcd,
+and X3DNA_analyze (stages full, bp_step, torsions) if find_pair and analyze of X3DNA are found,
+otherwise these are reported as skipped. Per-stage latencies are taken from stage_timer.
+Everything but X3DNA_analyze runs offline.
+
+Every benchmark reports the best/median/mean time of the repeats, time and rate per unit
+(file, frame, structure) and the peak of Python/NumPy allocations (tracemalloc, Python 3 only).
+The results are saved as JSON together with the git commit and library versions,
+compare prints the ratio of median times per unit between saved runs.
+
+Usage:
+python dna_bench.py run                                  # all groups, saved to bench_results/
+python dna_bench.py run --groups parsers,engines --repeat 10 --out new.json
+python dna_bench.py compare bench_results/old.json new.json
+"""
+from __future__ import print_function
+
+import argparse
+import functools
+import glob
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc=None
+try:
+	import resource
+except ImportError:
+	resource=None
+
+import dna_param
+from dcd_reader import DCDReader
+from dna_geometry import BaseTopology, fit_base_frames, base_pair_step_params, backbone_torsions, base_pairing
+from dna_grooves import strand_pairs, groove_widths, helical_axis
+from dna_hydrogens import HydrogenBuilder
+from dna_rebuild import DNARebuilder
+from dna_shard import load_structure
+from pdb_io import PDBWriter, PDB_ATOM_NAMES
+from stage_timer import TIMER, summary
+from traj_results import FrameResult
+
+GROUPS=('parsers','io','engines','pipeline')
+
+#Synthetic files in the formats of X3DNA, Curves+ and NACCESS outputs, checked in with the benchmarks
+BENCH_DATA=os.path.join(os.path.dirname(os.path.abspath(__file__)),'bench_data')
+
+#Tool output -> file name in the bench data directory
+BENCH_FILES={
+	'find_pair':'synthetic_12bp.inp',
+	'bp_step':'synthetic_12bp_bp_step.par',
+	'ref_frames':'synthetic_12bp_ref_frames.dat',
+	'backbone_tor':'synthetic_12bp_backbone.tor',
+	'lis':'synthetic_12bp.lis',
+	'asa':'synthetic_12bp.asa',
+}
+
+_clock=getattr(time,'perf_counter',time.time)
+
+
+###Reference pairs of the benchmark structure
+
+def _residue_labels(DNA,top):
+	"""
+	find_pair style labels of residues: chain, resid padded with dots, residue name
+	"""
+	chains=DNA.get('chain');resnames=DNA.get('resname')
+	first={}
+	for i,key in enumerate(zip(DNA.get('segname'),DNA.get('resid'))):
+		first.setdefault(key,i)
+	res=[]
+	for key in top.residues:
+		i=first[key]
+		res.append((str(chains[i]) or '-',('%4d'%key[1]).replace(' ','.'),('%3s'%resnames[i]).replace(' ','.')))
+	return(res)
+
+def _format_find_pair(DNA,top,pairs):
+	"""
+	find_pair .inp text for pairs, used as the reference when X3DNA is not installed
+	"""
+	labels=_residue_labels(DNA,top)
+	lines=['REF.pdb','REF.outs','    2         # duplex','%5d         # number of base-pairs'%len(pairs),
+		'    1     1    # explicit bp numbering/hetero atoms']
+	for k,(i,j) in enumerate(pairs):
+		(ci,ri,ni),(cj,rj,nj)=labels[i],labels[j]
+		lines.append('%5d %5d  0 # %4d | ....>%s:%s_:[%s]%s-----%s[%s]:%s_:%s<....'%(
+			i+1,j+1,k+1,ci,ri,ni,top.bases[i],top.bases[j],nj,rj,cj))
+	return('\n'.join(lines)+'\n')
+
+def bench_files(directory=BENCH_DATA):
+	"""
+	Returns dict output -> path of the tool outputs in directory (see BENCH_FILES)
+	"""
+	paths=dict((k,os.path.join(directory,f)) for k,f in BENCH_FILES.items())
+	missing=[p for p in paths.values() if not os.path.exists(p)]
+	if missing:
+		raise IOError('Missing benchmark data: %s'%', '.join(sorted(missing)))
+	return(paths)
+
+def x3dna_available():
+	"""
+	Whether find_pair and analyze of X3DNA are found, as X3DNA_analyze runs them
+	"""
+	return(all(os.path.isfile(dna_param._which(p)) for p in (dna_param.P_X3DNA_find_pair,dna_param.P_X3DNA_analyze)))
+
+
+###Measurement
+
+def _maxrss_mb():
+	"""
+	Peak resident memory of this process so far in MB, None where unknown
+	"""
+	if resource is None:
+		return(None)
+	rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return(rss/1024.0**2 if sys.platform=='darwin' else rss/1024.0)
+
+def measure(func,repeat=5,units=1,unit='call',memory=True):
+	"""
+	Times func() repeat times (after one warm-up call) and measures the peak of its allocations.
+
+	Parameters
+	----------
+	units - number of units (frames, files ...) one call processes, for per unit times and rates.
+	memory - run one more call under tracemalloc for the peak allocations.
+
+	Return
+	--------
+	dict with repeat, units, unit, best, median, mean (s per call), per_unit (median s per unit),
+	rate (units per s), peak_mb (None without tracemalloc), maxrss_mb.
+	"""
+	func()
+	times=[]
+	for k in range(repeat):
+		start=_clock()
+		func()
+		times.append(_clock()-start)
+	times=np.array(times)
+	peak=None
+	if memory and tracemalloc is not None:
+		tracemalloc.start()
+		try:
+			func()
+			peak=tracemalloc.get_traced_memory()[1]/1024.0**2
+		finally:
+			tracemalloc.stop()
+	median=float(np.median(times))
+	return({'repeat':repeat,'units':units,'unit':unit,'best':float(times.min()),'median':median,'mean':float(times.mean()),
+		'per_unit':median/units,'rate':units/median if median>0 else float('inf'),'peak_mb':peak,'maxrss_mb':_maxrss_mb()})
+
+
+class _Context(object):
+	"""
+	Structure, trajectory, topology and tool outputs shared by the benchmarks
+	"""
+
+	def __init__(self,pdb,dcd,data=BENCH_DATA,frames=None):
+		self.pdb=pdb
+		self.dcd=dcd
+		self.files=bench_files(data)
+		self.texts=dict((k,dna_param._read_text(p)) for k,p in self.files.items())
+		self.DNA=load_structure(pdb,dcd)
+		n=self.DNA.n_frames
+		self.frames=list(range(n)) if frames is None else [f for f in frames if f<n]
+		self.topology=BaseTopology.from_atomsel(self.DNA)
+		reader=DCDReader(dcd)
+		self.xyz=np.asarray(reader.frames()[self.frames][:,self.DNA.atom_index],dtype=np.float64)
+		self.pairs=strand_pairs(self.topology)
+		#reference pairs of the structure in TEMP, as X3DNA_find_pair would leave them
+		self.ref_fp_id=str(uuid.uuid4())
+		with open(os.path.join(dna_param.TEMP,self.ref_fp_id),'w') as f:
+			f.write(_format_find_pair(self.DNA,self.topology,self.pairs))
+		self._x3dna_ref=None
+
+	def x3dna_reference(self):
+		"""
+		Reference of X3DNA_analyze made by X3DNA find_pair for the first frame, on the first call
+		"""
+		if self._x3dna_ref is None:
+			self.DNA.set_frame(self.frames[0])
+			self._x3dna_ref=dna_param.X3DNA_find_pair(self.DNA)
+		return(self._x3dna_ref)
+
+	def close(self):
+		for ref in (self.ref_fp_id,self._x3dna_ref):
+			if ref is None:
+				continue
+			for path in glob.glob(os.path.join(dna_param.TEMP,ref+'*')):
+				os.remove(path)
+
+
+@dna_param.returns_records
+def native_analyze(DNA_atomsel,ref_fp_id,records=False):
+	"""
+	Per-frame analysis without external programs: base-pair and step parameters,
+	pairing and torsions, the columns of X3DNA_analyze except x,y,z
+	records - return traj_results.FrameResult filled from the arrays, without data frames
+	"""
+	if records:
+		top,pairs=dna_param._native_layout(DNA_atomsel,ref_fp_id)
+		names,values=base_pair_step_params(dna_param._coords(DNA_atomsel),top,pairs)
+		paired=dna_param.native_pairing(DNA_atomsel,ref_fp_id,as_array=True)
+		columns,torsions=dna_param.native_torsions(DNA_atomsel,ref_fp_id,as_array=True)
+		return(dna_param._frame_record([(['BPname']+dna_param.BP_PARAMS+dna_param.STEP_PARAMS,values),
+			(['Pairing'],paired[:,np.newaxis]),(columns,torsions)],names))
+	df=dna_param.native_analyze_bp_step(DNA_atomsel,ref_fp_id)
+	return(pd.concat([df.drop('BPnum',axis=1),dna_param.native_pairing(DNA_atomsel,ref_fp_id),
+		dna_param.native_torsions(DNA_atomsel,ref_fp_id)],axis=1).assign(BPnum=df['BPnum']))
+
+def _parser_benchmarks(ctx):
+	t=ctx.texts
+	fp=ctx.files['find_pair']
+	return([
+		('parse_find_pair',lambda:dna_param.parse_find_pair_text(t['find_pair']),1,'file'),
+		('check_pairing',lambda:dna_param.check_pairing(fp,fp),1,'file'),
+		('parse_bases_param',lambda:dna_param.parse_bases_param_text(t['bp_step']),1,'file'),
+		('parse_bases_param_array',lambda:dna_param.parse_bases_param_text(t['bp_step'],as_array=True),1,'file'),
+		('parse_ref_frames',lambda:dna_param.parse_ref_frames_text(t['ref_frames']),1,'file'),
+		('parse_ref_frames_array',lambda:dna_param.parse_ref_frames_text(t['ref_frames'],as_array=True),1,'file'),
+		('parse_tor_param',lambda:dna_param.parse_tor_param_text(t['backbone_tor']),1,'file'),
+		('parse_tor_param_array',lambda:dna_param.parse_tor_param_text(t['backbone_tor'],as_array=True),1,'file'),
+		('parse_lis',lambda:dna_param.parse_lis_text(t['lis'],backbone=True),1,'file'),
+		('parse_lis_array',lambda:dna_param.parse_lis_text(t['lis'],as_array=True),1,'file'),
+		('parse_asa',lambda:dna_param.parse_asa_text(t['asa']),1,'file'),
+	])
+
+def _io_benchmarks(ctx):
+	DNA=ctx.DNA
+	n=len(ctx.frames)
+	writer=PDBWriter.from_atomsel(DNA,name_map=PDB_ATOM_NAMES)
+	def read_frames():
+		reader=DCDReader(ctx.dcd)
+		for f in ctx.frames:
+			np.array(reader.frame(f)[DNA.atom_index],dtype=np.float64)
+	def write_frames():
+		for xyz in ctx.xyz:
+			writer.to_bytes(xyz)
+	def write_pdb_file():
+		with dna_param.scratch_dir() as wd:
+			dna_param._write_pdb(DNA,wd)
+	#what a worker sends to the driver for one frame
+	df=native_analyze(DNA,ctx.ref_fp_id)
+	record=FrameResult.from_dataframe(df)
+	return([
+		('load_pdb',lambda:load_structure(ctx.pdb),1,'structure'),
+		('read_dcd_frames',read_frames,n,'frame'),
+		('format_pdb_frames',write_frames,n,'frame'),
+		('write_pdb_file',write_pdb_file,1,'frame'),
+		('pickle_frame_dataframe',lambda:pickle.loads(pickle.dumps(df,pickle.HIGHEST_PROTOCOL)),1,'frame'),
+		('pickle_frame_record',lambda:pickle.loads(pickle.dumps(record,pickle.HIGHEST_PROTOCOL)),1,'frame'),
+		('frame_record',lambda:FrameResult.from_dataframe(df),1,'frame'),
+	])
+
+def _engine_benchmarks(ctx):
+	top=ctx.topology
+	xyz=ctx.xyz
+	pairs=ctx.pairs
+	n=len(xyz)
+	hydrogens=HydrogenBuilder(top,missing=False)
+	sasa=dna_param._sasa_engine(ctx.DNA,1.4,'')
+	names,params=base_pair_step_params(xyz[0],top,pairs)
+	rebuilder=DNARebuilder(''.join(top.bases[i] for i in pairs[:,0]))
+	return([
+		('topology',lambda:BaseTopology.from_atomsel(ctx.DNA),1,'structure'),
+		('fit_base_frames',lambda:fit_base_frames(xyz,top),n,'frame'),
+		('base_pair_step_params',lambda:base_pair_step_params(xyz,top,pairs),n,'frame'),
+		('backbone_torsions',lambda:backbone_torsions(xyz,top,pairs),n,'frame'),
+		('base_pairing',lambda:base_pairing(xyz,top,pairs),n,'frame'),
+		('groove_widths',lambda:groove_widths(xyz,top,pairs),n,'frame'),
+		('helical_axis',lambda:helical_axis(xyz,top,pairs),n,'frame'),
+		('hydrogens',lambda:[hydrogens.place(x) for x in xyz],n,'frame'),
+		('sasa',lambda:sasa.compute(xyz[0]),1,'frame'),
+		('rebuild',lambda:rebuilder.build(params),1,'structure'),
+	])
+
+def _frame_loop(ctx):
+	for f in ctx.frames:
+		ctx.DNA.set_frame(f)
+		native_analyze(ctx.DNA,ctx.ref_fp_id)
+
+def _trajectory(ctx,workers):
+	return(dna_param.analyze_trajectory(ctx.frames,ctx.DNA,ctx.ref_fp_id,workers=workers,analyze=native_analyze,log_level='quiet'))
+
+def _x3dna_loop(ctx,stages):
+	ref=ctx.x3dna_reference()
+	for f in ctx.frames:
+		ctx.DNA.set_frame(f)
+		dna_param.X3DNA_analyze(ctx.DNA,ref,stages=stages)
+
+def _pipeline_benchmarks(ctx,workers):
+	n=len(ctx.frames)
+	res=[('native_frame',functools.partial(_frame_loop,ctx),n,'frame'),
+		('trajectory_1_worker',functools.partial(_trajectory,ctx,1),n,'frame')]
+	if workers>1:
+		res.append(('trajectory_%d_workers'%workers,functools.partial(_trajectory,ctx,workers),n,'frame'))
+	#X3DNA_analyze with its stages, the programs are run for every frame; None - skipped
+	available=x3dna_available()
+	for stages in ('full','bp_step','torsions'):
+		res.append(('x3dna_analyze_'+stages,functools.partial(_x3dna_loop,ctx,stages) if available else None,n,'frame'))
+	return(res)
+
+def _stage_latency(records):
+	"""
+	Mean seconds per stage call from stage_timer records
+	"""
+	table=summary(records)
+	return(dict((str(k),float(v)) for k,v in table['mean'].items()))
+
+def run_benchmarks(pdb='only_nucl_init.pdb',dcd='md.dcd',data=BENCH_DATA,groups=GROUPS,repeat=5,workers=None,frames=None,
+	only=None,memory=True):
+	"""
+	Runs the benchmarks of groups and returns a data frame with one row per benchmark
+	(group, name and the fields of measure, stages - mean seconds per stage_timer stage).
+
+	data - directory with the files for the parsers (BENCH_FILES), the synthetic ones in bench_data by default.
+	workers - processes for the trajectory benchmark, one per core by default.
+	frames - frames of the dcd to use, all by default.
+	only - names of benchmarks to run, all by default.
+	"""
+	workers=workers or dna_param.cpu_count()
+	ctx=_Context(pdb,dcd,data,frames)
+	makers={'parsers':_parser_benchmarks,'io':_io_benchmarks,'engines':_engine_benchmarks,
+		'pipeline':lambda c:_pipeline_benchmarks(c,workers)}
+	rows=[]
+	try:
+		for group in groups:
+			if group not in makers:
+				raise ValueError('Unknown group %s, choose from %s'%(group,', '.join(GROUPS)))
+			for name,func,units,unit in makers[group](ctx):
+				if only and name not in only:
+					continue
+				if func is None:
+					dna_param.log('%-10s %-28s skipped, the programs are not found'%(group,name))
+					continue
+				mark=TIMER.mark()
+				row={'group':group,'name':name}
+				row.update(measure(func,repeat=repeat,units=units,unit=unit,memory=memory))
+				row['stages']=_stage_latency(TIMER.since(mark))
+				rows.append(row)
+				dna_param.log('%-10s %-28s %10.3f ms/%s %10.1f %s/s'%(group,name,1000*row['per_unit'],unit,row['rate'],unit))
+	finally:
+		ctx.close()
+	return(pd.DataFrame(rows))
+
+
+###Saving and comparing runs
+
+def _git_commit():
+	try:
+		out=subprocess.check_output(['git','rev-parse','--short','HEAD'],cwd=os.path.dirname(os.path.abspath(__file__)),
+			stderr=subprocess.STDOUT,universal_newlines=True)
+		dirty=subprocess.check_output(['git','status','--porcelain','--untracked-files=no'],
+			cwd=os.path.dirname(os.path.abspath(__file__)),universal_newlines=True)
+		return(out.strip()+('-dirty' if dirty.strip() else ''))
+	except (OSError,subprocess.CalledProcessError):
+		return(None)
+
+def environment():
+	"""
+	Commit, library versions and machine, saved with the results
+	"""
+	return({'date':time.strftime('%Y-%m-%d %H:%M:%S'),'commit':_git_commit(),'python':platform.python_version(),
+		'numpy':np.__version__,'pandas':pd.__version__,'platform':platform.platform(),'machine':platform.machine(),
+		'cpus':dna_param.cpu_count()})
+
+def save_results(results,filename,meta=None):
+	"""
+	Saves benchmark results (data frame of run_benchmarks) with environment() and meta to a JSON file
+	"""
+	directory=os.path.dirname(filename)
+	if directory and not os.path.isdir(directory):
+		os.makedirs(directory)
+	info=environment()
+	info.update(meta or {})
+	records=json.loads(results.to_json(orient='records'))
+	with open(filename,'w') as f:
+		json.dump({'meta':info,'results':records},f,indent=1,sort_keys=True)
+	return(filename)
+
+def load_results(filename):
+	"""
+	Returns (meta, data frame of results) saved by save_results
+	"""
+	with open(filename,'r') as f:
+		data=json.load(f)
+	return(data['meta'],pd.DataFrame(data['results']))
+
+def compare_results(filenames,column='per_unit'):
+	"""
+	Table of column (median seconds per unit by default) of every benchmark in the saved runs,
+	plus the ratio of the last run to the first one (above 1 - slower)
+	"""
+	tables=[]
+	labels=[]
+	for k,f in enumerate(filenames):
+		meta,df=load_results(f)
+		label='%d:%s'%(k,meta.get('commit') or os.path.basename(f))
+		labels.append(label)
+		tables.append(df.set_index(['group','name'])[column].rename(label))
+	res=pd.concat(tables,axis=1)
+	if len(labels)>1:
+		res['ratio']=res[labels[-1]]/res[labels[0]]
+	return(res)
+
+
+def main(argv=None):
+	parser=argparse.ArgumentParser(description='Offline benchmarks of DNA parameter analysis')
+	sub=parser.add_subparsers(dest='command')
+
+	r=sub.add_parser('run',help='run benchmarks and save the results')
+	r.add_argument('--pdb',default='only_nucl_init.pdb')
+	r.add_argument('--dcd',default='md.dcd')
+	r.add_argument('--data',default=BENCH_DATA,help='directory with X3DNA/Curves+/NACCESS outputs for the parsers (%s), synthetic files in bench_data by default'%
+		', '.join(sorted(BENCH_FILES.values())))
+	r.add_argument('--groups',default=','.join(GROUPS),help='comma separated: %s'%', '.join(GROUPS))
+	r.add_argument('--only',default=None,help='comma separated names of benchmarks')
+	r.add_argument('--repeat',type=int,default=5)
+	r.add_argument('--workers',type=int,default=None,help='processes for the trajectory benchmark, default one per core')
+	r.add_argument('--no-memory',action='store_true',help='skip the tracemalloc run')
+	r.add_argument('--out',default=None,help='JSON file, default bench_results/bench_DATE_COMMIT.json')
+
+	c=sub.add_parser('compare',help='compare saved runs, the first one is the baseline')
+	c.add_argument('results',nargs='+')
+	c.add_argument('--column',default='per_unit',help='per_unit, median, best, rate or peak_mb')
+	c.add_argument('--threshold',type=float,default=1.1,help='ratio above which a benchmark is marked as slower')
+
+	args=parser.parse_args(argv)
+	if args.command=='run':
+		res=run_benchmarks(args.pdb,args.dcd,args.data,[g for g in args.groups.split(',') if g],args.repeat,args.workers,
+			only=args.only.split(',') if args.only else None,memory=not args.no_memory)
+		out=args.out or os.path.join('bench_results','bench_%s_%s.json'%(time.strftime('%Y%m%d_%H%M%S'),_git_commit() or 'nogit'))
+		save_results(res,out,{'pdb':os.path.abspath(args.pdb),'dcd':os.path.abspath(args.dcd),'repeat':args.repeat})
+		print(res[['group','name','unit','per_unit','rate','peak_mb']].to_string(index=False))
+		print('Saved to %s'%out)
+	elif args.command=='compare':
+		res=compare_results(args.results,args.column)
+		print(res.to_string())
+		if 'ratio' in res:
+			slower=res[res['ratio']>args.threshold]
+			if len(slower):
+				print('Slower than %.2f x baseline: %s'%(args.threshold,', '.join('%s/%s'%k for k in slower.index)))
+	else:
+		parser.print_help()
+		return(1)
+	return(0)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,642 @@
+"""
+In-process geometry engine for DNA conformation analysis.
+
+This module does with NumPy what X3DNA does for every structure,
+but for many frames at once and without external calls:
+- fitting of the standard base reference frames (Olson et al. 2001)
+to the ring atoms of every base by the least squares (Kabsch) method,
+- base-pair and base-pair step parameters by the 3DNA algorithm (Lu & Olson 2003),
+- backbone torsions, chi and sugar pseudorotation parameters,
+- geometric check of base pairing with the find_pair criteria.
+
+Everything works on coordinate arrays of shape (frames,atoms,3) (or (atoms,3) for one frame),
+the atom indices of every base are looked up once from the topology (BaseTopology).
+
+Usage:
+top=BaseTopology.from_atomsel(DNA)
+origins,axes=fit_base_frames(coords,top)
+names,params=base_pair_step_params(coords,top,pairs)
+columns,tors=backbone_torsions(coords,top,pairs)
+paired=base_pairing(coords,top,pairs)
+"""
+import numpy as np
+from collections import OrderedDict
+
+
+#Standard bases in the standard reference frame,
+#the same coordinates as Atomic_?.pdb files of X3DNA (Olson et al. 2001, JMB 313:229)
+STD_BASES={
+	'A':OrderedDict([
+		("C1'",(-2.479,5.346,0.000)),
+		('N9',(-1.291,4.498,0.000)),
+		('C8',(0.024,4.897,0.000)),
+		('N7',(0.877,3.902,0.000)),
+		('C5',(0.071,2.771,0.000)),
+		('C6',(0.369,1.398,0.000)),
+		('N6',(1.611,0.909,0.000)),
+		('N1',(-0.668,0.532,0.000)),
+		('C2',(-1.912,1.023,0.000)),
+		('N3',(-2.320,2.290,0.000)),
+		('C4',(-1.267,3.124,0.000))]),
+	'G':OrderedDict([
+		("C1'",(-2.477,5.399,0.000)),
+		('N9',(-1.289,4.551,0.000)),
+		('C8',(0.023,4.962,0.000)),
+		('N7',(0.870,3.969,0.000)),
+		('C5',(0.071,2.833,0.000)),
+		('C6',(0.424,1.460,0.000)),
+		('O6',(1.554,0.955,0.000)),
+		('N1',(-0.700,0.641,0.000)),
+		('C2',(-1.999,1.087,0.000)),
+		('N2',(-2.949,0.139,-0.001)),
+		('N3',(-2.342,2.364,0.001)),
+		('C4',(-1.265,3.177,0.000))]),
+	'C':OrderedDict([
+		("C1'",(-2.477,5.402,0.000)),
+		('N1',(-1.285,4.542,0.000)),
+		('C2',(-1.472,3.158,0.000)),
+		('O2',(-2.628,2.709,0.001)),
+		('N3',(-0.391,2.344,0.000)),
+		('C4',(0.837,2.868,0.000)),
+		('N4',(1.875,2.027,0.001)),
+		('C5',(1.056,4.275,0.000)),
+		('C6',(-0.023,5.068,0.000))]),
+	'T':OrderedDict([
+		("C1'",(-2.481,5.354,0.000)),
+		('N1',(-1.284,4.500,0.000)),
+		('C2',(-1.462,3.135,0.000)),
+		('O2',(-2.562,2.608,0.000)),
+		('N3',(-0.298,2.407,0.000)),
+		('C4',(0.994,2.897,0.000)),
+		('O4',(1.944,2.119,0.000)),
+		('C5',(1.106,4.338,0.000)),
+		('C7',(2.466,4.961,0.001)),
+		('C6',(-0.024,5.057,0.000))]),
+}
+
+#X3DNA fits only the ring atoms
+PURINE_RING=['C4','N3','C2','N1','C6','C5','N7','C8','N9']
+PYRIMIDINE_RING=['C4','N3','C2','N1','C6','C5']
+RING_ATOMS={'A':PURINE_RING,'G':PURINE_RING,'C':PYRIMIDINE_RING,'T':PYRIMIDINE_RING}
+
+#Residue names as they come from CHARMM, AMBER, PDB or after the renaming in analyzeMD.vmdpy
+RESNAME_TO_BASE={
+	'ADE':'A','DA':'A','DA5':'A','DA3':'A','A':'A','_DA':'A',
+	'GUA':'G','DG':'G','DG5':'G','DG3':'G','G':'G','_DG':'G',
+	'CYT':'C','DC':'C','DC5':'C','DC3':'C','C':'C','_DC':'C',
+	'THY':'T','DT':'T','DT5':'T','DT3':'T','T':'T','_DT':'T',
+}
+
+#Atom names that differ between force fields and PDB
+ATOM_ALIASES={'C5M':'C7','O1P':'OP1','O2P':'OP2'}
+
+
+class BaseTopology(object):
+	"""
+	Atom indices of the bases, built once from the topology and reused for all frames.
+
+	Attributes
+	----------
+	residues - list of (segid,resid) of nucleotides in the order of appearance.
+	bases - one letter base type of every residue (A,G,C,T).
+	groups - dict base type -> (positions of the residues of this type, (n,k) array of ring atom indices)
+	atoms - list of dicts atom name -> atom index for every residue.
+	"""
+
+	def __init__(self,names,resnames,resids,segids=None):
+		"""
+		names, resnames, resids, segids - per atom arrays (segids may be chains or None).
+		Atoms of one residue need not be contiguous.
+		"""
+		n=len(names)
+		if segids is None:
+			segids=['']*n
+		self.residues=[]
+		self.bases=[]
+		self.atoms=[]
+		pos={}
+		for i in range(n):
+			base=RESNAME_TO_BASE.get(str(resnames[i]).strip())
+			if base is None:
+				continue
+			key=(str(segids[i]).strip(),int(resids[i]))
+			if key not in pos:
+				pos[key]=len(self.residues)
+				self.residues.append(key)
+				self.bases.append(base)
+				self.atoms.append({})
+			name=str(names[i]).strip()
+			self.atoms[pos[key]][ATOM_ALIASES.get(name,name)]=i
+
+		self.groups={}
+		for base in 'AGCT':
+			members=[k for k,b in enumerate(self.bases) if b==base]
+			if not members:
+				continue
+			ring=RING_ATOMS[base]
+			idx=np.empty((len(members),len(ring)),dtype=np.int64)
+			for m,k in enumerate(members):
+				try:
+					idx[m]=[self.atoms[k][a] for a in ring]
+				except KeyError as e:
+					raise ValueError('Residue %s:%d has no atom %s'%(self.residues[k]+(e.args[0],)))
+			self.groups[base]=(np.array(members,dtype=np.int64),idx)
+
+	@classmethod
+	def from_atomsel(cls,DNA_atomsel):
+		"""
+		Builds topology from VMD atomsel
+		"""
+		return(cls(DNA_atomsel.get('name'),DNA_atomsel.get('resname'),DNA_atomsel.get('resid'),DNA_atomsel.get('segname')))
+
+	def __len__(self):
+		return(len(self.residues))
+
+	def index(self,segid,resid):
+		"""
+		Returns position of residue segid:resid
+		"""
+		return(self.residues.index((segid,int(resid))))
+
+	def neighbor(self,k,offset):
+		"""
+		Position of the residue offset steps along the chain from residue k,
+		-1 if there is none (end of the segment)
+		"""
+		j=k+offset
+		if j<0 or j>=len(self.residues) or self.residues[j][0]!=self.residues[k][0]:
+			return(-1)
+		return(j)
+
+	def quadruplets(self,definition):
+		"""
+		Returns (n_residues,4) array of atom indices of a torsion, -1 where any atom is missing.
+
+		definition - four (offset,atom name) tuples, offset is relative to the residue (-1 previous, 1 next),
+		or a dict base type -> such tuples, when atoms differ between bases (like chi).
+		"""
+		res=np.full((len(self.residues),4),-1,dtype=np.int64)
+		for k in range(len(self.residues)):
+			quad=definition[self.bases[k]] if isinstance(definition,dict) else definition
+			idx=[]
+			for offset,name in quad:
+				j=self.neighbor(k,offset)
+				idx.append(self.atoms[j].get(name,-1) if j>=0 else -1)
+			if min(idx)>=0:
+				res[k]=idx
+		return(res)
+
+	def atom_index(self,names):
+		"""
+		Returns (n_residues,len(names)) array of atom indices, -1 where the atom is missing
+		"""
+		res=np.full((len(self.residues),len(names)),-1,dtype=np.int64)
+		for k,atoms in enumerate(self.atoms):
+			for j,name in enumerate(names):
+				res[k,j]=atoms.get(name,-1)
+		return(res)
+
+
+def _as_frames(coords):
+	"""
+	Returns coords as (frames,atoms,3) array and whether a single frame was given
+	"""
+	coords=np.asarray(coords)
+	single=coords.ndim==2
+	if single:
+		coords=coords[None]
+	return(coords,single)
+
+def kabsch(moving,target):
+	"""
+	Batched least squares superposition of a template onto coordinates.
+
+	moving - (k,3) template coordinates.
+	target - (...,k,3) coordinates to fit to.
+
+	Returns rotation (...,3,3) and translation (...,3), such that
+	target ~ rotation.dot(moving)+translation, and rmsd (...).
+	"""
+	moving=np.asarray(moving,dtype=float)
+	target=np.asarray(target,dtype=float)
+	mc=moving.mean(axis=0)
+	tc=target.mean(axis=-2)
+	m=moving-mc
+	t=target-tc[...,None,:]
+	#covariance of template and target coordinates
+	H=np.einsum('ki,...kj->...ij',m,t)
+	U,S,Vt=np.linalg.svd(H)
+	V=np.swapaxes(Vt,-1,-2)
+	d=np.sign(np.linalg.det(np.matmul(V,np.swapaxes(U,-1,-2))))
+	V[...,:,2]*=d[...,None]
+	R=np.matmul(V,np.swapaxes(U,-1,-2))
+	trans=tc-np.einsum('...ij,j->...i',R,mc)
+	fit=np.einsum('...ij,kj->...ki',R,m)
+	rmsd=np.sqrt(((fit-t)**2).sum(axis=-1).mean(axis=-1))
+	return(R,trans,rmsd)
+
+def fit_base_frames(coords,topology,return_rmsd=False):
+	"""
+	Fits standard base reference frames to every base in every frame.
+
+	Parameters
+	----------
+	coords - (frames,atoms,3) or (atoms,3) coordinates.
+	topology - BaseTopology for these atoms.
+	return_rmsd - also return rmsd of every fit.
+
+	Return
+	--------
+	origins - (frames,bases,3) origins of base reference frames.
+	axes - (frames,bases,3,3) rotation matrices, columns are x,y,z axes of the base frames.
+	(rmsd - (frames,bases) if return_rmsd)
+	If a single frame was given the frames dimension is dropped.
+	"""
+	coords,single=_as_frames(coords)
+	nf=len(coords)
+	nb=len(topology)
+	origins=np.empty((nf,nb,3))
+	axes=np.empty((nf,nb,3,3))
+	rmsd=np.empty((nf,nb))
+	for base,(members,idx) in topology.groups.items():
+		template=np.array([STD_BASES[base][a] for a in RING_ATOMS[base]])
+		R,t,r=kabsch(template,coords[:,idx].astype(float))
+		origins[:,members]=t
+		axes[:,members]=R
+		rmsd[:,members]=r
+	if single:
+		origins,axes,rmsd=origins[0],axes[0],rmsd[0]
+	if return_rmsd:
+		return(origins,axes,rmsd)
+	return(origins,axes)
+
+def pair_origins(origins,pairs):
+	"""
+	Centers of base pairs, the same as x,y,z in ref_frames.dat of X3DNA.
+
+	origins - (...,bases,3) origins of base frames from fit_base_frames.
+	pairs - (n_pairs,2) positions of paired bases (strand I, strand II).
+	Returns (...,n_pairs,3).
+	"""
+	pairs=np.asarray(pairs,dtype=np.int64)
+	return(0.5*(origins[...,pairs[:,0],:]+origins[...,pairs[:,1],:]))
+
+
+###Base-pair and step parameters, the same algorithm as bpstep_par in X3DNA
+
+def _norm(v):
+	return(v/np.linalg.norm(v,axis=-1)[...,None])
+
+def _rotation(axis,angle):
+	"""
+	Rotation matrices (...,3,3) about unit axis (...,3) by angle (...) in radians
+	"""
+	c=np.cos(angle)[...,None,None]
+	s=np.sin(angle)[...,None,None]
+	x,y,z=axis[...,0],axis[...,1],axis[...,2]
+	zero=np.zeros_like(x)
+	K=np.stack([np.stack([zero,-z,y],axis=-1),np.stack([z,zero,-x],axis=-1),np.stack([-y,x,zero],axis=-1)],axis=-2)
+	kk=axis[...,:,None]*axis[...,None,:]
+	return(c*np.eye(3)+s*K+(1-c)*kk)
+
+def _angle(a,b):
+	"""
+	Angle between vectors in radians
+	"""
+	cos=np.einsum('...i,...i->...',_norm(a),_norm(b))
+	return(np.arccos(np.clip(cos,-1.0,1.0)))
+
+def _signed_angle(a,b,ref):
+	"""
+	Angle between a and b projected onto the plane normal to ref,
+	positive if a->b is a right handed rotation about ref (vec_ang in X3DNA), radians.
+	"""
+	ref=_norm(ref)
+	a=a-np.einsum('...i,...i->...',a,ref)[...,None]*ref
+	b=b-np.einsum('...i,...i->...',b,ref)[...,None]*ref
+	ang=_angle(a,b)
+	sign=np.einsum('...i,...i->...',np.cross(a,b),ref)
+	return(np.where(sign<0,-ang,ang))
+
+def step_params(R1,o1,R2,o2):
+	"""
+	Six parameters relating frame 2 to frame 1, vectorized over leading dimensions.
+
+	R1,R2 - (...,3,3) frames, columns are x,y,z axes.
+	o1,o2 - (...,3) origins.
+
+	Return
+	--------
+	pars - (...,6) Shift, Slide, Rise (A), Tilt, Roll, Twist (degrees)
+	(for two bases of a pair these are Shear, Stretch, Stagger, Buckle, Propeller, Opening).
+	mid_axes - (...,3,3) middle frame.
+	mid_origin - (...,3) its origin.
+	"""
+	z1=R1[...,:,2]
+	z2=R2[...,:,2]
+	bend=_angle(z1,z2)
+	hinge=np.cross(z1,z2)
+	#z axes are (anti)parallel, any axis in the xy plane will do
+	small=np.linalg.norm(hinge,axis=-1)<1e-10
+	if np.any(small):
+		alt=R1[...,:,0]+R2[...,:,0]+R1[...,:,1]+R2[...,:,1]
+		hinge=np.where(small[...,None],alt,hinge)
+	hinge=_norm(hinge)
+
+	#rotate both frames about the hinge so that their z axes coincide
+	p1=np.matmul(_rotation(hinge,0.5*bend),R1)
+	p2=np.matmul(_rotation(hinge,-0.5*bend),R2)
+	mz=p1[...,:,2]
+	twist=_signed_angle(p1[...,:,1],p2[...,:,1],mz)
+	mid_axes=np.matmul(_rotation(mz,0.5*twist),p1)
+	mid_origin=0.5*(o1+o2)
+
+	shift=np.einsum('...i,...ij->...j',o2-o1,mid_axes)
+	phi=_signed_angle(hinge,mid_axes[...,:,1],mid_axes[...,:,2])
+	roll=bend*np.cos(phi)
+	tilt=bend*np.sin(phi)
+	angles=np.degrees(np.stack([tilt,roll,twist],axis=-1))
+	return(np.concatenate([shift,angles],axis=-1),mid_axes,mid_origin)
+
+def base_pair_frames(origins,axes,pairs):
+	"""
+	Base-pair parameters and base-pair reference frames.
+
+	origins, axes - from fit_base_frames, (...,bases,3) and (...,bases,3,3).
+	pairs - (n_pairs,2) positions of paired bases (strand I, strand II).
+
+	Return
+	--------
+	pars - (...,n_pairs,6) Shear, Stretch, Stagger, Buckle, Prop-Tw, Opening.
+	bp_axes - (...,n_pairs,3,3) base-pair frames.
+	bp_origins - (...,n_pairs,3) their origins (x,y,z of ref_frames.dat).
+	antiparallel - (...,n_pairs) bool, True if z axes of the two bases are antiparallel.
+	"""
+	pairs=np.asarray(pairs,dtype=np.int64)
+	R1=axes[...,pairs[:,0],:,:]
+	o1=origins[...,pairs[:,0],:]
+	R2=axes[...,pairs[:,1],:,:]
+	o2=origins[...,pairs[:,1],:]
+	#for antiparallel strands the frame of the second base is turned over (y and z reversed)
+	antiparallel=np.einsum('...i,...i->...',R1[...,:,2],R2[...,:,2])<0
+	flip=np.where(antiparallel[...,None],-1.0,1.0)
+	R2=R2.copy()
+	R2[...,:,1]*=flip
+	R2[...,:,2]*=flip
+	pars,bp_axes,bp_origins=step_params(R2,o2,R1,o1)
+	return(pars,bp_axes,bp_origins,antiparallel)
+
+def base_pair_step_params(coords,topology,pairs):
+	"""
+	Base-pair and base-pair step parameters for every frame, as in bp_step.par of X3DNA.
+
+	Parameters
+	----------
+	coords - (frames,atoms,3) or (atoms,3) coordinates.
+	topology - BaseTopology for these atoms.
+	pairs - (n_pairs,2) positions of paired bases in topology, in the order of base pairs.
+
+	Return
+	--------
+	names - list of base pair names like A-T (- for antiparallel, + for parallel bases in the first frame).
+	params - (frames,n_pairs,12) array, columns as BP_PARAMS+STEP_PARAMS in dna_param:
+	Shear, Stretch, Stagger, Buckle, Prop-Tw, Opening, Shift, Slide, Rise, Tilt, Roll, Twist.
+	Like in bp_step.par, row i holds the step between pairs i-1 and i,
+	so step parameters of the first row are NaN.
+	If a single frame was given the frames dimension is dropped.
+	"""
+	coords,single=_as_frames(coords)
+	pairs=np.asarray(pairs,dtype=np.int64)
+	origins,axes=fit_base_frames(coords,topology)
+	bp,bp_axes,bp_origins,antiparallel=base_pair_frames(origins,axes,pairs)
+	params=np.full(bp.shape[:-1]+(12,),np.nan)
+	params[...,:6]=bp
+	if len(pairs)>1:
+		params[...,1:,6:]=step_params(bp_axes[...,:-1,:,:],bp_origins[...,:-1,:],bp_axes[...,1:,:,:],bp_origins[...,1:,:])[0]
+	names=[topology.bases[i]+('-' if ap else '+')+topology.bases[j] for (i,j),ap in zip(pairs,antiparallel[0])]
+	if single:
+		params=params[0]
+	return(names,params)
+
+
+###Backbone torsions and sugar pucker, as in the -t output of X3DNA analyze
+
+_CHI_PURINE=((0,"O4'"),(0,"C1'"),(0,'N9'),(0,'C4'))
+_CHI_PYRIMIDINE=((0,"O4'"),(0,"C1'"),(0,'N1'),(0,'C2'))
+
+#Main chain and chi torsions, (offset,atom) relative to the nucleotide
+TORSIONS=OrderedDict([
+	('alpha',((-1,"O3'"),(0,'P'),(0,"O5'"),(0,"C5'"))),
+	('beta',((0,'P'),(0,"O5'"),(0,"C5'"),(0,"C4'"))),
+	('gamma',((0,"O5'"),(0,"C5'"),(0,"C4'"),(0,"C3'"))),
+	('delta',((0,"C5'"),(0,"C4'"),(0,"C3'"),(0,"O3'"))),
+	('epsilon',((0,"C4'"),(0,"C3'"),(0,"O3'"),(1,'P'))),
+	('zeta',((0,"C3'"),(0,"O3'"),(1,'P'),(1,"O5'"))),
+	('chi',{'A':_CHI_PURINE,'G':_CHI_PURINE,'C':_CHI_PYRIMIDINE,'T':_CHI_PYRIMIDINE}),
+])
+
+#Endocyclic torsions of the sugar ring
+SUGAR_TORSIONS=OrderedDict([
+	('v0',((0,"C4'"),(0,"O4'"),(0,"C1'"),(0,"C2'"))),
+	('v1',((0,"O4'"),(0,"C1'"),(0,"C2'"),(0,"C3'"))),
+	('v2',((0,"C1'"),(0,"C2'"),(0,"C3'"),(0,"C4'"))),
+	('v3',((0,"C2'"),(0,"C3'"),(0,"C4'"),(0,"O4'"))),
+	('v4',((0,"C3'"),(0,"C4'"),(0,"O4'"),(0,"C1'"))),
+])
+
+PUCKER_PARAMS=list(SUGAR_TORSIONS.keys())+['tm','P']
+
+#Sugar puckering by 36 degree sectors of the phase angle P starting from 0
+PUCKERING=["C3'-endo","C4'-exo","O4'-endo","C1'-exo","C2'-endo","C3'-exo","C4'-endo","O4'-exo","C1'-endo","C2'-exo"]
+
+def dihedrals(coords,quads):
+	"""
+	Dihedral angles in degrees for (n,4) atom index quadruplets,
+	vectorized over frames, NaN where the index is -1.
+
+	coords - (frames,atoms,3) or (atoms,3).
+	Returns (frames,n) or (n,).
+	"""
+	coords,single=_as_frames(coords)
+	quads=np.asarray(quads,dtype=np.int64)
+	missing=(quads<0).any(axis=1)
+	p=coords[:,np.where(quads<0,0,quads)].astype(float)
+	b0=p[:,:,0]-p[:,:,1]
+	b1=p[:,:,2]-p[:,:,1]
+	b2=p[:,:,3]-p[:,:,2]
+	#missing atoms give zero vectors here, they are masked below
+	with np.errstate(invalid='ignore',divide='ignore'):
+		b1=_norm(b1)
+		v=b0-np.einsum('...i,...i->...',b0,b1)[...,None]*b1
+		w=b2-np.einsum('...i,...i->...',b2,b1)[...,None]*b1
+		x=np.einsum('...i,...i->...',v,w)
+		y=np.einsum('...i,...i->...',np.cross(b1,v),w)
+		ang=np.degrees(np.arctan2(y,x))
+	ang[:,missing]=np.nan
+	if single:
+		ang=ang[0]
+	return(ang)
+
+def pseudorotation(v):
+	"""
+	Amplitude tm and phase P (0..360) of sugar pseudorotation (Altona & Sundaralingam)
+	from (...,5) endocyclic torsions v0..v4 in degrees.
+	"""
+	v0,v1,v2,v3,v4=[v[...,i] for i in range(5)]
+	a=(v4+v1)-(v3+v0)
+	b=2.0*v2*(np.sin(np.radians(36.0))+np.sin(np.radians(72.0)))
+	P=np.degrees(np.arctan2(a,b))
+	tm=v2/np.cos(np.radians(P))
+	return(tm,np.mod(P,360.0))
+
+def puckering(P):
+	"""
+	Names of sugar puckering for phase angles P, None where P is NaN
+	"""
+	P=np.asarray(P,dtype=float)
+	res=np.empty(P.shape,dtype=object)
+	ok=~np.isnan(P)
+	res[ok]=np.array(PUCKERING,dtype=object)[(np.mod(P[ok],360.0)//36).astype(int)%10]
+	return(res)
+
+def _torsion_quads(topology):
+	"""
+	Quadruplets of all torsions, cached in the topology since they do not change between frames
+	"""
+	if getattr(topology,'_torsion_quads',None) is None:
+		defs=list(TORSIONS.items())+list(SUGAR_TORSIONS.items())
+		topology._torsion_quads=np.concatenate([topology.quadruplets(d) for n,d in defs])
+	return(topology._torsion_quads)
+
+def nucleotide_torsions(coords,topology):
+	"""
+	Torsions and sugar pucker of every nucleotide.
+
+	Returns (frames,residues,len(TORSIONS)+len(PUCKER_PARAMS)) array,
+	columns are alpha..chi, v0..v4, tm, P (or (residues,...) for a single frame).
+	"""
+	coords,single=_as_frames(coords)
+	n=len(topology)
+	nt=len(TORSIONS)
+	ang=dihedrals(coords,_torsion_quads(topology)).reshape(len(coords),nt+len(SUGAR_TORSIONS),n).transpose(0,2,1)
+	tm,P=pseudorotation(ang[...,nt:])
+	res=np.concatenate([ang,tm[...,None],P[...,None]],axis=-1)
+	if single:
+		res=res[0]
+	return(res)
+
+def backbone_torsions(coords,topology,pairs):
+	"""
+	Torsions and sugar pucker for both strands arranged by base pairs,
+	as parse_tor_param returns them from X3DNA output.
+
+	Parameters
+	----------
+	coords - (frames,atoms,3) or (atoms,3) coordinates.
+	topology - BaseTopology for these atoms.
+	pairs - (n_pairs,2) positions of paired bases (strand I, strand II).
+
+	Return
+	--------
+	columns - alpha_1..chi_1, alpha_2..chi_2, v0_1..P_1, v0_2..P_2,
+	where _1 is the base of strand I and _2 the complementary base of strand II
+	(so the second strand goes in 3'-5' direction).
+	values - (frames,n_pairs,len(columns)) array (or (n_pairs,...) for a single frame).
+	"""
+	pairs=np.asarray(pairs,dtype=np.int64)
+	tors=nucleotide_torsions(coords,topology)
+	nt=len(TORSIONS)
+	s1=tors[...,pairs[:,0],:]
+	s2=tors[...,pairs[:,1],:]
+	values=np.concatenate([s1[...,:nt],s2[...,:nt],s1[...,nt:],s2[...,nt:]],axis=-1)
+	names=list(TORSIONS.keys())
+	columns=[c+'_1' for c in names]+[c+'_2' for c in names]+[c+'_1' for c in PUCKER_PARAMS]+[c+'_2' for c in PUCKER_PARAMS]
+	return(columns,values)
+
+
+###Base pairing, the criteria of X3DNA find_pair
+
+#Base nitrogens and oxygens that may form hydrogen bonds in a pair
+HBOND_ATOMS={
+	'A':['N1','N3','N6','N7'],
+	'G':['N1','N2','N3','O6','N7'],
+	'C':['N3','O2','N4'],
+	'T':['N3','O2','O4'],
+}
+
+#Glycosidic nitrogens, used for the N-N distance criterion
+GLYCOSIDIC_N={'A':'N9','G':'N9','C':'N1','T':'N1'}
+
+#Default criteria of find_pair (see the end of its .inp output)
+PAIRING_CRITERIA=OrderedDict([
+	('max_hbond',4.0),  # at least one N/O-N/O distance below this
+	('max_dorg',15.0),  # distance between base origins
+	('max_dv',2.5),     # vertical separation of base origins along the mean normal
+	('max_angle',65.0), # angle between base normals
+	('min_dnn',4.5),    # distance between glycosidic nitrogens
+])
+
+def _pair_atom_index(topology,pairs,atoms):
+	"""
+	(n_pairs,k) atom indices of atoms of the first and the second base of each pair, -1 padded
+	"""
+	k=max(len(v) for v in atoms.values())
+	res=[]
+	for col in (0,1):
+		idx=np.full((len(pairs),k),-1,dtype=np.int64)
+		for p,r in enumerate(pairs[:,col]):
+			names=atoms[topology.bases[r]]
+			idx[p,:len(names)]=[topology.atoms[r].get(n,-1) for n in names]
+		res.append(idx)
+	return(res)
+
+def base_pairing(coords,topology,pairs,**criteria):
+	"""
+	Checks for every frame which of the given (reference) pairs are still paired.
+
+	Parameters
+	----------
+	coords - (frames,atoms,3) or (atoms,3) coordinates.
+	topology - BaseTopology for these atoms.
+	pairs - (n_pairs,2) positions of paired bases, e.g. from the reference find_pair output.
+	criteria - to override PAIRING_CRITERIA.
+
+	Return
+	--------
+	(frames,n_pairs) bool array (or (n_pairs,) for a single frame),
+	True where the two bases satisfy all the criteria.
+	"""
+	crit=dict(PAIRING_CRITERIA)
+	for k in criteria:
+		if k not in crit:
+			raise TypeError('Unknown pairing criterion %s'%k)
+	crit.update(criteria)
+	coords,single=_as_frames(coords)
+	pairs=np.asarray(pairs,dtype=np.int64)
+
+	origins,axes=fit_base_frames(coords,topology)
+	o1=origins[:,pairs[:,0]]
+	o2=origins[:,pairs[:,1]]
+	z1=axes[:,pairs[:,0]][...,:,2]
+	z2=axes[:,pairs[:,1]][...,:,2]
+	dot=np.einsum('...i,...i->...',z1,z2)
+	#normal of the second base is turned for antiparallel bases
+	z2=np.where((dot<0)[...,None],-z2,z2)
+	angle=np.degrees(_angle(z1,z2))
+	normal=_norm(z1+z2)
+	dorg=o2-o1
+	dv=np.abs(np.einsum('...i,...i->...',dorg,normal))
+	dorg=np.linalg.norm(dorg,axis=-1)
+
+	n1,n2=_pair_atom_index(topology,pairs,dict((b,[a]) for b,a in GLYCOSIDIC_N.items()))
+	dnn=np.linalg.norm(coords[:,n1[:,0]]-coords[:,n2[:,0]],axis=-1)
+
+	h1,h2=_pair_atom_index(topology,pairs,HBOND_ATOMS)
+	d=np.linalg.norm(coords[:,np.where(h1<0,0,h1)][:,:,:,None,:]-coords[:,np.where(h2<0,0,h2)][:,:,None,:,:],axis=-1)
+	d[:,(h1<0)[:,:,None]|(h2<0)[:,None,:]]=np.inf
+	hbond=d.min(axis=(-1,-2))<=crit['max_hbond']
+
+	paired=hbond&(dorg<=crit['max_dorg'])&(dv<=crit['max_dv'])&(angle<=crit['max_angle'])&(dnn>=crit['min_dnn'])
+	if single:
+		paired=paired[0]
+	return(paired)
@@ -0,0 +1,256 @@
+"""
+Groove widths, helical axis and bending of DNA in NumPy, for blocks of frames.
+
+An in-process alternative to the groove parameters of Curves+ (CURVES_analyze):
+- groove widths come from phosphate-phosphate distances across the grooves:
+for every P of strand I the closest point of the strand II phosphate polyline is found
+within the minor (strand II partner 2..6 pairs back) and major (2..6 pairs ahead) groove windows,
+the width is this distance minus 5.8 A (two phosphate radii) as in Curves+ and 3DNA,
+and it is assigned to the level halfway between the two phosphates;
+the depth is the distance from the middle of the width vector to the base-pair center at that level,
+- the helical axis is the base-pair origins smoothed over a helical turn,
+bending is the angle between axis tangents and curvature is 1/R of the circle through axis points.
+Levels follow Curves+: 1..N for base pairs and half levels between them.
+
+Usage:
+top=BaseTopology.from_atomsel(DNA); pairs=strand_pairs(top)
+levels,gr=groove_widths(coords,top,pairs)     # (frames,levels,4) W12,D12,W21,D21
+axis,bend,curv=helical_axis(coords,top,pairs)
+df=groove_dataframe(levels,gr[0])             # same layout as dna_param.parse_lis
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from dna_geometry import _as_frames, fit_base_frames, pair_origins
+
+#Columns of the (E) groove section of Curves+ lis files
+GROOVE_COLUMNS=['W12','D12','W21','D21']
+AXIS_COLUMNS=['X','Y','Z','Bend','Curv']
+
+#Width of two phosphate groups subtracted from P-P distances
+P_DIAMETER=5.8
+
+#Offsets (in base pairs) of the strand II phosphates looked at across the grooves
+MINOR_WINDOW=(2,6)
+MAJOR_WINDOW=(2,6)
+
+
+def strand_pairs(topology):
+	"""
+	Pairs bases of a duplex without find_pair: the first segment goes 5'-3',
+	the second one is reversed, as CURVES_analyze assumes.
+	Returns (n_pairs,2) positions in topology.
+	"""
+	segids=[]
+	for seg,resid in topology.residues:
+		if seg not in segids:
+			segids.append(seg)
+	if len(segids)<2:
+		raise ValueError('Two DNA segments are needed to pair bases, found %s'%(segids,))
+	s1=[k for k,(seg,resid) in enumerate(topology.residues) if seg==segids[0]]
+	s2=[k for k,(seg,resid) in enumerate(topology.residues) if seg==segids[1]][::-1]
+	n=min(len(s1),len(s2))
+	return(np.column_stack([s1[:n],s2[:n]]).astype(np.int64))
+
+def levels(n_pairs):
+	"""
+	Curves+ levels for n_pairs base pairs: 1, 1.5, 2, ... n_pairs
+	"""
+	return(np.arange(2*n_pairs-1)*0.5+1)
+
+def _phosphates(coords,topology,pairs):
+	"""
+	(frames,n_pairs,3) P coordinates of strand I and strand II bases of pairs, NaN where P is missing
+	"""
+	res=[]
+	for strand in (0,1):
+		idx=np.array([topology.atoms[k].get('P',-1) for k in pairs[:,strand]],dtype=np.int64)
+		P=coords[:,np.maximum(idx,0)].astype(float)
+		P[:,idx<0]=np.nan
+		res.append(P)
+	return(res)
+
+def _closest_on_polyline(points,poly,offsets):
+	"""
+	For every point a the closest point on segments poly[b]-poly[b+1] for b=a+offsets.
+
+	points, poly - (frames,n,3). offsets - integer array of segment starts relative to a.
+	Return
+	--------
+	dist, pos - (frames,n) distance and fractional index b+t of the closest point, NaN if none.
+	foot - (frames,n,3) the closest point.
+	"""
+	nf,n=points.shape[:2]
+	a=np.arange(n)
+	b=a[:,np.newaxis]+offsets[np.newaxis,:]
+	ok=(b>=0)&(b+1<n)
+	b=np.clip(b,0,n-2)
+	start=poly[:,b]
+	seg=poly[:,b+1]-start
+	rel=points[:,:,np.newaxis]-start
+	with np.errstate(invalid='ignore',divide='ignore'):
+		t=np.clip((rel*seg).sum(axis=-1)/(seg*seg).sum(axis=-1),0.0,1.0)
+	foot=start+t[...,np.newaxis]*seg
+	d=np.linalg.norm(points[:,:,np.newaxis]-foot,axis=-1)
+	d=np.where(ok[np.newaxis]&~np.isnan(d),d,np.inf)
+	best=np.argmin(d,axis=-1)
+	sel=(np.arange(nf)[:,np.newaxis],a[np.newaxis,:],best)
+	dist=d[sel]
+	pos=(b[np.newaxis]+t)[sel]
+	foot=foot[sel]
+	missing=~np.isfinite(dist)
+	dist[missing]=np.nan
+	pos[missing]=np.nan
+	return(dist,pos,foot)
+
+def _interp_rows(x,xp,fp):
+	"""
+	np.interp for every frame (row) of xp,fp with NaN skipped, NaN outside of the data range
+	"""
+	res=np.full((len(xp),len(x)),np.nan)
+	for f in range(len(xp)):
+		ok=~(np.isnan(xp[f])|np.isnan(fp[f]))
+		if ok.sum()<2:
+			continue
+		order=np.argsort(xp[f][ok])
+		xs=xp[f][ok][order]
+		res[f]=np.interp(x,xs,fp[f][ok][order],left=np.nan,right=np.nan)
+	return(res)
+
+def groove_widths(coords,topology,pairs,minor_window=MINOR_WINDOW,major_window=MAJOR_WINDOW):
+	"""
+	Minor and major groove widths and depths for every frame.
+
+	Parameters
+	----------
+	coords - (frames,atoms,3) or (atoms,3) coordinates.
+	topology - dna_geometry.BaseTopology. pairs - (n_pairs,2) from strand_pairs or find_pair.
+	minor_window, major_window - (first,last) offsets of strand II phosphates, in base pairs.
+
+	Return
+	--------
+	levels - (2*n_pairs-1,) Curves+ levels.
+	values - (frames,levels,4) W12 (minor width), D12 (minor depth), W21 (major width), D21 (major depth),
+	NaN where the groove is not spanned by phosphates.
+	If a single frame was given the frames dimension is dropped.
+	"""
+	coords,single=_as_frames(coords)
+	pairs=np.asarray(pairs,dtype=np.int64)
+	n=len(pairs)
+	grid=levels(n)
+	origins,_=fit_base_frames(coords,topology)
+	centers=pair_origins(origins,pairs)
+	PI,PII=_phosphates(coords,topology,pairs)
+	values=np.full((len(coords),len(grid),4),np.nan)
+	#segments b..b+1 between the first and the last phosphate of a window
+	windows=((0,-np.arange(minor_window[1],minor_window[0],-1)),(2,np.arange(major_window[0],major_window[1])))
+	for col,offsets in windows:
+		dist,pos,foot=_closest_on_polyline(PI,PII,offsets)
+		level=0.5*(np.arange(n)[np.newaxis,:]+pos)+1
+		mid=0.5*(PI+foot)
+		#base-pair center at the (fractional) level of the width vector
+		k=np.clip(np.floor(level-1),0,max(n-2,0))
+		k=np.where(np.isnan(k),0,k).astype(np.int64)
+		frac=np.nan_to_num(level-1-k)[...,np.newaxis]
+		fi=np.arange(len(coords))[:,np.newaxis]
+		center=centers[fi,k]*(1-frac)+centers[fi,np.minimum(k+1,n-1)]*frac
+		depth=np.linalg.norm(mid-center,axis=-1)
+		values[:,:,col]=_interp_rows(grid,level,dist-P_DIAMETER)
+		values[:,:,col+1]=_interp_rows(grid,level,depth)
+	if single:
+		values=values[0]
+	return(grid,values)
+
+def helical_axis(coords,topology,pairs,turn=10,span=None):
+	"""
+	Helical axis from base-pair centers smoothed over a helical turn,
+	its bending and curvature for every frame.
+
+	Parameters
+	----------
+	coords - (frames,atoms,3) or (atoms,3) coordinates.
+	topology, pairs - as in groove_widths.
+	turn - base pairs per turn, centers are averaged over turn+1 pairs with half weights at the ends.
+	span - distance in base pairs over which bending and curvature are measured, turn by default.
+
+	Return
+	--------
+	axis - (frames,n_pairs,3) axis points at base-pair levels, NaN within turn/2 of the ends.
+	bend - (frames,n_pairs) angle in degrees between axis directions span/2 before and after the level.
+	curvature - (frames,n_pairs) 1/R in 1/A of the circle through axis points span/2 before, at and after the level.
+	If a single frame was given the frames dimension is dropped.
+	"""
+	coords,single=_as_frames(coords)
+	pairs=np.asarray(pairs,dtype=np.int64)
+	n=len(pairs)
+	span=span or turn
+	origins,_=fit_base_frames(coords,topology)
+	centers=pair_origins(origins,pairs)
+	w=np.ones(turn+1)
+	w[0]=w[-1]=0.5
+	w/=w.sum()
+	h=turn//2
+	axis=np.full(centers.shape,np.nan)
+	if n>turn:
+		windows=np.stack([centers[:,j:n-turn+j] for j in range(turn+1)],axis=0)
+		axis[:,h:n-turn+h]=np.einsum('j,jfkx->fkx',w,windows)
+	s=max(1,span//2)
+	bend=np.full(centers.shape[:2],np.nan)
+	curv=np.full(centers.shape[:2],np.nan)
+	if n>2*s:
+		u=axis[:,s:n-s]-axis[:,:n-2*s]
+		v=axis[:,2*s:]-axis[:,s:n-s]
+		nu=np.linalg.norm(u,axis=-1);nv=np.linalg.norm(v,axis=-1)
+		with np.errstate(invalid='ignore',divide='ignore'):
+			cos=(u*v).sum(axis=-1)/(nu*nv)
+			bend[:,s:n-s]=np.degrees(np.arccos(np.clip(cos,-1.0,1.0)))
+			curv[:,s:n-s]=2*np.linalg.norm(np.cross(u,v),axis=-1)/(nu*nv*np.linalg.norm(u+v,axis=-1))
+	if single:
+		axis,bend,curv=axis[0],bend[0],curv[0]
+	return(axis,bend,curv)
+
+def global_axis(axis):
+	"""
+	Global helical axis: the line fitted to axis points (...,n,3) by least squares,
+	returns its point (...,3) and unit direction (...,3) from the first to the last base pair
+	"""
+	axis=np.asarray(axis,dtype=float)
+	single=axis.ndim==2
+	if single:
+		axis=axis[np.newaxis]
+	points=np.empty((len(axis),3))
+	directions=np.empty((len(axis),3))
+	for f,a in enumerate(axis):
+		a=a[~np.isnan(a).any(axis=1)]
+		if len(a)<2:
+			points[f]=directions[f]=np.nan
+			continue
+		c=a.mean(axis=0)
+		d=np.linalg.svd(a-c)[2][0]
+		if np.dot(a[-1]-a[0],d)<0:
+			d=-d
+		points[f]=c
+		directions[f]=d
+	if single:
+		return(points[0],directions[0])
+	return(points,directions)
+
+def groove_dataframe(level,values):
+	"""
+	Data frame of one frame in the layout of dna_param.parse_lis: Level,W12,D12,W21,D21
+	"""
+	data=OrderedDict([('Level',level)])
+	for j,c in enumerate(GROOVE_COLUMNS):
+		data[c]=values[:,j]
+	return(pd.DataFrame(data,columns=['Level']+GROOVE_COLUMNS))
+
+def axis_dataframe(axis,bend,curvature):
+	"""
+	Data frame of one frame with Level (base pairs 1..N),X,Y,Z of the axis,Bend,Curv
+	"""
+	n=len(axis)
+	data=OrderedDict([('Level',np.arange(1,n+1,dtype=float)),('X',axis[:,0]),('Y',axis[:,1]),('Z',axis[:,2]),
+		('Bend',bend),('Curv',curvature)])
+	return(pd.DataFrame(data,columns=['Level']+AXIS_COLUMNS))
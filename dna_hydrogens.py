@@ -0,0 +1,229 @@
+"""
+Placement of DNA hydrogens from templates.
+
+Positions of hydrogens bound to sugar and base atoms are fully determined by the heavy atoms
+(the rotatable amino and methyl groups are put in their usual planar/staggered positions),
+so they are built here with vectorized NumPy instead of running reduce on every frame.
+Every hydrogen is described in the local frame of its parent atom P and two reference atoms A and B:
+e1 along A-P, e2 in the P,A,B plane, e3=e1 x e2. The local coordinates (the template) are derived once,
+either from standard geometry (bond lengths, tetrahedral and trigonal angles) or fitted to
+a structure that already has hydrogens, e.g. the first reduce output, and then applied to every frame.
+
+Usage:
+builder=HydrogenBuilder(BaseTopology.from_atomsel(DNA_atomsel))
+names,res,xyz_H=builder.place(xyz)   # names, residue positions and (n_H,3) coordinates
+xyz_all=builder.merge(xyz)           # atoms and hydrogens, each hydrogen after its parent
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from dna_geometry import GLYCOSIDIC_N
+
+#Hydrogens: name -> (parent, reference A, reference B, rule, bond length, bases)
+#rules: sp3_1 - one H on an atom with three heavy neighbors (A, B and the third in third_neighbor),
+#sp3_2+/sp3_2- - two H on an atom with two heavy neighbors A and B,
+#sp2_1 - one H in the plane of a trigonal atom with neighbors A and B,
+#sp2_cis/sp2_trans - amino H in the plane, cis or trans to B across the P-A bond,
+#sp3_m1/2/3 - methyl H staggered with respect to B across the P-A bond.
+HYDROGENS=OrderedDict([
+	("H1'",("C1'","O4'","C2'",'sp3_1',1.09,'AGCT')),
+	("H2'",("C2'","C1'","C3'",'sp3_2-',1.09,'AGCT')),
+	("H2''",("C2'","C1'","C3'",'sp3_2+',1.09,'AGCT')),
+	("H3'",("C3'","C2'","C4'",'sp3_1',1.09,'AGCT')),
+	("H4'",("C4'","C3'","O4'",'sp3_1',1.09,'AGCT')),
+	("H5'",("C5'","O5'","C4'",'sp3_2+',1.09,'AGCT')),
+	("H5''",("C5'","O5'","C4'",'sp3_2-',1.09,'AGCT')),
+	('H8',('C8','N7','N9','sp2_1',1.08,'AG')),
+	('H2',('C2','N1','N3','sp2_1',1.08,'A')),
+	('H61',('N6','C6','N1','sp2_cis',1.01,'A')),
+	('H62',('N6','C6','N1','sp2_trans',1.01,'A')),
+	('H1',('N1','C2','C6','sp2_1',1.01,'G')),
+	('H21',('N2','C2','N1','sp2_cis',1.01,'G')),
+	('H22',('N2','C2','N1','sp2_trans',1.01,'G')),
+	('H6',('C6','N1','C5','sp2_1',1.08,'CT')),
+	('H5',('C5','C4','C6','sp2_1',1.08,'C')),
+	('H41',('N4','C4','N3','sp2_cis',1.01,'C')),
+	('H42',('N4','C4','N3','sp2_trans',1.01,'C')),
+	('H3',('N3','C2','C4','sp2_1',1.01,'T')),
+	('H71',('C7','C5','C4','sp3_m1',1.09,'T')),
+	('H72',('C7','C5','C4','sp3_m2',1.09,'T')),
+	('H73',('C7','C5','C4','sp3_m3',1.09,'T')),
+])
+
+#Third heavy neighbor of sp3_1 parents, the glycosidic N depends on the base
+_THIRD_NEIGHBOR={"H1'":GLYCOSIDIC_N,"H3'":"O3'","H4'":"C5'"}
+
+#Sugar hydrogens, the ones get_dna_SASA reports
+SUGAR_HYDROGENS=["H1'","H2'","H2''","H3'","H4'","H5'","H5''"]
+
+#CHARMM names of hydrogens and their PDB names used here
+HYDROGEN_ALIASES={'H51':'H71','H52':'H72','H53':'H73'}
+
+_TETRAHEDRAL=np.radians(109.47)
+
+
+def _unit(v):
+	return(v/np.linalg.norm(v,axis=-1)[...,np.newaxis])
+
+def _local_frames(P,A,B):
+	"""
+	(n,3,3) frames with rows e1,e2,e3 for parents P and references A,B (all (n,3))
+	"""
+	e1=_unit(A-P)
+	v=B-P
+	e2=_unit(v-(v*e1).sum(axis=-1)[:,np.newaxis]*e1)
+	e3=np.cross(e1,e2)
+	return(np.stack([e1,e2,e3],axis=1))
+
+def _nerf(P,A,B,length,angle,dihedral):
+	"""
+	Positions H with |H-P|=length, angle A-P-H and dihedral B-A-P-H, vectorized over rows of P,A,B
+	"""
+	bc=_unit(P-A)
+	n=_unit(np.cross(A-B,bc))
+	m=np.cross(n,bc)
+	d=np.stack([-length*np.cos(angle)*np.ones(len(P)),length*np.sin(angle)*np.cos(dihedral)*np.ones(len(P)),
+		length*np.sin(angle)*np.sin(dihedral)*np.ones(len(P))],axis=1)
+	return(P+d[:,0:1]*bc+d[:,1:2]*m+d[:,2:3]*n)
+
+def _ideal(rule,length,P,A,B,C=None):
+	"""
+	Standard geometry positions for rule (see HYDROGENS), C - third neighbor for sp3_1
+	"""
+	ua=_unit(A-P)
+	ub=_unit(B-P)
+	if rule=='sp3_1':
+		return(P+length*_unit(-(ua+ub+_unit(C-P))))
+	if rule in ('sp3_2+','sp3_2-'):
+		bis=_unit(-(ua+ub))
+		perp=_unit(np.cross(ua,ub))
+		sign=1 if rule=='sp3_2+' else -1
+		half=_TETRAHEDRAL/2
+		return(P+length*(np.cos(half)*bis+sign*np.sin(half)*perp))
+	if rule=='sp2_1':
+		return(P+length*_unit(-(ua+ub)))
+	if rule=='sp2_cis':
+		return(_nerf(P,A,B,length,np.radians(120.0),0.0))
+	if rule=='sp2_trans':
+		return(_nerf(P,A,B,length,np.radians(120.0),np.pi))
+	if rule.startswith('sp3_m'):
+		k=int(rule[-1])-1
+		return(_nerf(P,A,B,length,_TETRAHEDRAL,np.radians(180.0-120.0*k)))
+	raise ValueError('Unknown hydrogen rule %s'%rule)
+
+
+class HydrogenBuilder(object):
+	"""
+	Places hydrogens of DNA residues of a topology (dna_geometry.BaseTopology).
+
+	Attributes
+	----------
+	names - names of hydrogens that can be built, in the order of output.
+	residue - (n_H,) residue positions (in topology.residues) of the hydrogens.
+	parent - (n_H,) indices of the atoms the hydrogens are bound to.
+	templates - dict hydrogen name -> (3,) local coordinates, None until derived.
+	"""
+
+	def __init__(self,topology,hydrogens=None,templates=None,missing=True):
+		"""
+		topology - dna_geometry.BaseTopology.
+		hydrogens - names of hydrogens to build, all in HYDROGENS by default.
+		templates - local coordinates from an earlier fit (see fit), standard geometry otherwise.
+		missing - build only hydrogens that are not in the residue already (CHARMM names count too).
+		"""
+		charmm=dict((v,k) for k,v in HYDROGEN_ALIASES.items())
+		self.topology=topology
+		hydrogens=list(HYDROGENS.keys()) if hydrogens is None else list(hydrogens)
+		self.names=[]
+		res=[];idx=[]
+		for k,base in enumerate(topology.bases):
+			atoms=topology.atoms[k]
+			for h in hydrogens:
+				parent,a,b,rule,length,bases=HYDROGENS[h]
+				if base not in bases:
+					continue
+				third=_THIRD_NEIGHBOR.get(h)
+				if isinstance(third,dict):
+					third=third[base]
+				need=[parent,a,b]+([third] if third else [])
+				if not all(n in atoms for n in need):
+					continue
+				if missing and (h in atoms or charmm.get(h) in atoms):
+					continue
+				self.names.append(h)
+				res.append(k)
+				idx.append([atoms[n] for n in need]+([] if third else [atoms[parent]]))
+		self.residue=np.array(res,dtype=np.int64)
+		self._index=np.array(idx,dtype=np.int64).reshape(-1,4)
+		self.parent=self._index[:,0]
+		self._names=np.array(self.names,dtype=object)
+		self.templates=templates
+
+	def ideal(self,xyz):
+		"""
+		Returns (n_H,3) positions of hydrogens from standard geometry
+		"""
+		xyz=np.asarray(xyz,dtype=np.float64)
+		res=np.empty((len(self.names),3))
+		for h in set(self.names):
+			sel=self._names==h
+			parent,a,b,rule,length,bases=HYDROGENS[h]
+			i=self._index[sel]
+			res[sel]=_ideal(rule,length,xyz[i[:,0]],xyz[i[:,1]],xyz[i[:,2]],xyz[i[:,3]])
+		return(res)
+
+	def fit(self,xyz,xyz_H=None):
+		"""
+		Derives templates: local coordinates of every hydrogen name averaged over residues.
+		xyz - heavy atom coordinates, xyz_H - (n_H,3) hydrogen positions in the order of names,
+		e.g. taken from a reduce output, NaN rows are skipped. Standard geometry is used
+		if xyz_H is None and for hydrogen names without any position given.
+		Returns self.
+		"""
+		xyz=np.asarray(xyz,dtype=np.float64)
+		P=xyz[self.parent]
+		frames=_local_frames(P,xyz[self._index[:,1]],xyz[self._index[:,2]])
+		ideal=np.einsum('nij,nj->ni',frames,self.ideal(xyz)-P)
+		local=ideal if xyz_H is None else np.einsum('nij,nj->ni',frames,np.asarray(xyz_H,dtype=np.float64)-P)
+		self.templates={}
+		for h in set(self.names):
+			sel=self._names==h
+			v=local[sel]
+			v=v[~np.isnan(v).any(axis=1)]
+			self.templates[h]=v.mean(axis=0) if len(v) else ideal[sel].mean(axis=0)
+		return(self)
+
+	def place(self,xyz):
+		"""
+		Places hydrogens for (n_atoms,3) coordinates of the topology atoms.
+		The templates are derived from standard geometry on the first call if not given.
+
+		Return
+		--------
+		names - list of hydrogen names, residue - (n_H,) residue positions, (n_H,3) coordinates.
+		"""
+		xyz=np.asarray(xyz,dtype=np.float64)
+		if self.templates is None:
+			self.fit(xyz)
+		P=xyz[self.parent]
+		frames=_local_frames(P,xyz[self._index[:,1]],xyz[self._index[:,2]])
+		local=np.array([self.templates.get(h,(np.nan,np.nan,np.nan)) for h in self.names]).reshape(-1,3)
+		return(self.names,self.residue,P+np.einsum('nji,nj->ni',frames,local))
+
+	def merged_order(self,n_atoms):
+		"""
+		Order of atoms 0..n_atoms-1 and hydrogens (n_atoms+k) where every hydrogen follows its parent,
+		so that residues stay contiguous when written out
+		"""
+		key=np.concatenate([np.arange(n_atoms),self.parent])
+		return(np.argsort(key,kind='mergesort'))
+
+	def merge(self,xyz,order=None):
+		"""
+		Returns (n_atoms+n_H,3) coordinates of the atoms with the hydrogens placed, in merged_order
+		"""
+		xyz=np.asarray(xyz,dtype=np.float64)
+		if order is None:
+			order=self.merged_order(len(xyz))
+		return(np.concatenate([xyz,self.place(xyz)[2]])[order])
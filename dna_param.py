@@ -5,6 +5,9 @@ within VMD through external calls to 3DNA and Curves+
 Both programs should be installed
 and configured beforehand
 
+VMD is not required to import it: any selection-like object from backends.py
+(Structure reads PDB and DCD files with NumPy) can be used instead of a VMD atomsel.
+
 It also provides the possibility to rebuild DNA via X3DNA, see lower part of the file.
 
 And now functionality to get SASA of hydrogens, see even lower part.
@@ -13,24 +16,39 @@ Naccess and phenix.reduce (if adding hydrogens) are needed.
 """
 import os
 import subprocess
-from VMD import *
-from Molecule import *
-from atomsel import *
 
 import pandas as pd
 import re
 
 import uuid
+import functools
+import shutil
+import tempfile
+from contextlib import contextmanager
 
 # from scipy.spatial import KDTree
 # from scipy.spatial import cKDTree
 import numpy as np
-from collections import OrderedDict
+from collections import OrderedDict, deque
+import multiprocessing
+from multiprocessing import cpu_count
+
+from dna_geometry import BaseTopology, base_pair_step_params, backbone_torsions, base_pairing
+from result_cache import ResultCache, file_signature, canonical
+from traj_results import TrajectoryResults, FrameResult, CSVSink, NPZChunkSink
+from traj_stats import BPStats
+from pdb_io import PDBWriter, PDB_ATOM_NAMES
+from backends import vmd_goto, copy_frames, maps_frames, Structure
+from dna_sasa import SASAEngine, atom_radii, read_radii
+from dna_hydrogens import HydrogenBuilder
+from dna_rebuild import DNARebuilder, write_par, params_from_dataframe
+from dna_grooves import strand_pairs, groove_widths, helical_axis, groove_dataframe, axis_dataframe
+from stage_timer import TIMER, timed, log, tool_output, get_log_level, set_log_level, summary
 
 __author__="Alexey Shaytan"
 
 TEMP='/tmp/'
-#P_X3DNA_DIR='/Users/alexeyshaytan/soft/x3dna-v2.1'
+P_X3DNA_DIR=os.environ.get('X3DNA','/Users/alexeyshaytan/soft/x3dna-v2.1')
 P_X3DNA_analyze='analyze'
 P_X3DNA_find_pair='find_pair'
 P_X3DNA_rebuild='rebuild'
@@ -44,10 +62,72 @@ P_NACCESS='/Users/alexeyshaytan/bin/naccess'
 P_REDUCE_PHENIX='/Applications/phenix-1.10.1-2155/build/bin/phenix.reduce'
 P_REDUCE_AMBER='/Users/alexeyshaytan/soft/amber12/bin/reduce'
 
+#Private per-call working directories are created here, tmpfs is used if present
+SCRATCH_ROOT='/dev/shm' if os.path.isdir('/dev/shm') else TEMP
+
 
 os.environ['X3DNA']=P_X3DNA_DIR
 
-def X3DNA_find_pair(DNA_atomsel):
+
+@contextmanager
+def scratch_dir(keep=False):
+	"""Context manager that gives a private working directory for one call
+
+	X3DNA and friends write their outputs under fixed names (ref_frames.dat, bp_step.par, backbone.tor ...)
+	into the current directory, so every call that runs them gets its own directory
+	under SCRATCH_ROOT. The directory and everything in it is removed on exit,
+	unless keep=True (useful for debugging).
+
+	Usage:
+	with scratch_dir() as wd:
+		...
+	"""
+	wd=tempfile.mkdtemp(prefix='dna_param_',dir=SCRATCH_ROOT)
+	try:
+		yield wd
+	finally:
+		if not keep:
+			shutil.rmtree(wd,ignore_errors=True)
+
+
+#PDB writers built for selections in this process, see _pdb_writer
+_pdb_writers={}
+
+#DNA residue names right aligned in columns 18-20, as reduce expects them
+_SASA_RESNAMES=dict((r,' '+r) for r in ['DA','DG','DC','DT'])
+
+def _coords(DNA_atomsel):
+	"""
+	Returns (n_atoms,3) coordinates of the selection in the current frame
+	"""
+	if hasattr(DNA_atomsel,'coords'):
+		return(DNA_atomsel.coords())
+	return(np.column_stack([DNA_atomsel.get('x'),DNA_atomsel.get('y'),DNA_atomsel.get('z')]))
+
+def _pdb_writer(DNA_atomsel,**kwargs):
+	"""
+	Returns a PDBWriter for the selection, the topology columns are formatted
+	only the first time a selection is written with given renames (kwargs of PDBWriter).
+	Changing names of atoms of the selection after that requires _pdb_writers.clear().
+	"""
+	key=(id(DNA_atomsel),repr(sorted(kwargs.items())))
+	if key not in _pdb_writers:
+		_pdb_writers[key]=PDBWriter.from_atomsel(DNA_atomsel,**kwargs)
+	return(_pdb_writers[key])
+
+def _write_pdb(DNA_atomsel,workdir):
+	"""
+	Writes DNA_atomsel to a uniquely named pdb in workdir and returns the unique name without extension
+	"""
+	unique=str(uuid.uuid4())
+	pdb = unique+'.pdb'
+	log("Writing coords to "+pdb,'verbose')
+	with TIMER.stage('pdb_write'):
+		_pdb_writer(DNA_atomsel).write(_coords(DNA_atomsel),os.path.join(workdir,pdb))
+	return(unique)
+
+
+def X3DNA_find_pair(DNA_atomsel,workdir=TEMP):
 	""" Runs find_pair program from X3DNA and returns a path to unique file with defined pairs
 
 	This is needed to supply this path to 3DNA_analyze,
@@ -60,31 +140,109 @@ def X3DNA_find_pair(DNA_atomsel):
 	----------
 	DNA_atomsel - DNA segments selected by atomsel command in VMD.
 	(NOT AtomSel!)
+	workdir - directory where the pdb and find_pair output are written,
+	TEMP by default, so that the reference file survives between calls.
 
 	Return
 	----------
 	returns a unique string - which is the file name of find_pair outfile
-	in the TEMP directory.
+	in the workdir directory.
 	"""
 
 	#At first we need to makup a couple of unique file names
-	unique=str(uuid.uuid4())
-	pdb = unique+'.pdb'
-	outf = unique
+	outf=_write_pdb(DNA_atomsel,workdir)
+	pdb = outf+'.pdb'
 
-	print("Writing coords to "+pdb)
-	DNA_atomsel.write('pdb',TEMP+'/'+pdb)
 	cmd=P_X3DNA_find_pair+' '+pdb+' '+outf
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	# wait for the process to terminate
-	out, err = p.communicate()
+	with TIMER.stage('find_pair'):
+		p = subprocess.Popen(cmd,shell=True,cwd=workdir,stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+		# wait for the process to terminate
+		out, err = p.communicate()
 	errcode = p.returncode
-	print('OUT:'+out)
-	print('ERR:'+err)
+	tool_output('find_pair',out,err,errcode)
 	return(outf)
 
 
-def X3DNA_analyze(DNA_atomsel,ref_fp_id):
+#Stages of X3DNA_analyze:
+#frames - x,y,z centers of base pairs (ref_frames.dat)
+#bp - base-pair and step parameters (bp_step.par)
+#pairing - Pairing with respect to the reference
+#torsions - sugar and backbone torsions
+STAGES=('frames','bp','pairing','torsions')
+
+#Named sets of stages
+PROFILES={
+	'full':set(STAGES),
+	'bp_step':set(['bp']),
+	'geometry':set(['frames','bp']),
+	'torsions':set(['torsions']),
+}
+
+def _analysis_stages(stages):
+	"""
+	Converts profile name or iterable of stage names into a set of stages
+	"""
+	if isinstance(stages,str):
+		if stages not in PROFILES:
+			raise ValueError('Unknown profile %s, choose from %s'%(stages,', '.join(sorted(PROFILES))))
+		return(set(PROFILES[stages]))
+	stages=set(stages)
+	unknown=stages-set(STAGES)
+	if unknown:
+		raise ValueError('Unknown stages %s, choose from %s'%(', '.join(sorted(unknown)),', '.join(STAGES)))
+	return(stages)
+
+def returns_records(func):
+	"""
+	Marks an analysis function that takes records=True and then returns traj_results.FrameResult
+	filled from the parsed or computed arrays, so that trajectory workers build no data frame per frame
+	"""
+	func.returns_records=True
+	return(func)
+
+def _returns_records(analyze):
+	while isinstance(analyze,functools.partial):
+		analyze=analyze.func
+	return(getattr(analyze,'returns_records',False))
+
+def _frame_record(blocks,bp_names=None):
+	"""
+	Builds traj_results.FrameResult of a frame from (columns,values) blocks of the stages,
+	side by side as pd.concat(axis=1) puts the data frames, shorter blocks are padded with NaN,
+	and BPnum 1..N is added as the last column.
+	BPname in the columns of a block stands for bp_names, its values have no column for it.
+	"""
+	n=max([len(v) for c,v in blocks]+[0])
+	columns=[c for cols,v in blocks for c in cols]+['BPnum']
+	values=np.full((n,len(columns)-('BPname' in columns)),np.nan,dtype=np.float32)
+	j=0
+	for cols,v in blocks:
+		k=len(cols)-('BPname' in cols)
+		values[:len(v),j:j+k]=v
+		j+=k
+	values[:,-1]=np.arange(1,n+1)
+	if bp_names is not None:
+		bp_names=list(bp_names)+['nan']*(n-len(bp_names))
+	return(FrameResult.from_arrays(columns,values,bp_names))
+
+#Contents of reference find_pair outputs read so far, ref_fp_id -> text
+_ref_templates={}
+
+@timed('write_reference')
+def _write_from_reference(ref_fp_id,cur_fp_id,workdir):
+	"""
+	Writes the reference find_pair output with ref_fp_id replaced by cur_fp_id
+	to cur_fp_id.fr in workdir, so that analyze uses the reference base pairs.
+	The reference is read only once per process.
+	"""
+	if ref_fp_id not in _ref_templates:
+		_ref_templates[ref_fp_id]=_read_text(os.path.join(TEMP,ref_fp_id))
+	with open(os.path.join(workdir,cur_fp_id+'.fr'),'w') as f: #fr - dreived from reference
+		f.write(_ref_templates[ref_fp_id].replace(ref_fp_id,cur_fp_id))
+
+
+@returns_records
+def X3DNA_analyze(DNA_atomsel,ref_fp_id,workdir=None,torsions='x3dna',stages='full',pairing='x3dna',records=False):
 	"""Performs the analysis using X3DNA
 
 	Parameters
@@ -94,6 +252,17 @@ def X3DNA_analyze(DNA_atomsel,ref_fp_id):
 	ref_fp_id - this is output id from X3DNA_find_pair function,
 	which was obtained for the structure that will be considered as a reference
 	to determine which bases are paired.
+	workdir - directory where X3DNA is run, by default a private scratch_dir()
+	is created and removed afterwards, so that several frames may be analyzed concurrently.
+	torsions - 'x3dna' gets sugar and backbone torsions from a second analyze -t call,
+	'native' computes them in process with dna_geometry.backbone_torsions.
+	stages - what to compute, either a profile name from PROFILES ('full','bp_step','geometry','torsions')
+	or a set of stages from STAGES: 'frames' (x,y,z), 'bp' (base-pair and step parameters),
+	'pairing', 'torsions'. External programs are run only for the requested stages.
+	pairing - 'x3dna' runs find_pair on the frame and compares with the reference,
+	'native' checks the reference pairs in process with dna_geometry.base_pairing.
+	records - return traj_results.FrameResult with the same columns, filled from the outputs as arrays
+	without building data frames (what trajectory workers use).
 
 	Return
 	--------
@@ -111,70 +280,102 @@ def X3DNA_analyze(DNA_atomsel,ref_fp_id):
 	Pairing - 1 if X3DNA sees a base pair there with respect to reference (even if if is non standart pairing), 0 if not.
 	x,y,z - the centers of reference frames of individual base pairs.
 	BPnum - numer of base pair from 1 to N
+	Only the columns of the requested stages are present.
 	"""
 
-	#Now we still run find_pairs on this frame to check if any base pairing was lost
-	#and simultaneously to output pdb
-	cur_fp_id=X3DNA_find_pair(DNA_atomsel)
-	pdb = cur_fp_id+'.pdb'
-	inp = cur_fp_id
-
-	#we have to do substitution in ref_fp_id file and copy it
-	#so it will process new file using original base pair information
-	#sed 's/pattern/replacement/g'
-
-	cmd='sed "s/'+ref_fp_id+'/'+cur_fp_id+'/g" '+ref_fp_id+'>'+cur_fp_id+'.fr' #fr - dreived from reference
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	out, err = p.communicate()
-	print('OUT:'+out+err)
-	
-	#Now we can run X3DNA_analyze
-	cmd=P_X3DNA_analyze+' '+cur_fp_id+'.fr'
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	out, err = p.communicate()
-	print('OUT:'+out+err)
+	stages=_analysis_stages(stages)
+	if torsions not in ('x3dna','native'):
+		raise ValueError("torsions should be 'x3dna' or 'native', not %r"%(torsions,))
+	if pairing not in ('x3dna','native'):
+		raise ValueError("pairing should be 'x3dna' or 'native', not %r"%(pairing,))
+
+	if workdir is None:
+		with scratch_dir() as wd:
+			return(X3DNA_analyze(DNA_atomsel,ref_fp_id,workdir=wd,torsions=torsions,stages=stages,pairing=pairing,records=records))
+
+	run_analyze=('frames' in stages) or ('bp' in stages)
+	run_find_pair=('pairing' in stages) and pairing=='x3dna'
+	run_tor=('torsions' in stages) and torsions=='x3dna'
+
+	if run_find_pair:
+		#Now we still run find_pairs on this frame to check if any base pairing was lost
+		#and simultaneously to output pdb
+		cur_fp_id=X3DNA_find_pair(DNA_atomsel,workdir=workdir)
+	elif run_analyze or run_tor:
+		cur_fp_id=_write_pdb(DNA_atomsel,workdir)
+	pdb = cur_fp_id+'.pdb' if (run_find_pair or run_analyze or run_tor) else None
+
+	#data frames of the stages, or (columns,values) blocks if records
+	dfs=[]
+	names=None
+	if run_analyze:
+		#we have to do substitution in ref_fp_id file and copy it
+		#so it will process new file using original base pair information
+		_write_from_reference(ref_fp_id,cur_fp_id,workdir)
+
+		#Now we can run X3DNA_analyze
+		cmd=P_X3DNA_analyze+' '+cur_fp_id+'.fr'
+		with TIMER.stage('analyze'):
+			p = subprocess.Popen(cmd,shell=True,cwd=workdir,stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+			out, err = p.communicate()
+		tool_output('analyze',out,err,p.returncode)
 
 ################################################
 #Extract base pairing, bp centers, bp params, bp step params
 ################################################
 
-	#####Base pairing (might be some got unpaired with respect to reference)
-	
 	#####Extract centers of base pairs from ref_frames.dat
-	df_rf=parse_ref_frames(TEMP+'/'+'ref_frames.dat')
-	# exit()
-	# print(df_rf)
+	if 'frames' in stages:
+		xyz=parse_ref_frames(os.path.join(workdir,'ref_frames.dat'),as_array=records)
+		dfs.append((['x','y','z'],xyz) if records else xyz)
 	###Extract base pair and base pair step parameters
-	df_bp=parse_bases_param(TEMP+'/'+'bp_step.par')
-	# print(df_bp)
+	if 'bp' in stages:
+		bp=parse_bases_param(os.path.join(workdir,'bp_step.par'),as_array=records)
+		if records:
+			names,bp=bp
+			bp=(['BPname']+BP_PARAMS+STEP_PARAMS,bp)
+		dfs.append(bp)
+	#####Base pairing (might be some got unpaired with respect to reference)
 	###Extract base pairing by comparing reference and current
-	df_pairing=check_pairing(TEMP+'/'+ref_fp_id,TEMP+'/'+cur_fp_id)
-	# print df_pairing
+	if 'pairing' in stages:
+		if pairing=='native':
+			paired=native_pairing(DNA_atomsel,ref_fp_id,as_array=records)
+		else:
+			paired=check_pairing(os.path.join(TEMP,ref_fp_id),os.path.join(workdir,cur_fp_id),as_array=records)
+		dfs.append((['Pairing'],paired[:,np.newaxis]) if records else paired)
 ################################################
-	#Special call to X3DNA_analyze that will get sugar and backbone params
-	#This call stangly deletes some files from previous call
-	#So we need to extract base-pair and ref frames info before
-	cmd=P_X3DNA_analyze+' -t=backbone.tor '+pdb
-	# print cmd
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	# wait for the process to terminate
-	out, err = p.communicate()
-	errcode = p.returncode
-	print('OUT:'+out+err)
+	if 'torsions' in stages:
+		if torsions=='native':
+			dfs.append(native_torsions(DNA_atomsel,ref_fp_id,as_array=records))
+		else:
+			#Special call to X3DNA_analyze that will get sugar and backbone params
+			#This call stangly deletes some files from previous call
+			#So we need to extract base-pair and ref frames info before
+			cmd=P_X3DNA_analyze+' -t=backbone.tor '+pdb
+			with TIMER.stage('analyze_torsions'):
+				p = subprocess.Popen(cmd,shell=True,cwd=workdir,stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+				# wait for the process to terminate
+				out, err = p.communicate()
+			errcode = p.returncode
+			tool_output('analyze_torsions',out,err,errcode)
 ####################################
 ##Now let's get torsion parameters
-	df_tor=parse_tor_param(TEMP+'/backbone.tor')
-	# print(df_tor)
+			dfs.append(parse_tor_param(os.path.join(workdir,'backbone.tor'),as_array=records))
+	if records:
+		return(_frame_record(dfs,names))
 	#Now we concatenate all the data frames
-	df_res=pd.concat([df_rf,df_bp,df_pairing,df_tor],axis=1)
+	df_res=pd.concat(dfs,axis=1) if dfs else pd.DataFrame()
 	df_res['BPnum']=range(1,len(df_res)+1)
 	df_res=df_res.reset_index(drop=True)
 	return(df_res)
 
 
-def X3DNA_analyze_bp_step(DNA_atomsel,ref_fp_id):
+@returns_records
+def X3DNA_analyze_bp_step(DNA_atomsel,ref_fp_id,workdir=None,backend='x3dna',records=False):
 	"""Performs the analysis using X3DNA and output only bp_step
 
+	The same as X3DNA_analyze with stages='bp_step'.
+
 	Parameters
 	----------
 	DNA_atomsel - DNA segments selected by atomsel command in VMD.
@@ -182,6 +383,12 @@ def X3DNA_analyze_bp_step(DNA_atomsel,ref_fp_id):
 	ref_fp_id - this is output id from X3DNA_find_pair function,
 	which was obtained for the structure that will be considered as a reference
 	to determine which bases are paired.
+	workdir - directory where X3DNA is run, by default a private scratch_dir()
+	is created and removed afterwards, so that several frames may be analyzed concurrently.
+	backend - 'x3dna' runs analyze,
+	'native' computes the same parameters in process with dna_geometry (no external calls),
+	only the pairs are taken from ref_fp_id.
+	records - return traj_results.FrameResult instead of a data frame, see X3DNA_analyze.
 
 	Return
 	--------
@@ -191,82 +398,608 @@ def X3DNA_analyze_bp_step(DNA_atomsel,ref_fp_id):
 	
 	All the names of the returned parameters correspond to their names in X3DNA.
 	Additional columns:
-	Pairing - 1 if X3DNA sees a base pair there with respect to reference (even if if is non standart pairing), 0 if not.
-	x,y,z - the centers of reference frames of individual base pairs.
+	BPname - name of base pair, like A-T.
 	BPnum - numer of base pair from 1 to N
 	"""
 
-	#Now we still run find_pairs on this frame to check if any base pairing was lost
-	#and simultaneously to output pdb
-	cur_fp_id=X3DNA_find_pair(DNA_atomsel)
-	pdb = cur_fp_id+'.pdb'
-	inp = cur_fp_id
+	if backend=='native':
+		return(native_analyze_bp_step(DNA_atomsel,ref_fp_id,records=records))
+	if backend!='x3dna':
+		raise ValueError("backend should be 'x3dna' or 'native', not %r"%(backend,))
+	return(X3DNA_analyze(DNA_atomsel,ref_fp_id,workdir=workdir,stages='bp_step',records=records))
 
-	#we have to do substitution in ref_fp_id file and copy it
-	#so it will process new file using original base pair information
-	#sed 's/pattern/replacement/g'
 
-	cmd='sed "s/'+ref_fp_id+'/'+cur_fp_id+'/g" '+ref_fp_id+'>'+cur_fp_id+'.fr' #fr - dreived from reference
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	out, err = p.communicate()
-	print('OUT:'+out+err)
-	
-	#Now we can run X3DNA_analyze
-	cmd=P_X3DNA_analyze+' '+cur_fp_id+'.fr'
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	out, err = p.communicate()
-	print('OUT:'+out+err)
+#Topologies and reference pairs of selections in this process, see _native_layout
+_native_layouts={}
 
-################################################
-#Extract base pairing, bp centers, bp params, bp step params
-################################################
+def _native_layout(DNA_atomsel,ref_fp_id):
+	"""
+	Returns (BaseTopology,pairs) for the selection and the reference find_pair output,
+	built on the first call only, so that index tables cached in the topology are reused between frames.
+	Changing atoms of the selection after that requires _native_layouts.clear().
+	"""
+	key=(id(DNA_atomsel),ref_fp_id)
+	if key not in _native_layouts:
+		_native_layouts[key]=(BaseTopology.from_atomsel(DNA_atomsel),parse_find_pair(os.path.join(TEMP,ref_fp_id)))
+	return(_native_layouts[key])
+
+@returns_records
+@timed('native_analyze_bp_step')
+def native_analyze_bp_step(DNA_atomsel,ref_fp_id,records=False):
+	"""Computes base-pair and step parameters in process, see dna_geometry.base_pair_step_params
+
+	Takes the same arguments and returns the same data frame as X3DNA_analyze_bp_step,
+	the pairs are read from the reference find_pair output.
+	records - return traj_results.FrameResult with the same columns instead of a data frame.
+	"""
+	top,pairs=_native_layout(DNA_atomsel,ref_fp_id)
+	names,values=base_pair_step_params(_coords(DNA_atomsel),top,pairs)
+	if records:
+		return(_frame_record([(['BPname']+BP_PARAMS+STEP_PARAMS,values)],names))
+	df_res=pd.DataFrame(values,columns=BP_PARAMS+STEP_PARAMS)
+	df_res.insert(0,'BPname',names)
+	df_res['BPnum']=range(1,len(df_res)+1)
+	return(df_res)
 
 
-	###Extract base pair and base pair step parameters
-	df_bp=parse_bases_param(TEMP+'/'+'bp_step.par')
-	# print(df_bp)
+@timed('native_torsions')
+def native_torsions(DNA_atomsel,ref_fp_id,as_array=False):
+	"""Computes sugar and backbone torsions in process, see dna_geometry.backbone_torsions
 
-################################################
+	Returns a data frame with the same layout as parse_tor_param:
+	_1 columns for the first strand, _2 for the complementary nucleotides of the second strand,
+	the pairs are read from the reference find_pair output.
+	as_array - if True returns a tuple (list of column names, (N,ncol) numpy array) as parse_tor_param.
+	"""
+	top,pairs=_native_layout(DNA_atomsel,ref_fp_id)
+	columns,values=backbone_torsions(_coords(DNA_atomsel),top,pairs)
+	if as_array:
+		return(columns,values)
+	return(pd.DataFrame(values,columns=columns))
 
-####################################
 
-	df_res=df_bp
-	df_res['BPnum']=range(1,len(df_res)+1)
-	df_res=df_res.reset_index(drop=True)
-	return(df_res)
+@timed('native_pairing')
+def native_pairing(DNA_atomsel,ref_fp_id,as_array=False,**criteria):
+	"""Checks base pairing in process, see dna_geometry.base_pairing
 
+	Returns a data frame with Pairing column like check_pairing:
+	1 if the reference pair still satisfies find_pair criteria, 0 if not.
+	as_array - if True returns the (N,) int array of the Pairing column.
+	criteria - to override dna_geometry.PAIRING_CRITERIA.
+	"""
+	top,pairs=_native_layout(DNA_atomsel,ref_fp_id)
+	paired=base_pairing(_coords(DNA_atomsel),top,pairs,**criteria)
+	if as_array:
+		return(paired.astype(int))
+	return(pd.DataFrame({'Pairing':paired.astype(int)},columns=['Pairing']))
+
+def native_pairing_block(coords,DNA_atomsel,ref_fp_id,**criteria):
+	"""Checks base pairing for a block of frames at once, see dna_geometry.base_pairing
 
+	coords - (frames,atoms,3) coordinates of the atoms of DNA_atomsel.
+	Returns (frames,n_pairs) int array, 1 where the reference pair is still paired.
+	"""
+	top,pairs=_native_layout(DNA_atomsel,ref_fp_id)
+	return(base_pairing(np.asarray(coords),top,pairs,**criteria).astype(int))
 
+def native_pairing_frames(frames,DNA_atomsel,ref_fp_id,block=100,set_frame=None,**criteria):
+	"""Base pairing over many frames, computed in blocks of frames
 
-def parse_ref_frames(file):
+	Parameters
+	----------
+	frames - frame numbers.
+	DNA_atomsel - DNA segments selected by atomsel command in VMD or a backends.Structure.
+	ref_fp_id - output id of X3DNA_find_pair for the reference structure.
+	block - number of frames whose coordinates are kept in memory and processed at once.
+	set_frame - function that moves the selection to a frame, as in iter_analyze.
+	criteria - to override dna_geometry.PAIRING_CRITERIA.
+
+	Return
+	--------
+	(n_frames,n_pairs) int array, 1 where the reference pair satisfies find_pair criteria in the frame.
+	"""
+	if set_frame is None:
+		set_frame=getattr(DNA_atomsel,'set_frame',vmd_goto)
+	frames=list(frames)
+	res=[]
+	for start in range(0,len(frames),block):
+		coords=[]
+		for frame in frames[start:start+block]:
+			set_frame(frame)
+			coords.append(_coords(DNA_atomsel))
+		res.append(native_pairing_block(np.array(coords),DNA_atomsel,ref_fp_id,**criteria))
+	if not res:
+		return(np.zeros((0,len(_native_layout(DNA_atomsel,ref_fp_id)[1])),dtype=int))
+	return(np.concatenate(res))
+
+
+###Here goes the trajectory driver.
+#A fixed pool of worker processes is forked from the running process (VMD or plain Python),
+#every worker moves the selection to a frame and runs the analysis on it.
+#With a ResultCache frames that were already analyzed with the same settings
+#are taken from disk, with a checkpoint file a killed run can be restarted.
+
+#State of a worker process, filled by _init_trajectory_worker
+_worker_state={}
+
+def _init_trajectory_worker(DNA_atomsel,ref_fp_id,analyze,set_frame,cache=None,log_level=None,records=False):
+	"""
+	Pool initializer, keeps the selection and settings in the worker process
+	so that only frame numbers have to be sent to it.
+	"""
+	if log_level is not None:
+		set_log_level(log_level)
+	_worker_state['DNA_atomsel']=DNA_atomsel
+	_worker_state['ref_fp_id']=ref_fp_id
+	_worker_state['analyze']=analyze
+	_worker_state['set_frame']=set_frame
+	_worker_state['cache']=cache
+	_worker_state['records']=records
+	#analyze fills FrameResult itself, otherwise its data frame is converted
+	_worker_state['fills_records']=records and _returns_records(analyze)
+
+def _as_result(res,records):
+	"""
+	Converts a result of analyze (or of the cache) to FrameResult if records, back to a data frame if not
+	"""
+	if records and isinstance(res,pd.DataFrame):
+		return(FrameResult.from_dataframe(res))
+	if not records and isinstance(res,FrameResult):
+		return(res.to_dataframe())
+	return(res)
+
+def _analyze_frame_batch(frames,shared_frames=None):
+	"""
+	Analyzes a batch of frames in a worker, returns a list of (frame,result) tuples
+	and the timing records of the batch.
+	shared_frames - backends.SharedFrames with the frames of the batch, loaded into the worker's Structure.
+	"""
+	if shared_frames is not None:
+		_worker_state['DNA_atomsel'].load_trajectory(shared_frames)
+	DNA_atomsel=_worker_state['DNA_atomsel']
+	ref_fp_id=_worker_state['ref_fp_id']
+	analyze=_worker_state['analyze']
+	set_frame=_worker_state['set_frame']
+	cache=_worker_state.get('cache')
+	records=_worker_state.get('records',False)
+	fills_records=_worker_state.get('fills_records',False)
+	res=[]
+	for frame in frames:
+		with TIMER.frame(frame):
+			with TIMER.stage('set_frame'):
+				set_frame(frame)
+			if cache is not None:
+				with TIMER.stage('cache'):
+					key=cache.key(_coords(DNA_atomsel))
+					r=cache.get(key)
+				if r is not None:
+					log("Frame %d from cache"%frame)
+					res.append((frame,_as_result(r,records)))
+					continue
+			log("Starting frame %d"%frame)
+			if fills_records:
+				r=analyze(DNA_atomsel,ref_fp_id,records=True)
+			else:
+				r=analyze(DNA_atomsel,ref_fp_id)
+			if records and not fills_records:
+				with TIMER.stage('record'):
+					r=_as_result(r,records)
+			if cache is not None:
+				with TIMER.stage('cache'):
+					cache.put(key,r)
+			res.append((frame,r))
+	#timing records go back to the driver with the results
+	return(res,TIMER.pop())
+
+def analysis_settings(ref_fp_id,analyze=X3DNA_analyze):
+	"""
+	Returns settings that define the result of analyze for given coordinates,
+	to be used as ResultCache settings: the contents of the reference find_pair output,
+	the analysis function with its bound arguments (functools.partial)
+	and signatures (path, size, mtime) of the external programs.
+	"""
+	func=analyze
+	args=()
+	keywords={}
+	while hasattr(func,'func'):
+		args=tuple(func.args or ())+args
+		keywords=dict(func.keywords or {},**keywords)
+		func=func.func
+	name=getattr(func,'__module__','')+'.'+getattr(func,'__name__',repr(func))
+	programs=[P_X3DNA_analyze,P_X3DNA_find_pair]
+	programs=[_which(p) for p in programs]
+	#the reference mentions its own unique name, which is different in every run
+	reference=_read_text(os.path.join(TEMP,ref_fp_id)).replace(ref_fp_id,'REFERENCE')
+	return({'reference':reference,
+		'analyze':name,'args':repr(canonical(args)),'keywords':repr(canonical(keywords)),
+		'programs':[file_signature(p) for p in programs]})
+
+def _which(program):
+	"""
+	Returns full path of a program found in PATH, or program itself
+	"""
+	if os.path.dirname(program):
+		return(program)
+	for d in os.environ.get('PATH','').split(os.pathsep):
+		path=os.path.join(d,program)
+		if os.path.isfile(path):
+			return(path)
+	return(program)
+
+def _is_done(results,frame):
+	"""
+	Whether results already have frame, sinks that only write to disk never have it
+	"""
+	if isinstance(results,TrajectoryResults):
+		try:
+			return(bool(results.filled[results.row(frame)]))
+		except KeyError:
+			return(False)
+	if hasattr(results,'__contains__'):
+		return(frame in results)
+	return(False)
+
+def iter_analyze(frames,DNA_atomsel,ref_fp_id,workers=None,chunksize=1,analyze=X3DNA_analyze,set_frame=None,cache=None,
+	shared=False,start_method=None,records=False):
+	"""Generator that analyzes frames of a trajectory and yields results as soon as they are ready
+
+	Takes the same arguments as analyze_trajectory.
+	records - if True workers return traj_results.FrameResult (float32 values,
+	base-pair names as codes, one shared column schema), which are much cheaper to send between processes
+	and to keep than data frames, TrajectoryResults, the sinks and BPStats take them as they are,
+	FrameResult.to_dataframe gives the data frame back.
+	Analysis functions marked with returns_records (X3DNA_analyze, native_analyze_bp_step ...) are called
+	with records=True and fill FrameResult from their outputs directly, without a data frame per frame,
+	data frames of other functions are converted.
+	Results are yielded in the order of frames, a worker pool is used if workers!=1.
+	At most workers*BATCHES_PER_WORKER batches of chunksize frames are in flight and nothing is kept
+	after it was yielded, so memory does not depend on the number of frames
+	if the consumer writes the results out, e.g. to traj_results.CSVSink or NPZChunkSink.
+
+	Usage:
+	with CSVSink('MD_DNAparam_1kx5.csv',bp=range(-73,74)) as sink:
+		for frame,df in iter_analyze(range(1,nf),DNA,reff):
+			sink[frame]=df
+
+	Yields
+	--------
+	(frame,result of analyze) tuples
+	"""
+	frames=list(frames)
+	if set_frame is None:
+		set_frame=getattr(DNA_atomsel,'set_frame',vmd_goto)
+	if cache is not None and not isinstance(cache,ResultCache):
+		cache=ResultCache(cache,settings=analysis_settings(ref_fp_id,analyze))
+	share=None
+	if shared and workers!=1 and not maps_frames(DNA_atomsel):
+		#workers read frames from shared copies of blocks of frames instead of the VMD molecule,
+		#a Structure on a DCD file is sent as it is, workers map the file themselves
+		source,source_set_frame=DNA_atomsel,set_frame
+		DNA_atomsel=Structure.from_selection(source)
+		set_frame=DNA_atomsel.set_frame
+		share=functools.partial(copy_frames,source,set_frame=source_set_frame)
+	for item in _iter_batches(frames,DNA_atomsel,ref_fp_id,workers,chunksize,analyze,set_frame,cache,start_method,records,share):
+		yield item
+	if cache is not None:
+		cache.evict()
+
+#Batches per worker that the driver lets be in flight, see _iter_batches
+BATCHES_PER_WORKER=4
+
+def _iter_batches(frames,DNA_atomsel,ref_fp_id,workers,chunksize,analyze,set_frame,cache,start_method,records=False,share=None):
+	"""
+	Runs batches of frames in the current process or in a pool, yields (frame,result) in order.
+	share - function frames -> backends.SharedFrames, if given the frames of every block of
+	workers*BATCHES_PER_WORKER batches are copied with it just before the block is submitted
+	and removed when its last result was yielded, so at most two blocks are in shared memory.
+	"""
+	chunksize=max(1,int(chunksize))
+	batches=[frames[i:i+chunksize] for i in range(0,len(frames),chunksize)]
+	if workers is None:
+		workers=cpu_count()
+	workers=max(1,min(workers,len(batches)))
+
+	if workers==1:
+		_init_trajectory_worker(DNA_atomsel,ref_fp_id,analyze,set_frame,cache,records=records)
+		for batch in batches:
+			items,timing=_analyze_frame_batch(batch)
+			TIMER.extend(timing)
+			for item in items:
+				yield item
+	else:
+		context=multiprocessing.get_context(start_method) if start_method else multiprocessing
+		pool=context.Pool(workers,initializer=_init_trajectory_worker,initargs=(DNA_atomsel,ref_fp_id,analyze,set_frame,cache,get_log_level(),records))
+		window=workers*BATCHES_PER_WORKER
+		live=[]
+		def tasks():
+			#(batch,shared frames of its block,whether it is the last batch of the block)
+			for start in range(0,len(batches),window):
+				block=batches[start:start+window]
+				buf=None
+				if share is not None:
+					buf=share([f for batch in block for f in batch])
+					live.append(buf)
+				for k,batch in enumerate(block):
+					yield batch,buf,k==len(block)-1
+		try:
+			#at most BATCHES_PER_WORKER batches per worker are queued, running or done and not yet yielded,
+			#so finished results do not pile up in memory if the consumer is slower than the workers;
+			#they are yielded in the order of batches while the pool keeps all workers busy
+			pending=deque()
+			queue=tasks()
+			for batch,buf,last in queue:
+				pending.append((pool.apply_async(_analyze_frame_batch,(batch,buf)),buf,last))
+				if len(pending)>=window:
+					break
+			while pending:
+				result,buf,last=pending.popleft()
+				items,timing=result.get()
+				for batch,next_buf,next_last in queue:
+					pending.append((pool.apply_async(_analyze_frame_batch,(batch,next_buf)),next_buf,next_last))
+					break
+				TIMER.extend(timing)
+				for item in items:
+					yield item
+				if last and buf is not None:
+					buf.unlink()
+					live.remove(buf)
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+			for buf in live:
+				buf.unlink()
+
+def analyze_trajectory(frames,DNA_atomsel,ref_fp_id,workers=None,chunksize=1,analyze=X3DNA_analyze,set_frame=None,out=None,
+	cache=None,checkpoint=None,checkpoint_every=100,shared=False,start_method=None,log_level=None,timing_log=None):
+	"""Runs analysis over the frames of a trajectory using a fixed pool of workers
+
+	Parameters
+	----------
+	frames - iterable of frame numbers to analyze.
+	DNA_atomsel - DNA segments selected by atomsel command in VMD.
+	(NOT AtomSel!)
+	ref_fp_id - this is output id from X3DNA_find_pair function for the reference structure.
+	workers - number of worker processes, None - one per core (multiprocessing.cpu_count()),
+	1 - everything is done in the current process without forking.
+	chunksize - number of frames sent to a worker at once.
+	analyze - analysis function called as analyze(DNA_atomsel,ref_fp_id),
+	X3DNA_analyze by default, X3DNA_analyze_bp_step is also suitable,
+	use functools.partial to pass stages and other options.
+	set_frame - function that makes frame current for DNA_atomsel, by default DNA_atomsel.set_frame
+	for backends (see backends.py) and VMD goto for a plain atomsel.
+	out - optional TrajectoryResults (see traj_results.py), if given results are stored there
+	in place as they arrive instead of being kept as data frames,
+	workers then send compact traj_results.FrameResult records instead of data frames (see iter_analyze).
+	A CSVSink or NPZChunkSink may also be given to write results to disk as they arrive,
+	closing it is left to the caller.
+	Frames that are already in out are skipped.
+	cache - ResultCache or a directory name, results are looked up there by the hash of coordinates
+	and analysis_settings(ref_fp_id,analyze), new results are added to it.
+	shared - if True workers read coordinates from shared memory-mapped files instead of moving the VMD molecule,
+	so every worker needs only the selection, not a copy of the whole loaded trajectory.
+	Frames are copied to /dev/shm (backends.SharedFrames) one block of workers*BATCHES_PER_WORKER batches
+	at a time, while the previous block is analyzed. A backends.Structure reading a DCD file is not copied,
+	workers map the file themselves.
+	start_method - multiprocessing start method, e.g. 'spawn' or 'forkserver' to start workers
+	as fresh Python processes instead of forks of the current one (Python 3 only),
+	best combined with shared=True or a Structure backend.
+	checkpoint - .npz file name, results are saved there every checkpoint_every frames and at the end,
+	together with checkpoint_settings(ref_fp_id,analyze). If the file exists the run continues from it
+	and only the missing frames are analyzed, ValueError is raised if it was made with another
+	reference, analysis function or options, or has other parameters or base pairs than out.
+	A TrajectoryResults store is created for it if out is not given.
+	log_level - 'quiet', 'normal' or 'verbose' for this run (see stage_timer.set_log_level),
+	with 'quiet' output of X3DNA and other programs is printed only if they fail.
+	timing_log - file name, timing records of every stage of every frame (stage_timer.TIMER)
+	are appended to it as JSON lines, and the per stage summary is printed (see stage_timer.summary).
+
+	Return
+	--------
+	OrderedDict frame -> result of analyze, in the order of frames,
+	or out if it was given (TrajectoryResults if checkpoint was given).
+	"""
+	frames=list(frames)
+	previous_level=get_log_level()
+	if log_level is not None:
+		set_log_level(log_level)
+	mark=TIMER.mark()
+	try:
+		results=_analyze_trajectory(frames,DNA_atomsel,ref_fp_id,workers,chunksize,analyze,set_frame,out,
+			cache,checkpoint,checkpoint_every,shared,start_method)
+	finally:
+		records=TIMER.since(mark)
+		if timing_log is not None:
+			TIMER.write_log(timing_log,records)
+			log('Time per stage, s:\n%s'%summary(records).to_string())
+		set_log_level(previous_level)
+	return(results)
+
+def checkpoint_settings(ref_fp_id,analyze=X3DNA_analyze):
+	"""
+	analysis_settings without the program signatures, saved with a checkpoint
+	and compared when a run continues from it
+	"""
+	settings=analysis_settings(ref_fp_id,analyze)
+	settings.pop('programs',None)
+	return(settings)
+
+def _resume_checkpoint(checkpoint,out,settings,frames):
+	"""
+	Loads the checkpoint into out (a TrajectoryResults of frames if out is None).
+	Raises ValueError if it was made with other analysis settings, parameters or base pairs,
+	values are copied by parameter name.
+	"""
+	saved=TrajectoryResults.load(checkpoint)
+	if saved.attrs.get('checkpoint_settings')!=settings:
+		raise ValueError('Checkpoint %s was made with another reference or analysis (or its settings are unknown), '
+			'remove it or give another checkpoint file'%checkpoint)
+	if out is None:
+		out=TrajectoryResults(frames)
+	if saved.data is None:
+		return(out)
+	if out.bp is not None and not np.array_equal(out.bp,saved.bp):
+		raise ValueError('Checkpoint %s has other base pairs than the output store'%checkpoint)
+	if out.data is None:
+		if out.params is not None and sorted(out.params)!=sorted(saved.params):
+			raise ValueError('Checkpoint %s has other parameters than the output store'%checkpoint)
+		out.bp=saved.bp
+		if out.params is None:
+			out.params,out.columns=saved.params,saved.columns
+		out._allocate()
+	elif sorted(out.params)!=sorted(saved.params):
+		raise ValueError('Checkpoint %s has other parameters than the output store'%checkpoint)
+	if out.bp_names is None:
+		out.bp_names=saved.bp_names
+	order=[saved.params.index(p) for p in out.params]
+	for frame in saved.frames[saved.filled].tolist():
+		try:
+			i=out.row(frame)
+		except KeyError:
+			continue
+		out.data[i]=saved[frame][:,order]
+		out.filled[i]=True
+	return(out)
+
+def _analyze_trajectory(frames,DNA_atomsel,ref_fp_id,workers,chunksize,analyze,set_frame,out,
+	cache,checkpoint,checkpoint_every,shared,start_method):
+	"""
+	analyze_trajectory without the log level and timing log handling
+	"""
+	if checkpoint is not None:
+		settings=checkpoint_settings(ref_fp_id,analyze)
+		if os.path.exists(checkpoint):
+			out=_resume_checkpoint(checkpoint,out,settings,frames)
+		elif out is None:
+			out=TrajectoryResults(frames)
+		out.attrs['checkpoint_settings']=settings
+	results=OrderedDict() if out is None else out
+	frames=[f for f in frames if not _is_done(results,f)]
+
+	since_save=0
+	#data frames are built only if they are what the caller gets back
+	records=isinstance(out,(TrajectoryResults,CSVSink,NPZChunkSink,BPStats))
+	for frame,res in iter_analyze(frames,DNA_atomsel,ref_fp_id,workers=workers,chunksize=chunksize,
+		analyze=analyze,set_frame=set_frame,cache=cache,shared=shared,start_method=start_method,records=records):
+		results[frame]=res
+		since_save+=1
+		if checkpoint is not None and since_save>=checkpoint_every:
+			results.save(checkpoint)
+			since_save=0
+	if checkpoint is not None:
+		results.save(checkpoint)
+	return(results)
+
+
+###Parsers of X3DNA and Curves+ output.
+#Each parse_* function takes a file name, while parse_*_text works
+#on the text itself (str, bytes or a buffer), so nothing is written back to disk.
+#With as_array=True the pandas construction is skipped altogether.
+
+#Names of base-pair and base-pair step parameters as in bp_step.par
+BP_PARAMS=['Shear','Stretch','Stagger','Buckle','Prop-Tw','Opening']
+STEP_PARAMS=['Shift','Slide','Rise','Tilt','Roll','Twist']
+
+#Tokens that are read as NaN, like pandas.read_csv does
+_NA_TOKENS=set(['','NA','N/A','NaN','nan','-nan','null','NULL'])
+
+def _read_text(file):
+	with open(file,'r') as f:
+		return(f.read())
+
+def _to_text(buf):
+	"""
+	Accepts str, bytes, bytearray or memoryview and returns str
+	"""
+	if isinstance(buf,(bytearray,memoryview)):
+		buf=bytes(buf)
+	if isinstance(buf,bytes) and not isinstance(buf,str):
+		buf=buf.decode('ascii','replace')
+	return(buf)
+
+def _table_rows(rows):
+	"""
+	Takes lists of tokens as they would be in a tab separated file
+	and splits them into header and data rows the way pandas.read_csv does:
+	blank rows are dropped, if data rows are longer than the header
+	the leading extra fields go to the index and are dropped here,
+	short rows are padded with empty fields.
+	"""
+	rows=[r for r in rows if r]
+	if not rows:
+		return([],[])
+	header=rows[0]
+	data=rows[1:]
+	nidx=max(0,len(data[0])-len(header)) if data else 0
+	n=len(header)
+	data=[(r[nidx:]+['']*n)[:n] for r in data]
+	return(header,data)
+
+def _column_values(tokens):
+	"""
+	Converts a column of string tokens to int or float array if possible,
+	otherwise keeps strings (object array), similar to pandas type inference.
+	"""
+	try:
+		return(np.array([int(t) for t in tokens],dtype=np.int64))
+	except ValueError:
+		pass
+	try:
+		return(np.array([np.nan if t in _NA_TOKENS else float(t) for t in tokens],dtype=float))
+	except ValueError:
+		return(np.array([np.nan if t in _NA_TOKENS else t for t in tokens],dtype=object))
+
+def _float_values(data):
+	"""
+	Converts data rows to a float array, anything non numeric becomes NaN
+	"""
+	res=np.empty((len(data),len(data[0]) if data else 0))
+	for i,row in enumerate(data):
+		for j,t in enumerate(row):
+			try:
+				res[i,j]=float(t)
+			except ValueError:
+				res[i,j]=np.nan
+	return(res)
+
+def _frame_from_rows(columns,data):
+	"""
+	Builds a data frame column by column from rows of string tokens
+	"""
+	cols=list(zip(*data)) if data else [()]*len(columns)
+	return(pd.DataFrame(OrderedDict((c,_column_values(v)) for c,v in zip(columns,cols)),columns=columns))
+
+@timed('parse_ref_frames')
+def parse_ref_frames(file,as_array=False):
 	"""
 	Parses ref_frames.dat file from X3DNA output
 	and returns a PANDAS data frame
 
+	as_array - see parse_ref_frames_text.
 	"""
-	print "Processing ", file
-	#let's get the data from file
-	# let's strip white spaces at first and replace with tabs
-	tmpfile=file.replace('.dat','.tmp')
-	with open(file,'r') as f:
-		with open(tmpfile,'w') as tf:
-			f.next()
-			f.next()
-			for line in f:
-				tf.write('\t'.join(line.partition('#')[0].split())+'\n')
-				next(f,'')
-				next(f,'')
-				next(f,'')
-				next(f,'')
-
-		#now we will read data frames, 
-		df=pd.read_csv(tmpfile, sep=u'\t',skiprows=0,header=None)
-		df.columns=['x','y','z']
-
-	# bdf.to_csv('../analysis_data/dna_bl_big_df.csv')
-	return(df)
+	log("Processing "+file,'verbose')
+	return(parse_ref_frames_text(_read_text(file),as_array=as_array))
 
-def parse_bases_param(file):
+def parse_ref_frames_text(text,as_array=False):
+	"""
+	Same as parse_ref_frames, but takes the contents of ref_frames.dat
+
+	as_array - if True returns (N,3) numpy array of base-pair centers
+	instead of a data frame with x,y,z columns.
+	"""
+	lines=_to_text(text).splitlines()
+	#two header lines, then blocks of 5 lines per base pair:
+	#origin, x, y, z axes and the title of the next pair
+	xyz=[l.partition('#')[0].split() for l in lines[2::5]]
+	xyz=np.array([r for r in xyz if r],dtype=float).reshape(-1,3)
+	if as_array:
+		return(xyz)
+	return(pd.DataFrame(xyz,columns=['x','y','z']))
+
+@timed('parse_bases_param')
+def parse_bases_param(file,as_array=False):
 	"""
 	Parse bp_step.par file as output by X3DNA
 	Get a data frame with base and base-pair step
@@ -277,138 +1010,166 @@ def parse_bases_param(file):
 	I.e. in the first line no base pair step parameters are specified!
 
 	offest - offset for DNA numbering.
+	as_array - see parse_bases_param_text.
 	"""
-	print "Processing ", file
-	#let's get the data from file
-	# let's strip white spaces at first and replace with tabs
-	tmpfile=file+'tmp'
-	with open(file,'r') as f:
-		with open(tmpfile,'w') as tf:
-			for line in f:
-				tf.write('\t'.join(line.split())+'\n')
-
-
-
-	df=pd.read_csv(tmpfile, sep=u'\t',skiprows=2)
-	#The first column is of the type A-T or A+T, the latter indicating something ...
-	# df=df.rename(columns={'#':'BP'})
-#Paired or unpaired
-	# for i in range(len(df)):
-	# 	if(i in bp_list):
-	# 		df.iloc[i,0]=1
-	# 	else:
-	# 		df.iloc[i,0]=0
-	# print df.head()
-	df.iloc[0,7:]=np.nan # since base bair step params are not defined in first row
-	
-	#This is changed to add base pair names 29 June 2015 - hope this would not break the VMD nucleosome analysis scripts.
-	# df=df.drop(df.columns[0], axis=1)
-	new_columns = df.columns.values
-	new_columns[0]='BPname'
-	df.columns=new_columns
+	log("Processing "+file,'verbose')
+	return(parse_bases_param_text(_read_text(file),as_array=as_array))
+
+def parse_bases_param_text(text,as_array=False):
+	"""
+	Same as parse_bases_param, but takes the contents of bp_step.par
+
+	as_array - if True returns a tuple (list of BPnames, (N,12) numpy array)
+	with the columns in the order of BP_PARAMS+STEP_PARAMS.
+	"""
+	lines=_to_text(text).splitlines()
+	#skip number of base-pairs and the comment, the next line is the header
+	header,data=_table_rows([l.split() for l in lines[2:]])
+	names=[r[0] for r in data]
+	values=_float_values([r[1:] for r in data])
+	if len(values):
+		values[0,6:]=np.nan # since base bair step params are not defined in first row
+	if as_array:
+		return(names,values)
 
+	#This is changed to add base pair names 29 June 2015 - hope this would not break the VMD nucleosome analysis scripts.
+	columns=['BPname']+header[1:]
+	df=pd.DataFrame(values,columns=columns[1:])
+	df.insert(0,'BPname',names)
 	return(df)
 
 
 
-def check_pairing(ref,cur):
+def parse_find_pair(file):
+	"""
+	Parses the .inp file output by X3DNA find_pair
+	and returns (N,2) array of paired residues in the order of base pairs.
+	Residues are numbered from 0 in the order they appear in the pdb.
+	"""
+	return(parse_find_pair_text(_read_text(file)))
+
+def parse_find_pair_text(text):
+	"""
+	Same as parse_find_pair, but takes the contents of the .inp file
+	"""
+	#    1   294   0 #    1 | ....>I:.-73_:[ADE]A-----T[THY]:..73_:J<....
+	pairs=[(int(m.group(1))-1,int(m.group(2))-1) for m in re.finditer('(?m)^\s*(\d+)\s+(\d+)\s+-?\d+\s+#\s*\d+\s*\|',_to_text(text))]
+	return(np.array(pairs,dtype=np.int64).reshape(-1,2))
+
+@timed('check_pairing')
+def check_pairing(ref,cur,as_array=False):
 	"""
 	Functions compairs two files output by 3DNA find_pair
 	for same structures in different conformations
 	and looks what base pairs are present/lost
 	in cur with respect to reference
 
+	as_array - if True returns the (N,) int array of the Pairing column.
+
 	This function is not well tested!!!
 	"""
-	bp_list_ref=list()
-
-	with open(ref,'r') as inf:
-		for line in inf:
-			if(re.search('\.\.\.\.>\S:\.*(-?\d+)_:',line)):
-				bp_list_ref.append(int(re.search('\.\.\.\.>\S:\.*(-?\d+)_:',line).group(1)))
-	print "Reference BP list"
-	print bp_list_ref
-
-	bp_list_cur=list()
+	bp_list_ref=_find_pair_bp_list(_read_text(ref))
+	log("Reference BP list\n%s"%(bp_list_ref,),'verbose')
 
-	with open(cur,'r') as inf:
-		for line in inf:
-			if(re.search('\.\.\.\.>\S:\.*(-?\d+)_:',line)):
-				bp_list_cur.append(int(re.search('\.\.\.\.>\S:\.*(-?\d+)_:',line).group(1)))
-	print "Current BP list"
-	print bp_list_cur
+	bp_list_cur=_find_pair_bp_list(_read_text(cur))
+	log("Current BP list\n%s"%(bp_list_cur,),'verbose')
 #Let's construct data frame by comparing
-	df_pairing = pd.DataFrame(columns=['Pairing'])
-	for i in range(len(bp_list_ref)):
-		if(bp_list_ref[i] in bp_list_cur):
-			df_pairing=df_pairing.append({'Pairing':1}, ignore_index=True)
-		else:
-			df_pairing=df_pairing.append({'Pairing':0}, ignore_index=True)
+	cur_set=set(bp_list_cur)
+	paired=np.array([1 if bp in cur_set else 0 for bp in bp_list_ref],dtype=int)
+	if as_array:
+		return(paired)
+	df_pairing=pd.DataFrame({'Pairing':paired},columns=['Pairing'])
 	return(df_pairing)
 
-def parse_tor_param(file):
+def _find_pair_bp_list(text):
+	"""
+	Residue numbers of the first strand of every base pair in find_pair output
+	"""
+	return([int(m) for m in re.findall('\.\.\.\.>\S:\.*(-?\d+)_:',text)])
+
+@timed('parse_tor_param')
+def parse_tor_param(file,as_array=False):
 	"""
 	Parse torsion parameters as returned by X3DNA (-t option) (tor-file)
 
+	as_array - see parse_tor_param_text.
 	"""
+	return(parse_tor_param_text(_read_text(file),as_array=as_array))
 
-	torfile=file
-	angfile=file+'.bba'
-	puckfile=file+'.pck'
-	with open(torfile,'r') as f:
-		f.readline()
-		with open(angfile,'w') as tf:
-			for line in f:
-				if('****' not in line):
-						plist=line.split()
-						if(len(plist)>5):
-							if((len(plist)!=12) and (plist[0]!='base')):
-								plist.insert(3,'no')
-						tf.write('\t'.join(plist)+'\n')
-				else:
-					break
-		for line in f:
-			if('*****' in line): break
-		with open(puckfile,'w') as tf:
-			for line in f:
-				tf.write('\t'.join(line.split())+'\n')
-
-	dfa=pd.read_csv(angfile, sep=u'\t',skiprows=19)
-	dfp=pd.read_csv(puckfile, sep=u'\t',skiprows=18)
-	#Now the idea is to slice this data frames into strands
-	dfa1=dfa.iloc[0:len(dfa)/2,1:]
-	dfa2=dfa.iloc[len(dfa)/2:,1:]
-	n=dfa1.columns
-	n1=[]
-	n2=[]
-	for i in n:
-		n1.append(i+'_1')
-		n2.append(i+'_2')
-	dfa1.columns=n1
-	dfa2.columns=n2
-	dfa1.index=range(len(dfa1))
-	dfa2.index=range(len(dfa2)-1,-1,-1)
-	dfa_new=pd.concat([dfa1,dfa2],axis=1)
-
-	dfp1=dfp.iloc[0:len(dfp)/2,1:]
-	dfp2=dfp.iloc[len(dfp)/2:,1:]
-	n=dfp1.columns
-	n1=[]
-	n2=[]
-	for i in n:
-		n1.append(i+'_1')
-		n2.append(i+'_2')
-	dfp1.columns=n1
-	dfp2.columns=n2
-	dfp1.index=range(len(dfp1))
-	dfp2.index=range(len(dfp2)-1,-1,-1)
-	dfp_new=pd.concat([dfp1,dfp2],axis=1)
-
-	df_new=pd.concat([dfa_new,dfp_new],axis=1)
-
-	return(df_new)
-
-def CURVES_analyze(DNA_atomsel,length):
+def _split_tor_text(text):
+	"""
+	Splits the tor-file into token rows of the torsion angle table
+	and the sugar pucker table
+	"""
+	lines=_to_text(text).splitlines()[1:]
+	ang=[]
+	puck=[]
+	i=0
+	for i,line in enumerate(lines):
+		if('****' in line): break
+		plist=line.split()
+		if(len(plist)>5):
+			if((len(plist)!=12) and (plist[0]!='base')):
+				plist.insert(3,'no')
+		ang.append(plist)
+	else:
+		i=len(lines)
+	for j in range(i+1,len(lines)):
+		if('*****' in lines[j]):
+			puck=[l.split() for l in lines[j+1:]]
+			break
+	#header lines before the tables, as in the X3DNA output
+	return(_table_rows(ang[19:]),_table_rows(puck[18:]))
+
+def _strand_columns(columns):
+	return([c+'_1' for c in columns]+[c+'_2' for c in columns])
+
+def _split_strands(data):
+	"""
+	Both strands are output 5'-3' one after another,
+	here they are put side by side with the second strand reversed
+	"""
+	n=len(data)//2
+	first=data[0:n]
+	second=data[n:][::-1]
+	res=[]
+	for i in range(max(len(first),len(second))):
+		a=first[i] if i<len(first) else None
+		b=second[i] if i<len(second) else None
+		res.append((a,b))
+	return(res)
+
+def parse_tor_param_text(text,as_array=False):
+	"""
+	Same as parse_tor_param, but takes the contents of the tor-file
+
+	Columns of the first strand get suffix _1, of the second strand - _2,
+	the second strand is renumbered in 3'-5' direction.
+
+	as_array - if True returns a tuple (list of column names, (N,ncol) numpy array),
+	anything non numeric (like ---) becomes NaN.
+	"""
+	(ha,da),(hp,dp)=_split_tor_text(text)
+	columns=[]
+	rows=None
+	for header,data in ((ha,da),(hp,dp)):
+		header=header[1:]
+		pairs=_split_strands([r[1:] for r in data])
+		empty=['']*len(header)
+		block=[(a if a is not None else empty)+(b if b is not None else empty) for a,b in pairs]
+		columns+=_strand_columns(header)
+		if rows is None:
+			rows=block
+		else:
+			#the two tables are aligned by row number
+			n=max(len(rows),len(block))
+			wa=len(rows[0]) if rows else 0
+			rows=[(rows[i] if i<len(rows) else ['']*wa)+(block[i] if i<len(block) else ['']*len(header)*2) for i in range(n)]
+	if as_array:
+		return(columns,_float_values(rows))
+	return(_frame_from_rows(columns,rows))
+
+def CURVES_analyze(DNA_atomsel,length,workdir=None,backend='curves'):
 	"""Performs the analysis using Curves+
 
 	Parameters
@@ -416,85 +1177,174 @@ def CURVES_analyze(DNA_atomsel,length):
 	DNA_atomsel - DNA segments selected by atomsel command in VMD.
 	(NOT AtomSel!)
 	length - length of one DNA strand.
+	workdir - directory where Curves+ is run, by default a private scratch_dir().
+	backend - 'curves' runs Curves+, 'native' computes groove widths and depths
+	from phosphate positions in process with dna_grooves (see native_grooves).
 	Returns
 	-------
 	Curently returns groove params.
 	"""
 
+	if backend=='native':
+		return(native_grooves(DNA_atomsel,length))
+	if backend!='curves':
+		raise ValueError("backend should be 'curves' or 'native', not %r"%(backend,))
+
+	if workdir is None:
+		with scratch_dir() as wd:
+			return(CURVES_analyze(DNA_atomsel,length,workdir=wd,backend=backend))
 
 	unique=str(uuid.uuid4())
 	pdb = unique+'.pdb'
 
-	print("Writing coords to "+pdb)
-	DNA_atomsel.write('pdb',TEMP+'/'+pdb)
+	log("Writing coords to "+pdb,'verbose')
+	with TIMER.stage('pdb_write'):
+		_pdb_writer(DNA_atomsel).write(_coords(DNA_atomsel),os.path.join(workdir,pdb))
 
 	#Now we can run CURVES+
 	cmd=P_CURVES+' <<!\n &inp file=%s, lis=%s,\n lib=%s\n &end\n2 1 -1 0 0\n1:%d\n%d:%d\n!'%(pdb,pdb,P_CURVES_LIB,length,length*2,length+1)
-	print cmd
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	out, err = p.communicate()
-	print('OUT:'+out+err)
+	log(cmd,'verbose')
+	with TIMER.stage('curves'):
+		p = subprocess.Popen(cmd,shell=True,cwd=workdir,stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+		out, err = p.communicate()
+	tool_output('curves',out,err,p.returncode)
 	#Now let's parse Curves output
-	lis=TEMP+'/'+pdb+'.lis'
+	lis=os.path.join(workdir,pdb+'.lis')
 	return(parse_lis(lis))
 
 
 
+def _curves_pairs(top,length=None):
+	"""
+	Pairs as in the Curves+ input of CURVES_analyze: residues 1..length with 2*length..length+1,
+	or the first segment with the reversed second one if length is None
+	"""
+	if length is None:
+		return(strand_pairs(top))
+	return(np.column_stack([np.arange(length),2*length-1-np.arange(length)]))
+
+def native_grooves(DNA_atomsel,length=None,axis=False):
+	"""Computes groove widths and depths in process, see dna_grooves.groove_widths
+
+	Returns a data frame with the layout of parse_lis (Level,W12,D12,W21,D21).
+	length - length of one DNA strand as in CURVES_analyze, by default the two segments are paired.
+	axis - also return the helical axis data frame (Level,X,Y,Z,Bend,Curv), see dna_grooves.helical_axis.
+	"""
+	coords=_coords(DNA_atomsel)
+	top=BaseTopology.from_atomsel(DNA_atomsel)
+	pairs=_curves_pairs(top,length)
+	with TIMER.stage('grooves'):
+		level,values=groove_widths(coords,top,pairs)
+	df=groove_dataframe(level,values)
+	if axis:
+		return(df,axis_dataframe(*helical_axis(coords,top,pairs)))
+	return(df)
+
+def native_grooves_frames(frames,DNA_atomsel,length=None,block=100,set_frame=None,axis=False):
+	"""Groove widths (and the helical axis) over many frames, computed in blocks of frames
+
+	Parameters
+	----------
+	frames - frame numbers.
+	DNA_atomsel - DNA segments selected by atomsel command in VMD or a backends.Structure.
+	length - as in native_grooves.
+	block - number of frames whose coordinates are kept in memory and processed at once.
+	set_frame - function that moves the selection to a frame, as in iter_analyze.
+	axis - add X,Y,Z,Bend,Curv of the helical axis at integer levels.
+
+	Return
+	--------
+	PANDAS data frame with one row per frame and level: Level,W12,D12,W21,D21 (and axis columns), Time - frame number.
+	"""
+	if set_frame is None:
+		set_frame=getattr(DNA_atomsel,'set_frame',vmd_goto)
+	top=BaseTopology.from_atomsel(DNA_atomsel)
+	pairs=_curves_pairs(top,length)
+	frames=list(frames)
+	dfs=[]
+	for start in range(0,len(frames),block):
+		chunk=frames[start:start+block]
+		coords=[]
+		for frame in chunk:
+			set_frame(frame)
+			coords.append(_coords(DNA_atomsel))
+		coords=np.array(coords)
+		level,values=groove_widths(coords,top,pairs)
+		if axis:
+			ax,bend,curv=helical_axis(coords,top,pairs)
+		for k,frame in enumerate(chunk):
+			df=groove_dataframe(level,values[k])
+			if axis:
+				#axis is defined at base pairs, half levels get NaN
+				df=df.merge(axis_dataframe(ax[k],bend[k],curv[k]),on='Level',how='left')
+			df['Time']=frame
+			dfs.append(df)
+	if not dfs:
+		return(pd.DataFrame())
+	return(pd.concat(dfs,ignore_index=True))
+
+@timed('parse_lis')
 def parse_lis(file):
 	"""
 	Parses CURVES+ lis file to get groove parameters
 	"""
+	return(parse_lis_text(_read_text(file)))
 
-	tmpfile=file.replace('.lis','.tmpb')
-	tmpfile2=file.replace('.lis','.tmpg')
+def parse_lis_text(text,as_array=False,backbone=False):
+	"""
+	Same as parse_lis, but takes the contents of the lis file
 
-	#Let's parse the backbone
-	with open(file,'r') as f: 
-		with open(tmpfile,'w') as t:
-			with open(tmpfile2,'w') as t2:
-				#loop till we find
-				#  (D) Backbone Parameters
-				for line in f:
-					if(re.search("\(D\)",line)): break
-				# Strand 1     Alpha  Beta   Gamma  Delta  Epsil  Zeta   Chi    Phase  Ampli  Puckr  
-				for line in f:
-					if(re.search("Strand",line)):
-						t.write('Strand\t'+'Resid\t'+'\t'.join(line.split()[2:])+'\n')
-						f.next() # skip one blank line
-						break
-				for line in f:
-					if(re.search("\d+\)\s+[ATGC]",line)):
-						t.write('1'+'\t'+'\t'.join(line.split()[2:]).replace('----','')+'\n')
-					else: break
-				for line in f:
-					if(re.search("Strand",line)):
-						f.next() # skip one blank line
-						break
-				for line in f:
-					if(re.search("\d+\)\s+[ATGC]",line)):
-						t.write('2'+'\t'+'\t'.join(line.split()[2:]).replace('----','')+'\n')
-					else: break
-				for line in f:
-					if(re.search("\(E\)",line)): break
-				for line in f:
-					if(re.search("Level",line)):
-						t2.write('\t'.join(line.split())+'\n')
-						f.next() # skip one blank line
-						break
-				for line in f:
-					if(re.search("\s+\d+",line)):
-						t2.write(line[0:8].strip()+'\t'+line[16:22].strip()+'\t'+line[23:30].strip()+'\t'+line[31:38].strip()+'\t'+line[39:46].strip()+'\n')
-					else: break
-					
-	#Uncomment this if you want backbone data, its here ready!!!
-	# df_bb=pd.read_csv(tmpfile, sep=u'\t')
-
-	df_gr=pd.read_csv(tmpfile2, sep=u'\t')
+	as_array - if True returns a tuple (list of column names, (N,5) numpy array)
+	for the groove parameters.
+	backbone - if True returns a tuple (groove parameters, backbone parameters)
+	where the second is a data frame with (D) Backbone Parameters of both strands.
+	"""
+	lines=_to_text(text).splitlines()
+	n=len(lines)
+	i=0
+	bb=[]
+	gr=[]
 
-	return(df_gr)
-	# df_bb.to_csv('../analysis_data/dna_bb_param_cryst.csv')
+	def find(start,pattern):
+		for k in range(start,n):
+			if(re.search(pattern,lines[k])): return(k)
+		return(n)
 
-	# df_gr.to_csv('../analysis_data/dna_gr_param_cryst.csv')
+	#Let's parse the backbone
+	#loop till we find
+	#  (D) Backbone Parameters
+	i=find(0,"\(D\)")+1
+	# Strand 1     Alpha  Beta   Gamma  Delta  Epsil  Zeta   Chi    Phase  Ampli  Puckr
+	i=find(i,"Strand")
+	if i<n:
+		bb.append(['Strand','Resid']+lines[i].split()[2:])
+	i+=2 # skip one blank line
+	for strand in ('1','2'):
+		while i<n and re.search("\d+\)\s+[ATGC]",lines[i]):
+			bb.append([strand]+('\t'.join(lines[i].split()[2:]).replace('----','')).split('\t'))
+			i+=1
+		i+=1
+		if strand=='1':
+			i=find(i,"Strand")+2 # skip one blank line
+
+	i=find(i,"\(E\)")+1
+	i=find(i,"Level")
+	if i<n:
+		gr.append(lines[i].split())
+	i+=2 # skip one blank line
+	while i<n and re.search("\s+\d+",lines[i]):
+		line=lines[i]
+		gr.append([line[0:8].strip(),line[16:22].strip(),line[23:30].strip(),line[31:38].strip(),line[39:46].strip()])
+		i+=1
+
+	header,data=_table_rows(gr)
+	if as_array:
+		df_gr=(header,_float_values(data))
+	else:
+		df_gr=_frame_from_rows(header,data)
+	if backbone:
+		return(df_gr,_frame_from_rows(*_table_rows(bb)))
+	return(df_gr)
 
 
 ###Here goes the rebuilding mechanism.
@@ -505,354 +1355,527 @@ def parse_lis(file):
 #x3dna_utils cp_std BDNA
 #rebuild -atomic bp_step.par nucl_new.pdb
 
-def gen_bp_step(data_frame,new_seq=None):
+def gen_bp_step(data_frame,new_seq=None,workdir=TEMP):
 	"""
 	Generates the bp_step.par file based on a data frame (might be the outpur of X3DNA_analyze or X3DNA_analyze_bp_step)
 	Returns a file name
 
 	Optionally we can place a new sequnce here in new_seq ['A','T',..].
+	The file is written to workdir (TEMP by default).
 	"""
 
 	unique=str(uuid.uuid4())
 	par = unique+'.par'
-	full_path=TEMP+'/'+par
+	full_path=os.path.join(workdir,par)
 
-	new_df=data_frame[['BPname','Shear','Stretch','Stagger','Buckle','Prop-Tw','Opening','Shift','Slide','Rise','Tilt','Roll','Twist']]
+	write_par(full_path,_bpnames(data_frame,new_seq),params_from_dataframe(data_frame))
+	return(full_path)
 
-	#put new sequence
+def _bpnames(data_frame,new_seq=None):
+	"""
+	Base pair names of the data frame or of new_seq ['A','T',..]
+	"""
 	if(new_seq):
 		d={'A':'A-T','T':'T-A','G':'G-C','C':'C-G'}
-		comp_seq=map(lambda x: d[x],new_seq)
-		new_df['BPname']=pd.Series(comp_seq,index=new_df.index)
-
-	# new_columns = new_df.columns.values
-	# new_columns[0]='#'
-	# new_df.columns=new_columns
-	new_df=new_df.fillna(0.0)
-
+		return([d[x] for x in new_seq])
+	return([str(x) for x in data_frame['BPname']])
 
-	f=open(full_path+'tmp','wb')
-	# f=open(par,'w')
 
-	f.write('  %d # base-pairs\n'%len(new_df.index))
-	f.write('    0 # ***local base-pair & step parameters***\n')
-	f.write(' #        Shear    Stretch   Stagger   Buckle   Prop-Tw   Opening     Shift     Slide     Rise      Tilt      Roll      Twist\n')
-	# new_df.to_string(f,index=False,na_rep='0.000',float_format='{:>10.3f}'.format)
-	new_df.to_string(f,index=False,header=False,justify='left',col_space=0,na_rep='0.000',formatters=['{:4s}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format,'{:>9.3f}'.format])
-	f.close()
-	#Now megahack - we need to strip one space from every row.
-	with open(full_path+'tmp','rb') as f:
-		with open(full_path,'wb') as f2:
-			for line in f:
-				f2.write(line[1:])
-
-
-	return(full_path)
-
-
-def build_dna(data_frame,pdbfile,new_seq=None):
+def build_dna(data_frame,pdbfile,new_seq=None,workdir=None,method='x3dna'):
 	"""
 	Runs gen_bp_step and then runs the rebuilding of DNA via X3DNA
 	and output to pdbfile
+	The standard base files and the intermediate .par file are kept in workdir,
+	by default a private scratch_dir() that is removed afterwards.
+	method='native' builds the structure in process with dna_rebuild.DNARebuilder
+	(standard bases and backbone templates, no X3DNA programs are run).
 	"""
-	par_fname=gen_bp_step(data_frame,new_seq)
+	if method=='native':
+		builder=DNARebuilder(_bpnames(data_frame,new_seq))
+		builder.write_pdb(params_from_dataframe(data_frame),pdbfile)
+		return
+	if workdir is None:
+		with scratch_dir() as wd:
+			return(build_dna(data_frame,pdbfile,new_seq,workdir=wd))
+
+	par_fname=gen_bp_step(data_frame,new_seq,workdir=workdir)
 
 	cmd=P_X3DNA_x3dna_utils+' cp_std BDNA'
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	out, err = p.communicate()
-	print('OUT:'+out+err)
+	with TIMER.stage('cp_std'):
+		p = subprocess.Popen(cmd,shell=True,cwd=workdir,stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+		out, err = p.communicate()
+	tool_output('cp_std',out,err,p.returncode)
 
 	cmd=P_X3DNA_rebuild+' -atomic '+par_fname+' '+par_fname+'.pdb'
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	out, err = p.communicate()
-	print('OUT:'+out+err)
-
-	os.system('mv '+par_fname+'.pdb '+pdbfile)
+	with TIMER.stage('rebuild'):
+		p = subprocess.Popen(cmd,shell=True,cwd=workdir,stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+		out, err = p.communicate()
+	tool_output('rebuild',out,err,p.returncode)
 
+	shutil.move(par_fname+'.pdb',pdbfile)
 
-def get_dna_SASA(DNA_atomsel,add_hydrogens=False,probe_size=1.4,slicew=0.05,cont_area=False,vdw_file_path='',vdw_set_select=None,debug=0,reduce='PHENIX'):
+def build_dna_batch(params,sequence,pdbfiles=None):
 	"""
-	
-	When working with non-standart radii requiers corrected 
-	vertsion of NACCESS that treats hydrogens as normal atoms!!!
+	Builds many structures with the same sequence at once in process (dna_rebuild.DNARebuilder).
 
-	Outputs a data frame where for every base pair we will have values of sugar hydrogens SASA and total SASA of all atoms.
-	As in X3DNA_analyze the numbering follows first strand. H5''_SASA_1 - sasa of first nucletide in first strand.
-	H5''_SASA_2 - of the complementary nucleotide (should be last in second strand).
-
-	DNA_atomsel - DNA segments selected by atomsel command in VMD.
-	(NOT AtomSel!)
-	add_hydrogens - add them with Reduce.
-	vdw_file_path - path to vdw file, if '' - standart will be used.
+	Parameters
+	----------
+	params - (structures,n_bp,12) array of BP_PARAMS+STEP_PARAMS or a list of data frames of X3DNA_analyze.
+	sequence - bases of the first strand ['A','T',..] or base pair names ['A-T',..].
+	pdbfiles - if given, structures are written to these files.
 
 	Return
 	--------
-	PANDAS data frame of the following format:
-	H1'_SASA_1 H1'_SASA_2 and so on.
-	FULL_SASA_1, FULL_SASA_2
+	(structures,n_atoms,3) coordinates and the DNARebuilder with the topology.
+	"""
+	if isinstance(params,(list,tuple)) and len(params) and isinstance(params[0],pd.DataFrame):
+		params=np.array([params_from_dataframe(df) for df in params])
+	builder=DNARebuilder(sequence)
+	xyz=builder.build(params)
+	if pdbfiles is not None:
+		writer=builder.writer()
+		for frame,f in zip(xyz.reshape((-1,)+xyz.shape[-2:]),pdbfiles):
+			writer.write(frame,f)
+	return(xyz,builder)
+
+
+###Here goes SASA via NACCESS.
+#get_dna_SASA and get_dna_FULL_SASA write the selection, optionally add hydrogens with reduce,
+#run NACCESS and sum the per atom SASA from the .asa file per nucleotide.
+#Nucleotides are paired as in X3DNA_analyze: first strand 5'-3', second strand reversed.
+
+#Sugar hydrogens reported by get_dna_SASA
+SASA_HYDROGENS=["H1'","H2'","H2''","H3'","H4'","H5'","H5''"]
+_SASA_DNA_RESNAMES=['DA','DC','DT','DG']
+_ASA_COLUMNS=['ATOM','atnum','name','resname','chain','resid','x','y','z','SASA','VdW']
+
+#Radii sets shipped in vdw_radii, selected by vdw_set_select
+VDW_RADII_SETS={
+	'charmm-rmin':'vdw_radii/vdw_charmm36_rmin.radii',
+	'charmm-sigma':'vdw_radii/vdw_charmm36_sigma.radii',
+	'amber-rmin':'vdw_radii/vdw_parm10_rmin.radii',
+	'amber-sigma':'vdw_radii/vdw_parm10_sigma.radii',
+}
+
+def _run_reduce(pdb,pdb_wH,reduce,workdir):
+	"""
+	Runs phenix.reduce (reduce='PHENIX') or AMBER reduce (reduce='AMBER') on pdb in workdir, output goes to pdb_wH
 	"""
+	#Let's run reduce
+	outfile=open(os.path.join(workdir,pdb_wH),'w')
+	P_REDUCE=P_REDUCE_PHENIX
+	if(reduce=='AMBER'):
+		P_REDUCE=P_REDUCE_AMBER
+	cmd=P_REDUCE +' -NOFLIP '+pdb 
+	with TIMER.stage('reduce'):
+		p = subprocess.Popen(cmd,shell=True,cwd=workdir,stdout=outfile, stderr=subprocess.PIPE, universal_newlines=True)
+		# wait for the process to terminate
+		out, err = p.communicate()
+	errcode = p.returncode
+	#reduce writes its log to stderr even when it succeeds
+	tool_output('reduce','',err,errcode)
+	outfile.close()
 
-	if vdw_set_select:
-		if vdw_set_select=='charmm-rmin':
-			vdw_file_path=os.path.join(os.path.dirname(os.path.realpath(__file__)),'vdw_radii/vdw_charmm36_rmin.radii')
-		if vdw_set_select=='charmm-sigma':
-			vdw_file_path=os.path.join(os.path.dirname(os.path.realpath(__file__)),'vdw_radii/vdw_charmm36_sigma.radii')
-		if vdw_set_select=='amber-rmin':
-			vdw_file_path=os.path.join(os.path.dirname(os.path.realpath(__file__)),'vdw_radii/vdw_parm10_rmin.radii')
-		if vdw_set_select=='amber-sigma':
-			vdw_file_path=os.path.join(os.path.dirname(os.path.realpath(__file__)),'vdw_radii/vdw_parm10_sigma.radii')
+class _Hydrogenated(object):
+	"""
+	Selection with hydrogens added by dna_hydrogens.HydrogenBuilder:
+	per atom topology of atoms and hydrogens (every hydrogen after its parent atom) and a PDB writer for it.
+	"""
 
+	def __init__(self,DNA_atomsel,builder):
+		self.builder=builder
+		get=DNA_atomsel.get
+		n=len(get('name'))
+		parent=builder.parent
+		self.order=builder.merged_order(n)
+		def merged(values,hydrogen_values=None):
+			values=list(values)
+			extra=[values[i] for i in parent] if hydrogen_values is None else list(hydrogen_values)
+			merged_values=values+extra
+			return([merged_values[i] for i in self.order])
+		self.names=merged([PDB_ATOM_NAMES.get(x,x) for x in get('name')],builder.names)
+		self.resnames=merged(get('resname'))
+		self.resids=merged(get('resid'))
+		self.chains=merged(get('chain'))
+		self.segids=merged(get('segname'))
+		self.elements=merged(get('element'),['H']*len(parent))
+		self.writer=PDBWriter(self.names,self.resnames,self.resids,chains=self.chains,segids=self.segids,
+			elements=self.elements,resname_map=_SASA_RESNAMES)
+
+	def coords(self,DNA_atomsel):
+		return(self.builder.merge(_coords(DNA_atomsel),self.order))
+
+#_Hydrogenated per selection and reduce mode, templates are derived once
+_hydrogenated_cache={}
+
+def _hydrogenated(DNA_atomsel,reduce,workdir=None):
+	"""
+	Returns _Hydrogenated for the selection. The hydrogen templates are derived on the first call:
+	from standard geometry (reduce='TEMPLATE') or from a reduce run on the current frame
+	(reduce='TEMPLATE-PHENIX' or 'TEMPLATE-AMBER'), later frames reuse them.
+	"""
+	key=(id(DNA_atomsel),reduce)
+	if key not in _hydrogenated_cache:
+		builder=HydrogenBuilder(BaseTopology(DNA_atomsel.get('name'),DNA_atomsel.get('resname'),DNA_atomsel.get('resid'),DNA_atomsel.get('chain')))
+		xyz=_coords(DNA_atomsel)
+		if reduce=='TEMPLATE':
+			builder.fit(xyz)
+		elif reduce in ('TEMPLATE-PHENIX','TEMPLATE-AMBER'):
+			builder.fit(xyz,_reduce_hydrogens(DNA_atomsel,builder,reduce.split('-')[1],workdir))
+		else:
+			raise ValueError("reduce should be 'PHENIX', 'AMBER', 'TEMPLATE', 'TEMPLATE-PHENIX' or 'TEMPLATE-AMBER', not %r"%(reduce,))
+		_hydrogenated_cache[key]=_Hydrogenated(DNA_atomsel,builder)
+	return(_hydrogenated_cache[key])
+
+def _reduce_hydrogens(DNA_atomsel,builder,reduce,workdir=None):
+	"""
+	Runs reduce once on the current frame and returns (n_H,3) positions of the hydrogens of builder
+	found in its output (NaN for the ones not found)
+	"""
+	if workdir is None:
+		with scratch_dir() as wd:
+			return(_reduce_hydrogens(DNA_atomsel,builder,reduce,wd))
+	unique=str(uuid.uuid4())
+	_pdb_writer(DNA_atomsel,name_map=PDB_ATOM_NAMES,resname_map=_SASA_RESNAMES).write(_coords(DNA_atomsel),os.path.join(workdir,unique+'.pdb'))
+	_run_reduce(unique+'.pdb',unique+'_wH.pdb',reduce,workdir)
+	found={}
+	with open(os.path.join(workdir,unique+'_wH.pdb'),'r') as f:
+		for l in f:
+			if l.startswith(('ATOM','HETATM')):
+				found[(l[21],int(l[22:26]),l[12:16].strip())]=[float(l[30:38]),float(l[38:46]),float(l[46:54])]
+	chains=DNA_atomsel.get('chain')
+	resids=DNA_atomsel.get('resid')
+	res=np.full((len(builder.names),3),np.nan)
+	for k,(name,i) in enumerate(zip(builder.names,builder.parent)):
+		xyz=found.get((str(chains[i])[:1] or ' ',int(resids[i]),name))
+		if xyz is not None:
+			res[k]=xyz
+	return(res)
+
+def _run_naccess(DNA_atomsel,add_hydrogens,probe_size,slicew,cont_area,vdw_file_path,vdw_set_select,debug,reduce,workdir):
+	"""
+	Writes the selection, adds hydrogens if needed and runs NACCESS in workdir,
+	returns the path to the .asa file
+	"""
+	if vdw_set_select in VDW_RADII_SETS:
+		vdw_file_path=os.path.join(os.path.dirname(os.path.realpath(__file__)),VDW_RADII_SETS[vdw_set_select])
 
 	#At first we need to makup a couple of unique file names
 	unique=str(uuid.uuid4())
 	pdb = unique+'.pdb'
 	pdb_wH=unique+'_wH'+'.pdb'
-	outf = unique
-
-	print("Writing coords to "+pdb)
-
-	#since VMD shifts DNA residue names by one and reduce does not understands it, here is a dirty hack.
-	#But if we already did that we should avoid
-	if(DNA_atomsel.get('resname')[0][0]!='_'):
-		DNA_atomsel.set('resname',[('_'+i) if i in ['DA','DG','DC','DT'] else i for i in DNA_atomsel.get('resname')])
-	#also try to convert atom names to pdb naming
-	ch={'O1P':'OP1','O2P':'OP2','C5M':'C7','H51':'H71','H52':'H72','H53':'H73'}
-	DNA_atomsel.set('name',[ch.get(i,i) for i in DNA_atomsel.get('name')])
-
-	DNA_atomsel.write('pdb',TEMP+'/'+pdb)
-	with open(TEMP+'/'+pdb, 'r') as content_file:
-		content = content_file.read()
-	with open(TEMP+'/'+pdb, 'w') as content_file:
-		content_file.write(content.replace('_',' '))
+
+	if add_hydrogens and reduce.startswith('TEMPLATE'):
+		#hydrogens are placed from templates, no reduce run
+		log("Writing coords with hydrogens to "+pdb_wH,'verbose')
+		hyd=_hydrogenated(DNA_atomsel,reduce,workdir)
+		with TIMER.stage('hydrogens'):
+			xyz=hyd.coords(DNA_atomsel)
+		with TIMER.stage('pdb_write'):
+			hyd.writer.write(xyz,os.path.join(workdir,pdb_wH))
+		add_hydrogens=False
+		pdb=None
+
+	#reduce wants DNA residue names shifted by one column and atoms in pdb naming,
+	#the writer does both renames once per selection
+	if pdb:
+		log("Writing coords to "+pdb,'verbose')
+		with TIMER.stage('pdb_write'):
+			_pdb_writer(DNA_atomsel,name_map=PDB_ATOM_NAMES,resname_map=_SASA_RESNAMES).write(_coords(DNA_atomsel),os.path.join(workdir,pdb))
 	
 	if(add_hydrogens):
-		#Let's run reduce
-		outfile=open(TEMP+'/'+pdb_wH,'w')
-		P_REDUCE=P_REDUCE_PHENIX
-		if(reduce=='AMBER'):
-			P_REDUCE=P_REDUCE_AMBER
-		cmd=P_REDUCE +' -NOFLIP '+pdb 
-		p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=outfile, stderr=subprocess.PIPE)
+		_run_reduce(pdb,pdb_wH,reduce,workdir)
+	elif pdb:
+		shutil.move(os.path.join(workdir,pdb),os.path.join(workdir,pdb_wH))
+	#Now we go for NACCESS
+	cmd=P_NACCESS+' '+os.path.join(workdir,pdb_wH)+' -p '+'%f'%probe_size+' %s'%(('-r '+ vdw_file_path) if vdw_file_path else '')+' -y'+' -z '+'%f'%slicew+'%s'%(' -c' if cont_area else '')
+	with TIMER.stage('naccess'):
+		p = subprocess.Popen(cmd,shell=True,cwd=workdir,stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
 		# wait for the process to terminate
 		out, err = p.communicate()
-		errcode = p.returncode
-		# print('OUT:'+out)
-		print('Log:'+err)
-		outfile.close()
-	else:
-		os.system('mv '+TEMP+'/'+pdb+' '+TEMP+'/'+pdb_wH)
-	#Now we go for NACCESS
-	cmd=P_NACCESS+' '+TEMP+'/'+pdb_wH+' -p '+'%f'%probe_size+' %s'%(('-r '+ vdw_file_path) if vdw_file_path else '')+' -y'+' -z '+'%f'%slicew+'%s'%(' -c' if cont_area else '')
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	# wait for the process to terminate
-	out, err = p.communicate()
 	errcode = p.returncode
-	print "=======================NACCESS run BEGIN================"
+	if not debug:
+		tool_output('naccess',out,err,errcode)
+		return(os.path.join(workdir,pdb_wH[:-3]+'asa'))
+	print("=======================NACCESS run BEGIN================")
 	if debug>0:
-		with open(TEMP+'/'+pdb_wH[:-3]+'log','r') as f:
+		with open(os.path.join(workdir,pdb_wH[:-3]+'log'),'r') as f:
 			print('Log file:'+f.read())
 		print('ErrOUT:'+err)
 		print('STDOUT:'+out)
 	if debug>1:
-		print "-------ASA file-----"
-		with open(TEMP+'/'+pdb_wH[:-3]+'asa','r') as f:
+		print("-------ASA file-----")
+		with open(os.path.join(workdir,pdb_wH[:-3]+'asa'),'r') as f:
 			print(f.read())
-	print "=======================NACCESS run END================"
-
-	# os.system("cd int_data; naccess ../inp_data/1naj_mod1.pdb -y ; cd ..")
-	# table=pd.read_csv(TEMP+'/'+pdb_wH[:-3]+'asa',usecols=[2,4,5,9,10],dtype=None)
-	table=pd.read_csv(TEMP+'/'+pdb_wH[:-3]+'asa',sep="\s+",header=None,names=['ATOM','atnum','name','resname','chain','resid','x','y','z','SASA','VdW'])
-	# table=table[(table['name'].isin(['H5\'\'','H5\'','H4\'','H3\'','H2\'\'','H2\'','H1\'']))&(table['resname'].isin(['DA','DC','DT','DG']))]
-	table=table[(table['resname'].isin(['DA','DC','DT','DG']))]
-	# print table[300:330]
-
-	#let' get needed dataframe
-	#split
-	gb=table.groupby(['chain'])
-	keys=list(gb.groups.keys())
-	keys.sort()
-	# print keys
-	str_one=gb.get_group(keys[0]) 
-	str_two=gb.get_group(keys[1]) 
-
-	gb=str_one.groupby('resid')
-	keys=list(gb.groups.keys())
-	keys.sort()
-
-	gb2=str_two.groupby('resid')
-	keys2=list(gb2.groups.keys())
-	keys2.sort()
-	keys2=keys2[::-1]
-
-	sum_df=pd.DataFrame()
-
-	for i,i2 in zip(keys,keys2):
-		objdf=gb.get_group(i)
-		h1p=objdf[objdf['name']=='H1\'']['SASA'].values[0]
-		h2p=objdf[objdf['name']=='H2\'']['SASA'].values[0]
-		h2pp=objdf[objdf['name']=='H2\'\'']['SASA'].values[0]
-		h3p=objdf[objdf['name']=='H3\'']['SASA'].values[0]
-		h4p=objdf[objdf['name']=='H4\'']['SASA'].values[0]
-		h5p=objdf[objdf['name']=='H5\'']['SASA'].values[0]
-		h5pp=objdf[objdf['name']=='H5\'\'']['SASA'].values[0]
-		fullsasa1=objdf['SASA'].sum()
-
-		objdf2=gb2.get_group(i2)
-		h1p2=objdf2[objdf2['name']=='H1\'']['SASA'].values[0]
-		h2p2=objdf2[objdf2['name']=='H2\'']['SASA'].values[0]
-		h2pp2=objdf2[objdf2['name']=='H2\'\'']['SASA'].values[0]
-		h3p2=objdf2[objdf2['name']=='H3\'']['SASA'].values[0]
-		h4p2=objdf2[objdf2['name']=='H4\'']['SASA'].values[0]
-		h5p2=objdf2[objdf2['name']=='H5\'']['SASA'].values[0]
-		h5pp2=objdf2[objdf2['name']=='H5\'\'']['SASA'].values[0]
-		fullsasa2=objdf2['SASA'].sum()
-
-
-		# print h1p
-
-		sum_df=pd.concat([sum_df,
-			pd.DataFrame({'H1\'_SASA_1':[h1p],'H1\'_SASA_2':[h1p2],
-				'H2\'_SASA_1':[h2p],'H2\'_SASA_2':[h2p2],
-				'H2\'\'_SASA_1':[h2pp],'H2\'\'_SASA_2':[h2pp2],
-				'H3\'_SASA_1':[h3p],'H3\'_SASA_2':[h3p2],
-				'H4\'_SASA_1':[h4p],'H4\'_SASA_2':[h4p2],
-				'H5\'_SASA_1':[h5p],'H5\'_SASA_2':[h5p2],
-				'H5\'\'_SASA_1':[h5pp],'H5\'\'_SASA_2':[h5pp2],'FULL_SASA_1':[fullsasa1],'FULL_SASA_2':[fullsasa2]})])
-
-	return sum_df#.reset_index()
-
-
-
-def get_dna_FULL_SASA(DNA_atomsel,add_hydrogens=False,probe_size=1.4,slicew=0.05,cont_area=False,vdw_file_path='',vdw_set_select=None,debug=0,reduce='PHENIX'):
+	print("=======================NACCESS run END================")
+	return(os.path.join(workdir,pdb_wH[:-3]+'asa'))
+
+#SASA engines built for selections in this process, see _sasa_engine
+_sasa_engines={}
+
+def _sasa_engine(DNA_atomsel,probe_size,vdw_file_path):
+	"""
+	Returns SASAEngine for the selection (or _Hydrogenated), radii are assigned once per selection, probe and radii file
+	"""
+	key=(id(DNA_atomsel),probe_size,vdw_file_path)
+	if key not in _sasa_engines:
+		if isinstance(DNA_atomsel,_Hydrogenated):
+			hyd=DNA_atomsel
+			radii=atom_radii(hyd.names,[_SASA_RESNAMES.get(r,r).strip() for r in hyd.resnames],hyd.elements,
+				read_radii(vdw_file_path) if vdw_file_path else None)
+			_sasa_engines[key]=SASAEngine(radii,probe_size=probe_size,names=hyd.names,
+				resnames=[_SASA_RESNAMES.get(r,r) for r in hyd.resnames],resids=hyd.resids,chains=hyd.chains)
+		else:
+			_sasa_engines[key]=SASAEngine.from_atomsel(DNA_atomsel,probe_size=probe_size,radii_file=vdw_file_path or None,
+				name_map=PDB_ATOM_NAMES)
+	return(_sasa_engines[key])
+
+def _sasa_atom_table(DNA_atomsel,add_hydrogens,probe_size,slicew,cont_area,vdw_file_path,vdw_set_select,debug,reduce,workdir,method):
+	"""
+	Per atom SASA table with the columns of parse_asa, from NACCESS (method='naccess')
+	or from the in process Shrake-Rupley engine of dna_sasa (method='native', slicew is not used)
+	"""
+	if method=='naccess':
+		return(parse_asa(_run_naccess(DNA_atomsel,add_hydrogens,probe_size,slicew,cont_area,vdw_file_path,vdw_set_select,debug,reduce,workdir)))
+	if method!='native':
+		raise ValueError("method should be 'naccess' or 'native', not %r"%(method,))
+	if add_hydrogens and not reduce.startswith('TEMPLATE'):
+		raise ValueError("method='native' adds hydrogens only with reduce='TEMPLATE', 'TEMPLATE-PHENIX' or 'TEMPLATE-AMBER'")
+	if vdw_set_select in VDW_RADII_SETS:
+		vdw_file_path=os.path.join(os.path.dirname(os.path.realpath(__file__)),VDW_RADII_SETS[vdw_set_select])
+	if add_hydrogens:
+		hyd=_hydrogenated(DNA_atomsel,reduce)
+		engine=_sasa_engine(hyd,probe_size,vdw_file_path)
+		with TIMER.stage('hydrogens'):
+			xyz=hyd.coords(DNA_atomsel)
+		with TIMER.stage('sasa'):
+			table=engine.table(xyz)
+	else:
+		engine=_sasa_engine(DNA_atomsel,probe_size,vdw_file_path)
+		with TIMER.stage('sasa'):
+			table=engine.table(_coords(DNA_atomsel))
+	if cont_area:
+		#contact surface is the accessible one scaled to the van der Waals sphere
+		table['SASA']*=(engine.radii/(engine.radii+probe_size))**2
+	return(table)
+
+@timed('parse_asa')
+def parse_asa(file):
+	"""
+	Reads NACCESS .asa file into a data frame with columns
+	ATOM,atnum,name,resname,chain,resid,x,y,z,SASA,VdW
+	"""
+	return(parse_asa_text(_read_text(file)))
+
+def parse_asa_text(text):
+	rows=[l.split() for l in _to_text(text).splitlines()]
+	rows=[r for r in rows if len(r)==len(_ASA_COLUMNS)]
+	if not rows:
+		return(pd.DataFrame(columns=_ASA_COLUMNS))
+	cols=list(zip(*rows))
+	data=OrderedDict()
+	for c,values in zip(_ASA_COLUMNS,cols):
+		data[c]=_column_values(values)
+	return(pd.DataFrame(data,columns=_ASA_COLUMNS))
+
+class SASALayout(object):
+	"""
+	Pairing of nucleotides for SASA tables, computed once.
+	The first (alphabetically) chain goes 5'-3' by resid, the second one is reversed,
+	and the nucleotides are paired in this order, as in X3DNA_analyze.
+
+	Attributes
+	----------
+	strand1, strand2 - lists of (chain,resid) of paired nucleotides.
+	index - pandas MultiIndex of strand1+strand2, used to find rows of atoms.
+	"""
+
+	def __init__(self,chains,resids,resnames):
+		chains=np.asarray([str(c) for c in chains],dtype=object)
+		resids=np.asarray(resids,dtype=np.int64)
+		dna=np.array([str(r).strip() in _SASA_DNA_RESNAMES for r in resnames],dtype=bool)
+		keys=sorted(set(chains[dna]))
+		if len(keys)<2:
+			raise ValueError('Two DNA chains are needed to pair nucleotides, found %s'%(keys,))
+		res1=sorted(set(resids[dna&(chains==keys[0])]))
+		res2=sorted(set(resids[dna&(chains==keys[1])]))[::-1]
+		n=min(len(res1),len(res2))
+		self.strand1=[(keys[0],r) for r in res1[:n]]
+		self.strand2=[(keys[1],r) for r in res2[:n]]
+		self.index=pd.MultiIndex.from_tuples(self.strand1+self.strand2)
+
+	@classmethod
+	def from_atomsel(cls,DNA_atomsel):
+		"""
+		Layout from the topology of the selection, chains as written to the pdb
+		"""
+		return(cls(DNA_atomsel.get('chain'),DNA_atomsel.get('resid'),DNA_atomsel.get('resname')))
+
+	@classmethod
+	def from_table(cls,table):
+		"""
+		Layout from a table read by parse_asa
+		"""
+		return(cls(table['chain'].astype(str).values,table['resid'].values,table['resname'].values))
+
+	def __len__(self):
+		return(len(self.strand1))
+
+	def sum_by_nucleotide(self,table,names=None):
+		"""
+		Sums SASA of atoms per nucleotide with one index lookup.
+
+		Return
+		--------
+		full - (2,n_bp) total SASA of nucleotides of the first and second strand.
+		per_name - (2,n_bp,len(names)) SASA of the atoms with given names (NaN if absent) or None.
+		"""
+		n=len(self)
+		keys=pd.MultiIndex.from_arrays([table['chain'].astype(str).values,table['resid'].values.astype(np.int64)])
+		rows=self.index.get_indexer(keys)
+		dna=table['resname'].isin(_SASA_DNA_RESNAMES).values&(rows>=0)
+		rows=rows[dna]
+		sasa=table['SASA'].values.astype(float)[dna]
+		full=np.bincount(rows,weights=sasa,minlength=2*n).reshape(2,n)
+		if names is None:
+			return(full,None)
+		col=pd.Index(names).get_indexer(table['name'].values[dna])
+		sel=col>=0
+		per_name=np.full((2*n,len(names)),np.nan)
+		#the first atom with a name wins, as .values[0] did
+		per_name[rows[sel][::-1],col[sel][::-1]]=sasa[sel][::-1]
+		return(full,per_name.reshape(2,n,len(names)))
+
+def _sasa_frame(table,layout,hydrogens):
+	"""
+	Data frame of get_dna_SASA (hydrogens=True) or get_dna_FULL_SASA (hydrogens=False) from an .asa table
+	"""
+	if hydrogens:
+		full,per_name=layout.sum_by_nucleotide(table,SASA_HYDROGENS)
+		data=OrderedDict()
+		for j,name in enumerate(SASA_HYDROGENS):
+			data[name+'_SASA_1']=per_name[0,:,j]
+			data[name+'_SASA_2']=per_name[1,:,j]
+		data['FULL_SASA_1']=full[0]
+		data['FULL_SASA_2']=full[1]
+	else:
+		full,_=layout.sum_by_nucleotide(table)
+		data=OrderedDict([('SASA_1',full[0]),('SASA_2',full[1])])
+	return(pd.DataFrame(data,columns=list(data.keys())))
+
+def get_dna_SASA(DNA_atomsel,add_hydrogens=False,probe_size=1.4,slicew=0.05,cont_area=False,vdw_file_path='',vdw_set_select=None,debug=0,reduce='PHENIX',workdir=None,layout=None,method='naccess'):
 	"""
 	
 	When working with non-standart radii requiers corrected 
 	vertsion of NACCESS that treats hydrogens as normal atoms!!!
 
-	Outputs a data frame where for every base pair we will have values of FULL SASA of each nucleotide.
-	As in X3DNA_analyze the numbering follows first strand. SASA_1 - sasa of first nucletide in first strand.
-	SASA_2 - of the complementary nucleotide (should be last in second strand).
+	Outputs a data frame where for every base pair we will have values of sugar hydrogens SASA and total SASA of all atoms.
+	As in X3DNA_analyze the numbering follows first strand. H5''_SASA_1 - sasa of first nucletide in first strand.
+	H5''_SASA_2 - of the complementary nucleotide (should be last in second strand).
 
 	DNA_atomsel - DNA segments selected by atomsel command in VMD.
 	(NOT AtomSel!)
 	add_hydrogens - add them with Reduce.
+	reduce - 'PHENIX' or 'AMBER' runs that reduce for every call,
+	'TEMPLATE' places the hydrogens from standard geometry templates without reduce (dna_hydrogens),
+	'TEMPLATE-PHENIX' or 'TEMPLATE-AMBER' derive the templates from one reduce run on the first call.
 	vdw_file_path - path to vdw file, if '' - standart will be used.
+	vdw_set_select - one of VDW_RADII_SETS instead of vdw_file_path.
+	workdir - directory where reduce and NACCESS are run, by default a private scratch_dir().
+	layout - SASALayout to reuse between calls, by default it is taken from the NACCESS output.
+	method - 'naccess' runs NACCESS, 'native' computes SASA in process with dna_sasa.SASAEngine
+	(Shrake-Rupley, radii from the same radii files, slicew is not used).
 
 	Return
 	--------
 	PANDAS data frame of the following format:
-	SASA_1 SASA_2 and so on.
+	H1'_SASA_1 H1'_SASA_2 and so on.
+	FULL_SASA_1, FULL_SASA_2
 	"""
 
-	if vdw_set_select:
-		if vdw_set_select=='charmm-rmin':
-			vdw_file_path=os.path.join(os.path.dirname(os.path.realpath(__file__)),'vdw_radii/vdw_charmm36_rmin.radii')
-		if vdw_set_select=='charmm-sigma':
-			vdw_file_path=os.path.join(os.path.dirname(os.path.realpath(__file__)),'vdw_radii/vdw_charmm36_sigma.radii')
-		if vdw_set_select=='amber-rmin':
-			vdw_file_path=os.path.join(os.path.dirname(os.path.realpath(__file__)),'vdw_radii/vdw_parm10_rmin.radii')
-		if vdw_set_select=='amber-sigma':
-			vdw_file_path=os.path.join(os.path.dirname(os.path.realpath(__file__)),'vdw_radii/vdw_parm10_sigma.radii')
+	if workdir is None and method=='naccess':
+		with scratch_dir() as wd:
+			return(get_dna_SASA(DNA_atomsel,add_hydrogens,probe_size,slicew,cont_area,vdw_file_path,vdw_set_select,debug,reduce,workdir=wd,layout=layout,method=method))
 
+	table=_sasa_atom_table(DNA_atomsel,add_hydrogens,probe_size,slicew,cont_area,vdw_file_path,vdw_set_select,debug,reduce,workdir,method)
+	if layout is None:
+		layout=SASALayout.from_table(table)
+	return(_sasa_frame(table,layout,True))
 
-	#At first we need to makup a couple of unique file names
-	unique=str(uuid.uuid4())
-	pdb = unique+'.pdb'
-	pdb_wH=unique+'_wH'+'.pdb'
-	outf = unique
-
-	print("Writing coords to "+pdb)
-
-	#since VMD shifts DNA residue names by one and reduce does not understands it, here is a dirty hack.
-	#But if we already did that we should avoid
-	if(DNA_atomsel.get('resname')[0][0]!='_'):
-		DNA_atomsel.set('resname',[('_'+i) if i in ['DA','DG','DC','DT'] else i for i in DNA_atomsel.get('resname')])
-	#also try to convert atom names to pdb naming
-	ch={'O1P':'OP1','O2P':'OP2','C5M':'C7','H51':'H71','H52':'H72','H53':'H73'}
-	DNA_atomsel.set('name',[ch.get(i,i) for i in DNA_atomsel.get('name')])
-
-	DNA_atomsel.write('pdb',TEMP+'/'+pdb)
-	with open(TEMP+'/'+pdb, 'r') as content_file:
-		content = content_file.read()
-	with open(TEMP+'/'+pdb, 'w') as content_file:
-		content_file.write(content.replace('_',' '))
-	
-	if(add_hydrogens):
-		#Let's run reduce
-		outfile=open(TEMP+'/'+pdb_wH,'w')
-		P_REDUCE=P_REDUCE_PHENIX
-		if(reduce=='AMBER'):
-			P_REDUCE=P_REDUCE_AMBER
-		cmd=P_REDUCE +' -NOFLIP '+pdb 
-		p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=outfile, stderr=subprocess.PIPE)
-		# wait for the process to terminate
-		out, err = p.communicate()
-		errcode = p.returncode
-		# print('OUT:'+out)
-		print('Log:'+err)
-		outfile.close()
-	else:
-		os.system('mv '+TEMP+'/'+pdb+' '+TEMP+'/'+pdb_wH)
-	#Now we go for NACCESS
-	cmd=P_NACCESS+' '+TEMP+'/'+pdb_wH+' -p '+'%f'%probe_size+' %s'%(('-r '+ vdw_file_path) if vdw_file_path else '')+' -y'+' -z '+'%f'%slicew+'%s'%(' -c' if cont_area else '')
-	p = subprocess.Popen(cmd,shell=True,cwd=TEMP,stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-	# wait for the process to terminate
-	out, err = p.communicate()
-	errcode = p.returncode
-	print "=======================NACCESS run BEGIN================"
-	if debug>0:
-		with open(TEMP+'/'+pdb_wH[:-3]+'log','r') as f:
-			print('Log file:'+f.read())
-		print('ErrOUT:'+err)
-		print('STDOUT:'+out)
-	if debug>1:
-		print "-------ASA file-----"
-		with open(TEMP+'/'+pdb_wH[:-3]+'asa','r') as f:
-			print(f.read())
-	print "=======================NACCESS run END================"
 
-	# os.system("cd int_data; naccess ../inp_data/1naj_mod1.pdb -y ; cd ..")
-	# table=pd.read_csv(TEMP+'/'+pdb_wH[:-3]+'asa',usecols=[2,4,5,9,10],dtype=None)
-	table=pd.read_csv(TEMP+'/'+pdb_wH[:-3]+'asa',sep="\s+",header=None,names=['ATOM','atnum','name','resname','chain','resid','x','y','z','SASA','VdW'])
-	table=table[(table['resname'].isin(['DA','DC','DT','DG']))]
-	# print table[30:50]
+def get_dna_FULL_SASA(DNA_atomsel,add_hydrogens=False,probe_size=1.4,slicew=0.05,cont_area=False,vdw_file_path='',vdw_set_select=None,debug=0,reduce='PHENIX',workdir=None,layout=None,method='naccess'):
+	"""
+	
+	When working with non-standart radii requiers corrected 
+	vertsion of NACCESS that treats hydrogens as normal atoms!!!
 
-	#let' get needed dataframe
-	#split
-	gb=table.groupby(['chain'])
-	keys=list(gb.groups.keys())
-	keys.sort()
-	# print keys
-	str_one=gb.get_group(keys[0]) 
-	str_two=gb.get_group(keys[1]) 
+	Outputs a data frame where for every base pair we will have values of FULL SASA of each nucleotide.
+	As in X3DNA_analyze the numbering follows first strand. SASA_1 - sasa of first nucletide in first strand.
+	SASA_2 - of the complementary nucleotide (should be last in second strand).
 
-	gb=str_one.groupby('resid')
-	keys=list(gb.groups.keys())
-	keys.sort()
+	DNA_atomsel - DNA segments selected by atomsel command in VMD.
+	(NOT AtomSel!)
+	add_hydrogens - add them with Reduce.
+	reduce - 'PHENIX' or 'AMBER' runs that reduce for every call,
+	'TEMPLATE' places the hydrogens from standard geometry templates without reduce (dna_hydrogens),
+	'TEMPLATE-PHENIX' or 'TEMPLATE-AMBER' derive the templates from one reduce run on the first call.
+	vdw_file_path - path to vdw file, if '' - standart will be used.
+	vdw_set_select - one of VDW_RADII_SETS instead of vdw_file_path.
+	workdir - directory where reduce and NACCESS are run, by default a private scratch_dir().
+	layout - SASALayout to reuse between calls, by default it is taken from the NACCESS output.
+	method - 'naccess' runs NACCESS, 'native' computes SASA in process with dna_sasa.SASAEngine
+	(Shrake-Rupley, radii from the same radii files, slicew is not used).
 
-	gb2=str_two.groupby('resid')
-	keys2=list(gb2.groups.keys())
-	keys2.sort()
-	keys2=keys2[::-1]
+	Return
+	--------
+	PANDAS data frame of the following format:
+	SASA_1 SASA_2 and so on.
+	"""
 
-	sum_df=pd.DataFrame()
+	if workdir is None and method=='naccess':
+		with scratch_dir() as wd:
+			return(get_dna_FULL_SASA(DNA_atomsel,add_hydrogens,probe_size,slicew,cont_area,vdw_file_path,vdw_set_select,debug,reduce,workdir=wd,layout=layout,method=method))
 
-	for i,i2 in zip(keys,keys2):
-		objdf=gb.get_group(i)
-		h1p=objdf['SASA'].sum()
+	table=_sasa_atom_table(DNA_atomsel,add_hydrogens,probe_size,slicew,cont_area,vdw_file_path,vdw_set_select,debug,reduce,workdir,method)
+	if layout is None:
+		layout=SASALayout.from_table(table)
+	return(_sasa_frame(table,layout,False))
 
-		objdf2=gb2.get_group(i2)
-		h1p2=objdf2['SASA'].sum()
 
-		# print h1p2
+def _sasa_analyze(DNA_atomsel,ref_fp_id,full=False,layout=None,**kwargs):
+	"""
+	get_dna_SASA or get_dna_FULL_SASA in the analyze(DNA_atomsel,ref_fp_id) form of the trajectory driver
+	"""
+	if full:
+		return(get_dna_FULL_SASA(DNA_atomsel,layout=layout,**kwargs))
+	return(get_dna_SASA(DNA_atomsel,layout=layout,**kwargs))
 
-		sum_df=pd.concat([sum_df,
-			pd.DataFrame({'SASA_1':[h1p],'SASA_2':[h1p2]})])
+def get_dna_SASA_frames(frames,DNA_atomsel,full=False,workers=1,set_frame=None,**kwargs):
+	"""Runs get_dna_SASA (or get_dna_FULL_SASA if full=True) over many frames
 
-	return sum_df#.reset_index()
+	The pairing of nucleotides is computed once from the topology of DNA_atomsel
+	(chain and resid, as written to the pdb) and reused for all frames.
 
-if __name__ == '__main__':
-	print "Kuku"
-	X3DNA_find_pair('x')
-	help(atomsel)
+	Parameters
+	----------
+	frames - frame numbers.
+	DNA_atomsel - DNA segments selected by atomsel command in VMD or a backends.Structure.
+	full - output only total SASA of nucleotides as get_dna_FULL_SASA.
+	workers, set_frame - as in analyze_trajectory, frames are run in one process by default.
+	kwargs - passed to get_dna_SASA (add_hydrogens, probe_size, vdw_set_select ...).
 
+	Return
+	--------
+	PANDAS data frame with one row per frame and base pair: the columns of get_dna_SASA,
+	BP - number of base pair from 1 to N and Time - frame number.
+	"""
+	layout=SASALayout.from_atomsel(DNA_atomsel)
+	analyze=functools.partial(_sasa_analyze,full=full,layout=layout,**kwargs)
+	dfs=[]
+	for frame,df in iter_analyze(frames,DNA_atomsel,None,workers=workers,analyze=analyze,set_frame=set_frame):
+		df['BP']=np.arange(1,len(df)+1)
+		df['Time']=frame
+		dfs.append(df)
+	if not dfs:
+		return(pd.DataFrame())
+	return(pd.concat(dfs,ignore_index=True))
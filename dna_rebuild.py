@@ -0,0 +1,319 @@
+"""
+In-process rebuilding of DNA from base-pair and step parameters.
+
+This is the inverse of dna_geometry.base_pair_step_params and does what
+rebuild -atomic of X3DNA does, but for many structures at once:
+- base-pair frames are composed step by step from Shift, Slide, Rise, Tilt, Roll, Twist
+(Lu & Olson 2003, the middle frame is rotated by the half of the bending about the hinge),
+- the two base frames of every pair are obtained from the base-pair parameters in the same way,
+- standard base atoms (dna_geometry.STD_BASES) and backbone templates expressed
+in the base frame are placed with one matrix product per structure.
+All structures in a batch share the sequence, so the loop goes over base pairs only.
+The .par files of gen_bp_step and PDB files can be written in bulk for use with X3DNA.
+
+Usage:
+builder=DNARebuilder('ATGC...')
+xyz=builder.build(params)                 # params (structures,bp,12) -> (structures,atoms,3)
+builder.write_pdb(params,['s1.pdb','s2.pdb'])
+write_par('s1.par',builder.bpnames,params[0])
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from dna_geometry import STD_BASES, BaseTopology, fit_base_frames
+from pdb_io import PDBWriter, format_fixed
+
+#Columns of .par files and of the (...,12) parameter arrays
+PAR_COLUMNS=['Shear','Stretch','Stagger','Buckle','Prop-Tw','Opening','Shift','Slide','Rise','Tilt','Roll','Twist']
+
+COMPLEMENT={'A':'T','T':'A','G':'C','C':'G'}
+
+#Sugar-phosphate atoms in the standard base reference frame,
+#averaged over the nucleosomal DNA of only_nucl_init.pdb (see backbone_templates)
+STD_BACKBONE={
+	'A':OrderedDict([
+		('P',(-0.113,9.088,-1.986)),
+		('OP1',(-0.555,10.242,-2.509)),
+		('OP2',(0.989,9.085,-1.096)),
+		("O5'",(-1.259,8.440,-1.336)),
+		("C5'",(-2.311,8.070,-1.991)),
+		("C4'",(-3.178,7.163,-1.254)),
+		("O4'",(-2.638,5.845,-1.304)),
+		("C3'",(-3.338,7.517,0.183)),
+		("O3'",(-4.662,7.343,0.564)),
+		("C2'",(-2.428,6.543,0.859))]),
+	'G':OrderedDict([
+		('P',(-0.310,9.119,-2.248)),
+		('OP1',(-0.782,10.235,-2.836)),
+		('OP2',(0.823,9.212,-1.421)),
+		("O5'",(-1.427,8.508,-1.490)),
+		("C5'",(-2.506,8.051,-2.074)),
+		("C4'",(-3.278,7.130,-1.269)),
+		("O4'",(-2.683,5.844,-1.309)),
+		("C3'",(-3.393,7.524,0.172)),
+		("O3'",(-4.671,7.245,0.617)),
+		("C2'",(-2.403,6.633,0.823))]),
+	'C':OrderedDict([
+		('P',(-0.521,9.417,-2.422)),
+		('OP1',(-1.177,10.530,-2.936)),
+		('OP2',(0.688,9.600,-1.662)),
+		("O5'",(-1.535,8.631,-1.611)),
+		("C5'",(-2.595,8.080,-2.097)),
+		("C4'",(-3.322,7.149,-1.244)),
+		("O4'",(-2.694,5.864,-1.289)),
+		("C3'",(-3.384,7.561,0.192)),
+		("O3'",(-4.650,7.313,0.695)),
+		("C2'",(-2.377,6.657,0.826))]),
+	'T':OrderedDict([
+		('P',(-0.455,9.605,-2.061)),
+		('OP1',(-1.152,10.772,-2.387)),
+		('OP2',(0.745,9.670,-1.287)),
+		("O5'",(-1.457,8.677,-1.376)),
+		("C5'",(-2.441,8.144,-1.968)),
+		("C4'",(-3.235,7.184,-1.213)),
+		("O4'",(-2.629,5.892,-1.295)),
+		("C3'",(-3.390,7.515,0.246)),
+		("O3'",(-4.711,7.292,0.632)),
+		("C2'",(-2.457,6.542,0.906))]),
+}
+
+_RESNAMES={'A':'DA','G':'DG','C':'DC','T':'DT'}
+#DNA residue names are right justified in the PDB residue name field
+_PDB_RESNAMES=dict((r,' '+r) for r in _RESNAMES.values())
+
+
+def _rz(angle):
+	"""
+	(...,3,3) rotations about z by angle (...) in radians
+	"""
+	c=np.cos(angle);s=np.sin(angle)
+	zero=np.zeros_like(c);one=np.ones_like(c)
+	return(np.stack([np.stack([c,-s,zero],axis=-1),np.stack([s,c,zero],axis=-1),np.stack([zero,zero,one],axis=-1)],axis=-2))
+
+def _ry(angle):
+	"""
+	(...,3,3) rotations about y by angle (...) in radians
+	"""
+	c=np.cos(angle);s=np.sin(angle)
+	zero=np.zeros_like(c);one=np.ones_like(c)
+	return(np.stack([np.stack([c,zero,s],axis=-1),np.stack([zero,one,zero],axis=-1),np.stack([-s,zero,c],axis=-1)],axis=-2))
+
+def step_transform(pars):
+	"""
+	Inverse of dna_geometry.step_params, vectorized over leading dimensions.
+
+	pars - (...,6) Shift, Slide, Rise (A), Tilt, Roll, Twist (degrees)
+	(or Shear, Stretch, Stagger, Buckle, Propeller, Opening).
+
+	Return
+	--------
+	rot - (...,3,3) frame 2 in frame 1: R2=R1.rot.
+	trans - (...,3) origin 2 in frame 1: o2=o1+R1.trans.
+	mid - (...,3,3) middle frame in frame 1.
+	"""
+	pars=np.asarray(pars,dtype=np.float64)
+	tilt,roll,twist=[np.radians(pars[...,k]) for k in (3,4,5)]
+	bend=np.hypot(tilt,roll)
+	phi=np.arctan2(tilt,roll)
+	first=_rz(0.5*twist-phi)
+	rot=np.matmul(np.matmul(first,_ry(bend)),_rz(0.5*twist+phi))
+	mid=np.matmul(np.matmul(first,_ry(0.5*bend)),_rz(phi))
+	trans=np.einsum('...ij,...j->...i',mid,pars[...,:3])
+	return(rot,trans,mid)
+
+def bp_frames(params):
+	"""
+	Base-pair frames from step parameters, the first pair is at the origin with identity axes.
+
+	params - (...,n_bp,12) in the order of PAR_COLUMNS, row i holds the step between pairs i-1 and i
+	(step parameters of the first row are not used).
+
+	Return
+	--------
+	axes - (...,n_bp,3,3), columns are x,y,z axes. origins - (...,n_bp,3).
+	"""
+	params=np.asarray(params,dtype=np.float64)
+	nbp=params.shape[-2]
+	rot,trans,_=step_transform(np.nan_to_num(params[...,6:]))
+	axes=np.empty(params.shape[:-1]+(3,3))
+	origins=np.empty(params.shape[:-1]+(3,))
+	axes[...,0,:,:]=np.eye(3)
+	origins[...,0,:]=0.0
+	for i in range(1,nbp):
+		axes[...,i,:,:]=np.matmul(axes[...,i-1,:,:],rot[...,i,:,:])
+		origins[...,i,:]=origins[...,i-1,:]+np.einsum('...ij,...j->...i',axes[...,i-1,:,:],trans[...,i,:])
+	return(axes,origins)
+
+def base_frames(params):
+	"""
+	Frames of the bases of antiparallel pairs, as fit_base_frames would find them.
+
+	params - (...,n_bp,12) in the order of PAR_COLUMNS.
+
+	Return
+	--------
+	axes1, origins1 - (...,n_bp,3,3) and (...,n_bp,3) of strand I bases.
+	axes2, origins2 - the same for the complementary bases of strand II (in the order of pairs).
+	"""
+	params=np.asarray(params,dtype=np.float64)
+	bp_axes,bp_origins=bp_frames(params)
+	rot,trans,mid=step_transform(np.nan_to_num(params[...,:6]))
+	#base_pair_frames measures strand I base from the turned over strand II base, the pair frame is the middle one
+	axes2=np.matmul(bp_axes,np.swapaxes(mid,-1,-2))
+	axes1=np.matmul(axes2,rot)
+	shift=np.einsum('...ij,...j->...i',axes2,trans)
+	origins2=bp_origins-0.5*shift
+	origins1=origins2+shift
+	axes2=axes2*np.array([1.0,-1.0,-1.0])
+	return(axes1,origins1,axes2,origins2)
+
+def params_from_dataframe(data_frame):
+	"""
+	Returns (n_bp,12) array of PAR_COLUMNS from a data frame of X3DNA_analyze, NaN are replaced by 0 as in gen_bp_step
+	"""
+	return(data_frame[PAR_COLUMNS].astype(float).fillna(0.0).values)
+
+def backbone_templates(coords,topology,atoms=None):
+	"""
+	Derives STD_BACKBONE-like templates from a structure: coordinates of atoms
+	in the fitted base frames averaged over residues of every base type.
+
+	coords - (n_atoms,3), topology - dna_geometry.BaseTopology.
+	Returns dict base -> OrderedDict atom name -> (x,y,z).
+	"""
+	atoms=atoms or list(STD_BACKBONE['A'].keys())
+	origins,axes=fit_base_frames(coords,topology)
+	res={}
+	for base in 'AGCT':
+		members=[k for k,b in enumerate(topology.bases) if b==base]
+		template=OrderedDict()
+		for a in atoms:
+			ks=[k for k in members if a in topology.atoms[k]]
+			if ks:
+				local=np.einsum('kji,kj->ki',axes[ks],coords[[topology.atoms[k][a] for k in ks]]-origins[ks])
+				template[a]=tuple(local.mean(axis=0))
+		if members:
+			res[base]=template
+	return(res)
+
+
+class DNARebuilder(object):
+	"""
+	Atomic model of a DNA duplex with a fixed sequence, placed for any number of parameter sets.
+
+	Strand I is chain A with resids 1..N, strand II is chain B with resids N+1..2N
+	going 5'-3', i.e. from the complement of the last pair to the complement of the first one.
+
+	Attributes
+	----------
+	bpnames - base pair names like A-T.
+	names, resnames, resids, chains - per atom topology.
+	"""
+
+	def __init__(self,sequence,backbone=True,backbone_atoms=None):
+		"""
+		sequence - bases of strand I ('ATGC' or a list) or base pair names ['A-T',...].
+		backbone - place the sugar-phosphate atoms, otherwise only base atoms with C1'.
+		backbone_atoms - templates as returned by backbone_templates, STD_BACKBONE by default.
+		"""
+		seq1=[s.strip()[0].upper() for s in sequence]
+		seq2=[s.strip()[-1].upper() if len(s.strip())>1 else COMPLEMENT[s.strip().upper()] for s in sequence]
+		self.bpnames=['%s-%s'%(a,b) for a,b in zip(seq1,seq2)]
+		templates=backbone_atoms or STD_BACKBONE
+		nbp=len(seq1)
+		#residues in output order: (strand, pair, base)
+		residues=[(0,i,seq1[i]) for i in range(nbp)]+[(1,i,seq2[i]) for i in range(nbp-1,-1,-1)]
+		self.names=[];self.resnames=[];self.resids=[];self.chains=[]
+		slot=[];local=[]
+		for r,(strand,i,base) in enumerate(residues):
+			atoms=OrderedDict()
+			if backbone:
+				atoms.update(templates[base])
+			atoms.update(STD_BASES[base])
+			for name,xyz in atoms.items():
+				self.names.append(name)
+				self.resnames.append(_RESNAMES[base])
+				self.resids.append(r+1)
+				self.chains.append('AB'[strand])
+				slot.append(strand*nbp+i)
+				local.append(xyz)
+		self._slot=np.array(slot,dtype=np.int64)
+		self._local=np.array(local,dtype=np.float64).reshape(-1,3)
+		self._writer=None
+
+	def __len__(self):
+		return(len(self.names))
+
+	def topology(self):
+		"""
+		dna_geometry.BaseTopology of the model, e.g. to analyze built structures
+		"""
+		return(BaseTopology(self.names,self.resnames,self.resids,self.chains))
+
+	def pairs(self):
+		"""
+		(n_bp,2) positions of paired residues in topology()
+		"""
+		nbp=len(self.bpnames)
+		return(np.column_stack([np.arange(nbp),2*nbp-1-np.arange(nbp)]))
+
+	def build(self,params):
+		"""
+		Returns atomic coordinates for parameters, (structures,n_bp,12) -> (structures,n_atoms,3)
+		or (n_bp,12) -> (n_atoms,3), columns in the order of PAR_COLUMNS.
+		"""
+		params=np.asarray(params,dtype=np.float64)
+		if params.shape[-2:]!=(len(self.bpnames),12):
+			raise ValueError('Expected (...,%d,12) parameters, got %s'%(len(self.bpnames),params.shape))
+		axes1,origins1,axes2,origins2=base_frames(params)
+		axes=np.concatenate([axes1,axes2],axis=-3)[...,self._slot,:,:]
+		origins=np.concatenate([origins1,origins2],axis=-2)[...,self._slot,:]
+		return(origins+np.einsum('...nij,nj->...ni',axes,self._local))
+
+	def writer(self):
+		"""
+		pdb_io.PDBWriter for the model, made once
+		"""
+		if self._writer is None:
+			self._writer=PDBWriter(self.names,self.resnames,self.resids,chains=self.chains,
+				elements=[n.lstrip('0123456789')[0] for n in self.names],resname_map=_PDB_RESNAMES)
+		return(self._writer)
+
+	def write_pdb(self,params,filenames):
+		"""
+		Builds (structures,n_bp,12) parameters and writes every structure to the corresponding file
+		"""
+		xyz=self.build(params)
+		if xyz.ndim==2:
+			xyz=xyz[np.newaxis]
+			filenames=[filenames] if isinstance(filenames,str) else filenames
+		writer=self.writer()
+		for frame,f in zip(xyz,filenames):
+			writer.write(frame,f)
+
+
+def format_par(bpnames,params):
+	"""
+	Returns the text of a .par file (the format of gen_bp_step and rebuild of X3DNA)
+	for (n_bp,12) parameters, NaN are written as 0.000
+	"""
+	params=np.nan_to_num(np.asarray(params,dtype=np.float64))
+	nbp=len(bpnames)
+	header=('  %d # base-pairs\n'%nbp+'    0 # ***local base-pair & step parameters***\n'
+		' #        Shear    Stretch   Stagger   Buckle   Prop-Tw   Opening     Shift     Slide     Rise      Tilt      Roll      Twist\n')
+	if nbp==0:
+		return(header)
+	#every number is ' %9.3f', formatted for all values at once
+	fields=np.full((nbp,12,10),ord(' '),dtype=np.uint8)
+	fields[:,:,1:]=format_fixed(params,9,3)
+	names=np.array([list(('%-4s'%n)[:4].encode('ascii')) for n in bpnames],dtype=np.uint8)
+	lines=np.concatenate([names,fields.reshape(nbp,120),np.full((nbp,1),ord('\n'),dtype=np.uint8)],axis=1)
+	return(header+lines.tobytes().decode('ascii'))
+
+def write_par(filename,bpnames,params):
+	"""
+	Writes (n_bp,12) parameters to a .par file, see format_par
+	"""
+	with open(filename,'w') as f:
+		f.write(format_par(bpnames,params))
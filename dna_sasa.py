@@ -0,0 +1,277 @@
+"""
+Shrake-Rupley solvent accessible surface area in NumPy.
+
+Every atom is a sphere of its van der Waals radius plus the probe radius,
+a fixed set of points is put on it, and the SASA of the atom is the part of its
+sphere area whose points are not inside any neighboring sphere.
+Neighbors are found with a half shell cell list (or scipy cKDTree if installed, which is faster),
+compute_frames reuses one neighbor list over frames while atoms move less than half a skin.
+The buried test for all points of a pair of atoms is one matrix product:
+point x_i+R_i*s is inside sphere j if s.d < (R_j^2-R_i^2-|d|^2)/(2R_i), d=x_i-x_j.
+Radii are assigned once per topology from a NACCESS-style radii file
+(vdw_set_select sets of dna_param) or by element.
+
+Usage:
+engine=SASAEngine.from_atomsel(DNA_atomsel,probe_size=1.4)
+sasa=engine.compute(xyz)                   # (n_atoms,) in A^2
+table=engine.table(xyz)                    # same columns as dna_param.parse_asa
+"""
+import numpy as np
+import pandas as pd
+
+try:
+	from scipy.spatial import cKDTree
+except ImportError:
+	cKDTree=None
+
+#Radii used for atoms that are not in the radii set, by the first letter of the element
+ELEMENT_RADII={'C':1.80,'N':1.60,'O':1.40,'S':1.85,'P':1.90,'H':1.10}
+DEFAULT_RADIUS=1.80
+
+_sphere_cache={}
+
+def sphere_points(n):
+	"""
+	Returns (n,3) nearly uniform points on the unit sphere (golden section spiral)
+	"""
+	if n not in _sphere_cache:
+		k=np.arange(n)+0.5
+		z=1-2*k/n
+		r=np.sqrt(1-z*z)
+		phi=np.pi*(3-np.sqrt(5))*k
+		_sphere_cache[n]=np.column_stack([r*np.cos(phi),r*np.sin(phi),z])
+	return(_sphere_cache[n])
+
+def read_radii(file):
+	"""
+	Reads radii file in NACCESS format:
+	RESIDUE ATOM  DA   22
+	ATOM  P     1.90  ...
+	Return
+	--------
+	dict (resname,atom name) -> radius
+	"""
+	radii={}
+	resname=None
+	with open(file,'r') as f:
+		for line in f:
+			tokens=line.split()
+			if not tokens or tokens[0].startswith('#'):
+				continue
+			if tokens[0]=='RESIDUE' and len(tokens)>=3:
+				resname=tokens[2]
+			elif tokens[0]=='ATOM' and len(tokens)>=3 and resname is not None:
+				radii[(resname,tokens[1])]=float(tokens[2])
+	return(radii)
+
+def atom_radii(names,resnames,elements=None,radii=None):
+	"""
+	Returns (n_atoms,) van der Waals radii: from radii dict (resname,name) if present there,
+	otherwise from ELEMENT_RADII by element (or the first letter of the name).
+	"""
+	radii=radii or {}
+	res=np.empty(len(names))
+	for i,(name,resname) in enumerate(zip(names,resnames)):
+		name=str(name).strip()
+		resname=str(resname).strip()
+		r=radii.get((resname,name))
+		if r is None:
+			element=str(elements[i]).strip() if elements is not None else ''
+			element=element or name.lstrip('0123456789')[:1]
+			r=ELEMENT_RADII.get(element.upper()[:1],DEFAULT_RADIUS)
+		res[i]=r
+	return(res)
+
+
+def neighbor_pairs(xyz,cutoff):
+	"""
+	Returns (i,j) arrays of all pairs i!=j closer than cutoff, sorted by i.
+	Uses scipy cKDTree if available, otherwise a cell list.
+	"""
+	xyz=np.asarray(xyz,dtype=np.float64)
+	n=len(xyz)
+	if n==0:
+		return(np.zeros(0,dtype=np.int64),np.zeros(0,dtype=np.int64))
+	if cKDTree is not None:
+		tree=cKDTree(xyz)
+		try:
+			pairs=tree.query_pairs(cutoff,output_type='ndarray')
+		except TypeError:
+			#older scipy returns a set of tuples
+			pairs=np.array(sorted(tree.query_pairs(cutoff)),dtype=np.int64).reshape(-1,2)
+		i=np.concatenate([pairs[:,0],pairs[:,1]])
+		j=np.concatenate([pairs[:,1],pairs[:,0]])
+	else:
+		i,j=_cell_list_pairs(xyz,cutoff)
+	order=np.argsort(i,kind='mergesort')
+	return(i[order].astype(np.int64),j[order].astype(np.int64))
+
+def _cell_list_pairs(xyz,cutoff):
+	"""
+	Cell list search: atoms are binned into cubes of size cutoff,
+	pairs are looked for in the cell itself and 13 of its 26 neighbors (half shell),
+	every pair is found once and returned in both orders.
+	"""
+	cell=np.floor((xyz-xyz.min(axis=0))/cutoff).astype(np.int64)
+	dims=cell.max(axis=0)+3
+	#shift by one so that neighbor cells of border cells have valid ids
+	cell+=1
+	cid=(cell[:,0]*dims[1]+cell[:,1])*dims[2]+cell[:,2]
+	order=np.argsort(cid,kind='mergesort')
+	sorted_cid=cid[order]
+	ii=[];jj=[]
+	offsets=[(dx,dy,dz) for dx in (-1,0,1) for dy in (-1,0,1) for dz in (-1,0,1) if (dx,dy,dz)>=(0,0,0)]
+	for dx,dy,dz in offsets:
+		ncid=cid+(dx*dims[1]+dy)*dims[2]+dz
+		start=np.searchsorted(sorted_cid,ncid,side='left')
+		stop=np.searchsorted(sorted_cid,ncid,side='right')
+		count=stop-start
+		if not count.any():
+			continue
+		a=np.repeat(np.arange(len(xyz)),count)
+		#positions start..stop-1 for every atom
+		offs=np.arange(count.sum())-np.repeat(np.cumsum(count)-count,count)
+		b=order[np.repeat(start,count)+offs]
+		if (dx,dy,dz)==(0,0,0):
+			keep=a<b
+			a=a[keep];b=b[keep]
+		ii.append(a);jj.append(b)
+	i=np.concatenate(ii);j=np.concatenate(jj)
+	d2=((xyz[i]-xyz[j])**2).sum(axis=1)
+	keep=d2<cutoff*cutoff
+	i=i[keep];j=j[keep]
+	return(np.concatenate([i,j]),np.concatenate([j,i]))
+
+
+class SASAEngine(object):
+	"""
+	Per atom SASA for a fixed set of atoms.
+
+	Attributes
+	----------
+	radii - (n_atoms,) van der Waals radii.
+	probe_size - probe radius.
+	points - (n_points,3) unit sphere points.
+	names, resnames, resids, chains - topology for table(), may be None.
+	"""
+
+	def __init__(self,radii,probe_size=1.4,n_points=256,names=None,resnames=None,resids=None,chains=None,block=4000000):
+		"""
+		radii - per atom van der Waals radii (see atom_radii).
+		n_points - points per sphere, more points give smaller error (about 1% at 256).
+			Without scipy the 9346 nucleosome DNA atoms take about 0.55 s per frame at 256 points
+			and 0.5 s at 100 points: the neighbor search and pair filtering do not depend on n_points,
+			so fewer points save little and cost accuracy (a few % at 100).
+		block - number of pair x point tests done at once, limits memory.
+		"""
+		self.radii=np.asarray(radii,dtype=np.float64)
+		self.probe_size=probe_size
+		self.points=sphere_points(n_points)
+		self.names=names
+		self.resnames=resnames
+		self.resids=resids
+		self.chains=chains
+		self.block=block
+		self._R=self.radii+probe_size
+
+	@classmethod
+	def from_atomsel(cls,DNA_atomsel,probe_size=1.4,radii_file=None,name_map=None,resname_map=None,**kwargs):
+		"""
+		Builds the engine for a selection (VMD atomsel or backends.Structure),
+		radii come from radii_file (NACCESS format) where possible.
+		name_map, resname_map - renames applied before the radii lookup, e.g. pdb_io.PDB_ATOM_NAMES.
+		"""
+		name_map=name_map or {}
+		resname_map=resname_map or {}
+		names=[name_map.get(n,n) for n in DNA_atomsel.get('name')]
+		resnames=[resname_map.get(r,r) for r in DNA_atomsel.get('resname')]
+		try:
+			elements=DNA_atomsel.get('element')
+		except Exception:
+			elements=None
+		radii=atom_radii(names,resnames,elements,read_radii(radii_file) if radii_file else None)
+		return(cls(radii,probe_size=probe_size,names=names,resnames=resnames,resids=DNA_atomsel.get('resid'),
+			chains=DNA_atomsel.get('chain'),**kwargs))
+
+	def compute(self,xyz):
+		"""
+		Returns (n_atoms,) SASA in A^2 for (n_atoms,3) coordinates
+		"""
+		xyz=np.asarray(xyz,dtype=np.float64)
+		if len(xyz)<2:
+			return(self._sasa(xyz,None,None))
+		i,j=neighbor_pairs(xyz,2*self._R.max())
+		return(self._sasa(xyz,i,j))
+
+	def compute_frames(self,frames_xyz,skin=2.0):
+		"""
+		Returns (n_frames,n_atoms) SASA for an iterable of (n_atoms,3) coordinates.
+		The neighbor list is built with cutoff 2*max(R)+skin and reused for the following frames
+		until an atom has moved by more than skin/2 from where the list was built (Verlet list).
+		If the list has to be rebuilt on two frames in a row (frames saved far apart),
+		the skin is dropped and the list is built for every frame as compute does.
+		"""
+		res=[]
+		ref=None
+		last_build=None
+		for k,xyz in enumerate(frames_xyz):
+			xyz=np.asarray(xyz,dtype=np.float64)
+			if len(xyz)<2:
+				res.append(self._sasa(xyz,None,None))
+				continue
+			if ref is None or ((xyz-ref)**2).sum(axis=1).max()>(skin/2.)**2:
+				if last_build==k-1:
+					skin=0.
+				i,j=neighbor_pairs(xyz,2*self._R.max()+skin)
+				ref=xyz.copy()
+				last_build=k
+			res.append(self._sasa(xyz,i,j))
+		return(np.array(res))
+
+	def _sasa(self,xyz,i,j):
+		"""
+		SASA for coordinates and candidate neighbor pairs (i,j) sorted by i, pairs that do not overlap are skipped.
+		"""
+		n=len(xyz)
+		R=self._R
+		npts=len(self.points)
+		exposed=np.ones((n,npts),dtype=bool)
+		if i is not None and len(i):
+			d=xyz[i]-xyz[j]
+			d2=(d*d).sum(axis=1)
+			close=d2<(R[i]+R[j])**2
+			i=i[close];j=j[close];d=d[close];d2=d2[close]
+			thr=((R[j]**2-R[i]**2-d2)/(2*R[i])).astype(np.float32)
+			#single precision is enough for the point tests (errors ~1e-6 A) and halves the matrix product time
+			d=d.astype(np.float32)
+			points=self.points.T.astype(np.float32)
+			#pairs are sorted by i, so every block covers whole atoms except at its ends,
+			#buried points are accumulated with bitwise_or.reduceat per atom; the 0/1 bytes of the
+			#boolean rows are viewed as uint64 words so one OR handles 8 points
+			word=np.uint64 if npts%8==0 else np.uint8
+			buried_atom=np.zeros((n,npts),dtype=bool)
+			words=buried_atom.view(word)
+			step=max(1,self.block//npts)
+			for start in range(0,len(i),step):
+				stop=min(len(i),start+step)
+				buried=np.dot(d[start:stop],points)<thr[start:stop,np.newaxis]
+				ib=i[start:stop]
+				first=np.concatenate([[0],np.nonzero(np.diff(ib))[0]+1])
+				words[ib[first]]|=np.bitwise_or.reduceat(buried.view(word),first,axis=0)
+			exposed=~buried_atom
+		return(4*np.pi*R**2*exposed.mean(axis=1))
+
+	def table(self,xyz,sasa=None):
+		"""
+		Returns per atom data frame with the columns of NACCESS .asa files
+		(ATOM,atnum,name,resname,chain,resid,x,y,z,SASA,VdW), as dna_param.parse_asa does.
+		"""
+		xyz=np.asarray(xyz,dtype=np.float64)
+		if sasa is None:
+			sasa=self.compute(xyz)
+		n=len(xyz)
+		return(pd.DataFrame({'ATOM':['ATOM']*n,'atnum':np.arange(1,n+1),
+			'name':[str(x).strip() for x in self.names],'resname':[str(x).strip() for x in self.resnames],
+			'chain':[str(x).strip() for x in self.chains],'resid':np.asarray(self.resids,dtype=np.int64),
+			'x':xyz[:,0],'y':xyz[:,1],'z':xyz[:,2],'SASA':sasa,'VdW':self.radii},
+			columns=['ATOM','atnum','name','resname','chain','resid','x','y','z','SASA','VdW']))
@@ -0,0 +1,233 @@
+"""
+Command line analysis of a trajectory split into shards, for batch systems.
+
+Every shard is a --first/--last/--step range of DCD frames (or the K-th of N equal parts of it),
+analyzed in plain Python (backends.Structure, no VMD) and saved as a TrajectoryResults .npz file
+that describes itself: frame numbers, reference find_pair output and pairs, analysis settings.
+The merge command checks that the shards were made with the same settings and reference,
+that no frame is missing or analyzed twice, and writes the full per-frame and averaged tables.
+
+Usage (e.g. as a SLURM array job with 16 tasks):
+python dna_shard.py analyze --pdb only_nucl_init.pdb --dcd md.dcd --first 1 --shard $SLURM_ARRAY_TASK_ID --shards 16 --out shards/
+python dna_shard.py merge shards/*.npz --out MD_DNAparam_1kx5
+"""
+from __future__ import print_function
+
+import argparse
+import functools
+import os
+import sys
+import time
+import uuid
+
+import numpy as np
+
+from backends import Structure
+from traj_results import TrajectoryResults, merge_results
+from traj_stats import BPStats
+import dna_param
+
+#Residue names of CHARMM converted as in analyzeMD.vmdpy
+CONV_RES={'CYT':'DC','GUA':'DG','THY':'DT','ADE':'DA'}
+
+#Settings that have to be the same in all shards to merge them,
+#program signatures (path, size, mtime) may differ between nodes
+_MERGE_KEYS=['reference','analyze','args','keywords']
+
+
+def shard_frames(first,last,step,shard=None,shards=None):
+	"""
+	Frames first..last (inclusive) with step, or the shard-th (from 0) of shards contiguous parts of them
+	"""
+	frames=list(range(first,last+1,step))
+	if shards is None:
+		return(frames)
+	if not 0<=shard<shards:
+		raise ValueError('shard should be in 0..%d, not %d'%(shards-1,shard))
+	bounds=np.linspace(0,len(frames),shards+1).round().astype(int)
+	return(frames[bounds[shard]:bounds[shard+1]])
+
+def load_structure(pdb,dcd=None):
+	"""
+	Nucleic acids of the pdb as backends.Structure, names converted as in analyzeMD.vmdpy
+	"""
+	DNA=Structure.from_pdb(pdb).nucleic()
+	DNA.set('resname',[CONV_RES.get(r,r) for r in DNA.get('resname')])
+	DNA.set('chain',[s[2:] if len(s)>2 else (c or s) for s,c in zip(DNA.get('segname'),DNA.get('chain'))])
+	if dcd:
+		DNA.load_dcd(dcd)
+	return(DNA)
+
+def _analysis(backend,stages):
+	"""
+	Analysis function for analyze_trajectory and the stages it computes,
+	the native backend gives base-pair and step parameters only
+	"""
+	if backend=='native':
+		if stages not in (None,'bp_step'):
+			raise ValueError('--backend native computes only bp_step, not --stages %s'%stages)
+		return(functools.partial(dna_param.X3DNA_analyze_bp_step,backend='native'),'bp_step')
+	stages=stages or 'full'
+	return(functools.partial(dna_param.X3DNA_analyze,stages=stages),stages)
+
+def _check_resume(filename,settings,pairs):
+	"""
+	Raises ValueError if the shard file to resume from was made with other settings or reference pairs
+	"""
+	attrs=TrajectoryResults.load(filename).attrs
+	for k in _MERGE_KEYS:
+		if attrs.get('settings',{}).get(k)!=settings.get(k):
+			raise ValueError('%s was made with other analysis settings (%s), it can not be resumed'%(filename,k))
+	if attrs.get('pairs')!=pairs:
+		raise ValueError('%s was made with other reference pairs, it can not be resumed'%filename)
+
+def _reference(DNA,reference=None):
+	"""
+	Returns ref_fp_id: a copy of the given find_pair output in TEMP, or find_pair run on the current coordinates.
+	The pdb and output names in the first two lines of the copy are ref_fp_id+'.pdb' and ref_fp_id+'.outs',
+	as in the output of X3DNA_find_pair, so that _write_from_reference points them to every frame.
+	"""
+	if reference is None:
+		return(dna_param.X3DNA_find_pair(DNA))
+	ref_fp_id=str(uuid.uuid4())
+	with open(reference,'r') as f:
+		lines=f.read().splitlines()
+	if len(lines)<2:
+		raise ValueError('%s is not a find_pair output'%reference)
+	lines[0]=ref_fp_id+'.pdb'
+	lines[1]=ref_fp_id+'.outs'
+	with open(os.path.join(dna_param.TEMP,ref_fp_id),'w') as f:
+		f.write('\n'.join(lines)+'\n')
+	return(ref_fp_id)
+
+def analyze_shard(args):
+	DNA=load_structure(args.pdb)
+	#the reference is the structure of the pdb file, as in analyzeMD.vmdpy
+	ref_fp_id=_reference(DNA,args.reference)
+	DNA.load_dcd(args.dcd)
+	last=DNA.n_frames-1 if args.last is None else min(args.last,DNA.n_frames-1)
+	frames=shard_frames(args.first,last,args.step,args.shard,args.shards)
+	analyze,stages=_analysis(args.backend,args.stages)
+
+	store=TrajectoryResults(frames)
+	settings=dna_param.analysis_settings(ref_fp_id,analyze)
+	pairs=dna_param.parse_find_pair(os.path.join(dna_param.TEMP,ref_fp_id)).tolist()
+	store.attrs=dict(first=args.first,last=last,step=args.step,shard=args.shard,shards=args.shards,
+		frames=frames,pdb=os.path.abspath(args.pdb),dcd=os.path.abspath(args.dcd),
+		pairs=pairs,settings=settings,backend=args.backend,stages=stages,started=time.strftime('%Y-%m-%d %H:%M:%S'))
+	out=args.out
+	if out.endswith(os.sep) or os.path.isdir(out):
+		if not os.path.isdir(out):
+			os.makedirs(out)
+		name='shard_%06d_%06d.npz'%(frames[0],frames[-1]) if frames else 'shard_empty.npz'
+		out=os.path.join(out,name)
+	if os.path.exists(out):
+		if args.resume:
+			_check_resume(out,settings,pairs)
+		else:
+			os.remove(out)
+	#the output is also the checkpoint, partial results are saved there during the run
+	dna_param.analyze_trajectory(frames,DNA,ref_fp_id,workers=args.workers,chunksize=args.chunksize,analyze=analyze,
+		out=store,cache=args.cache,checkpoint=out,shared=args.shared,log_level=args.log_level,timing_log=args.timing_log)
+	store.attrs['finished']=time.strftime('%Y-%m-%d %H:%M:%S')
+	store.save(out)
+	dna_param.log('Saved %d frames to %s'%(int(store.filled.sum()),out))
+	return(out)
+
+def _check_shards(stores,files):
+	"""
+	Raises ValueError if shards have different settings or references, returns the expected frames
+	"""
+	first=stores[0].attrs
+	if not first:
+		raise ValueError('%s is not a shard: it has no settings'%files[0])
+	expected=set()
+	for store,f in zip(stores,files):
+		attrs=store.attrs
+		for k in _MERGE_KEYS:
+			if attrs.get('settings',{}).get(k)!=first.get('settings',{}).get(k):
+				raise ValueError('%s and %s differ in analysis settings (%s)'%(files[0],f,k))
+		if attrs.get('pairs')!=first.get('pairs'):
+			raise ValueError('%s and %s have different reference pairs'%(files[0],f))
+		expected.update(attrs.get('frames',store.frames.tolist()))
+	return(sorted(expected))
+
+def merge_shards(args):
+	stores=[TrajectoryResults.load(f) for f in args.shards]
+	expected=_check_shards(stores,args.shards)
+	if args.first is not None or args.last is not None:
+		attrs=stores[0].attrs
+		first=attrs['first'] if args.first is None else args.first
+		last=attrs['last'] if args.last is None else args.last
+		expected=sorted(set(expected)|set(range(first,last+1,args.step or attrs['step'])))
+	#merge_results raises if a frame is in two shards
+	store=merge_results(stores)
+	missing=store.missing(expected)
+	if missing:
+		msg='%d frames are missing, e.g. %s'%(len(missing),missing[:10])
+		if not args.allow_missing:
+			raise ValueError(msg)
+		print('WARNING: '+msg)
+	store.attrs.update(shards=[os.path.abspath(f) for f in args.shards],frames=store.frames.tolist(),missing=missing)
+	for k in ('shard','first','last','started','finished'):
+		store.attrs.pop(k,None)
+	store.save(args.out+'.npz')
+	store.to_dataframe().to_csv(args.out+'.csv')
+	#angles like Twist and torsions are averaged on a circle
+	stats=BPStats(bp=store.bp,params=store.params)
+	stats.update_block(store.data[store.filled])
+	stats.save(args.out+'_stats.npz')
+	stats.to_dataframe().to_csv(args.out+'_avr.csv')
+	print('Merged %d frames from %d shards into %s'%(len(store.frames),len(stores),args.out))
+	return(store)
+
+def main(argv=None):
+	parser=argparse.ArgumentParser(description='Sharded DNA parameter analysis of MD trajectories')
+	sub=parser.add_subparsers(dest='command')
+
+	a=sub.add_parser('analyze',help='analyze a range of frames of a DCD and save a partial result')
+	a.add_argument('--pdb',required=True,help='structure, also the reference for find_pair')
+	a.add_argument('--dcd',required=True,help='trajectory')
+	a.add_argument('--first',type=int,default=0,help='first frame (from 0)')
+	a.add_argument('--last',type=int,default=None,help='last frame, inclusive (default the last one)')
+	a.add_argument('--step',type=int,default=1)
+	a.add_argument('--shard',type=int,default=None,help='analyze only this part (from 0) of the frames, e.g. $SLURM_ARRAY_TASK_ID')
+	a.add_argument('--shards',type=int,default=None,help='number of parts the frames are split into')
+	a.add_argument('--out',required=True,help='output .npz file or directory')
+	a.add_argument('--reference',default=None,help='find_pair output to use instead of running find_pair on the pdb')
+	a.add_argument('--backend',choices=['x3dna','native'],default='x3dna',help='native - base-pair and step parameters in process')
+	a.add_argument('--stages',default=None,help='profile of X3DNA_analyze (%s), full by default, '
+		'only bp_step with --backend native'%', '.join(sorted(dna_param.PROFILES)))
+	a.add_argument('--workers',type=int,default=None,help='worker processes, default one per core')
+	a.add_argument('--chunksize',type=int,default=1)
+	a.add_argument('--cache',default=None,help='ResultCache directory')
+	a.add_argument('--shared',action='store_true',help='workers read frames from memory-mapped files (the DCD file here) instead of their own copies')
+	a.add_argument('--resume',action='store_true',help='continue from the output file of a killed run instead of starting anew')
+	a.add_argument('--log-level',choices=['quiet','normal','verbose'],default=None,
+		help='quiet - output of X3DNA is printed only if it fails (default from DNA_PARAM_LOG or normal)')
+	a.add_argument('--timing-log',default=None,help='append per frame timing of every stage to this JSON lines file and print a summary')
+
+	m=sub.add_parser('merge',help='combine shards into the full per frame and averaged tables')
+	m.add_argument('shards',nargs='+',help='.npz files written by analyze')
+	m.add_argument('--out',required=True,help='output prefix: PREFIX.npz, PREFIX.csv, PREFIX_avr.csv, PREFIX_stats.npz')
+	m.add_argument('--first',type=int,default=None,help='expected first frame of the whole run')
+	m.add_argument('--last',type=int,default=None,help='expected last frame of the whole run')
+	m.add_argument('--step',type=int,default=None)
+	m.add_argument('--allow-missing',action='store_true',help='only warn about missing frames')
+
+	args=parser.parse_args(argv)
+	if args.command=='analyze':
+		if (args.shard is None)!=(args.shards is None):
+			parser.error('--shard and --shards go together')
+		if args.backend=='native' and args.stages not in (None,'bp_step'):
+			parser.error('--backend native computes only bp_step, --stages %s needs --backend x3dna'%args.stages)
+		analyze_shard(args)
+	elif args.command=='merge':
+		merge_shards(args)
+	else:
+		parser.print_help()
+		return(1)
+	return(0)
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,157 @@
+"""
+Vectorized PDB writer that reuses the topology between frames.
+
+Everything in an ATOM line except coordinates (record name, serial, atom and residue names,
+chain, resid, occupancy, beta, segment, element) is formatted once, when the writer is created,
+into a (n_atoms,79) byte array. For every frame only the x,y,z columns are filled in
+with NumPy integer arithmetic, without Python loops over atoms.
+The result can go to a file (e.g. under /dev/shm), a file object or a memory buffer.
+
+Usage:
+writer=PDBWriter.from_atomsel(DNA_atomsel,name_map=PDB_ATOM_NAMES)
+writer.write(xyz,'/dev/shm/frame.pdb')
+buf=writer.to_buffer(xyz)  # io.BytesIO
+"""
+import io
+
+import numpy as np
+
+#CHARMM to PDB v3 names of atoms and DNA residues
+PDB_ATOM_NAMES={'O1P':'OP1','O2P':'OP2','C5M':'C7','H51':'H71','H52':'H72','H53':'H73'}
+PDB_RESNAMES={'CYT':'DC','GUA':'DG','THY':'DT','ADE':'DA'}
+
+#PDB columns of coordinates, 0-based and each 8 characters wide
+_COORD_START=30
+_COORD_WIDTH=8
+_COORD_DECIMALS=3
+_LINE_LENGTH=79
+
+
+def _atom_name(name):
+	"""
+	Atom names shorter than 4 characters start in column 14 as in the PDB format
+	"""
+	return(name[:4] if len(name)>=4 else ' '+name)
+
+def _wrap(number,limit):
+	"""
+	Numbers that do not fit into a PDB field are wrapped around
+	"""
+	return(number if -limit//10<number<limit else number%limit)
+
+def format_fixed(values,width=8,decimals=3):
+	"""
+	Formats numbers like '%{width}.{decimals}f' into a (...,width) uint8 array of ASCII codes,
+	vectorized over any shape of values.
+	Raises ValueError if a value does not fit into width or is not finite.
+	"""
+	values=np.asarray(values,dtype=np.float64)
+	if not np.isfinite(values).all():
+		raise ValueError('Coordinates should be finite to be written to PDB')
+	absval=np.abs(values)
+	shifted=absval*10**decimals
+	scaled=np.array(np.floor(shifted+0.5),dtype=np.int64)
+	#near ties the product is inexact, they are rounded by Python as printf would do
+	for idx in np.argwhere(np.abs(shifted-np.floor(shifted)-0.5)<1e-6):
+		idx=tuple(idx)
+		scaled[idx]=int(('%.*f'%(decimals,absval[idx])).replace('.',''))
+	neg=np.signbit(values)
+	ipart=scaled//10**decimals
+	fpart=scaled%10**decimals
+	int_width=width-decimals-1
+	ndigits=np.ones(values.shape,dtype=np.int64)
+	for k in range(1,int_width):
+		ndigits+=ipart>=10**k
+	if ((ndigits+neg)>int_width).any() or (ipart>=10**int_width).any():
+		raise ValueError('Values do not fit into %d characters'%width)
+
+	out=np.full(values.shape+(width,),ord(' '),dtype=np.uint8)
+	for k in range(decimals):
+		out[...,width-1-k]=ord('0')+(fpart//10**k)%10
+	out[...,int_width]=ord('.')
+	for k in range(int_width):
+		digit=ord('0')+(ipart//10**k)%10
+		pos=int_width-1-k
+		out[...,pos]=np.where(k<ndigits,digit,np.where((k==ndigits)&neg,ord('-'),ord(' ')))
+	return(out)
+
+
+class PDBWriter(object):
+	"""
+	Writes frames of a fixed set of atoms in PDB format.
+
+	Attributes
+	----------
+	n_atoms - number of atoms.
+	template - (n_atoms,79) uint8 array of ATOM lines with blank coordinates.
+	"""
+
+	def __init__(self,names,resnames,resids,chains=None,segids=None,elements=None,
+		occupancy=None,beta=None,serials=None,record='ATOM',name_map=None,resname_map=None,header=None):
+		"""
+		names, resnames, resids - per atom sequences.
+		chains, segids, elements - per atom sequences, blank if None.
+		occupancy, beta - per atom numbers, 1.0 and 0.0 if None.
+		serials - atom serial numbers, 1..N by default (wrapped at 100000, resids at 10000).
+		name_map, resname_map - renames applied once, e.g. PDB_ATOM_NAMES, PDB_RESNAMES.
+		header - lines written before the atoms (e.g. CRYST1), without the END record.
+		"""
+		name_map=name_map or {}
+		resname_map=resname_map or {}
+		n=len(names)
+		self.n_atoms=n
+		chains=chains if chains is not None else ['']*n
+		segids=segids if segids is not None else ['']*n
+		elements=elements if elements is not None else ['']*n
+		occupancy=occupancy if occupancy is not None else np.ones(n)
+		beta=beta if beta is not None else np.zeros(n)
+		serials=serials if serials is not None else np.arange(1,n+1)
+		self.header=header or ''
+
+		lines=[]
+		for i in range(n):
+			name=str(names[i])
+			resname=str(resnames[i])
+			line='%-6s%5d %-4s %-4s%1s%4d    %s%s%s%6.2f%6.2f      %-4s%2s\n'%(
+				record,_wrap(int(serials[i]),100000),_atom_name(name_map.get(name,name)),resname_map.get(resname,resname)[:4],
+				str(chains[i])[:1],_wrap(int(resids[i]),10000),' '*_COORD_WIDTH,' '*_COORD_WIDTH,' '*_COORD_WIDTH,
+				float(occupancy[i]),float(beta[i]),str(segids[i])[:4],str(elements[i])[:2])
+			lines.append(line)
+		self.template=np.frombuffer(''.join(lines).encode('ascii'),dtype=np.uint8).reshape(n,_LINE_LENGTH).copy()
+
+	@classmethod
+	def from_atomsel(cls,DNA_atomsel,**kwargs):
+		"""
+		Takes the topology from a VMD atomsel (NOT AtomSel!)
+		"""
+		get=DNA_atomsel.get
+		return(cls(get('name'),get('resname'),get('resid'),chains=get('chain'),segids=get('segname'),
+			elements=get('element'),occupancy=get('occupancy'),beta=get('beta'),**kwargs))
+
+	def to_bytes(self,xyz):
+		"""
+		Returns the PDB file contents for (n_atoms,3) coordinates as bytes
+		"""
+		xyz=np.asarray(xyz)
+		if xyz.shape!=(self.n_atoms,3):
+			raise ValueError('Expected (%d,3) coordinates, got %s'%(self.n_atoms,xyz.shape))
+		lines=self.template.copy()
+		lines[:,_COORD_START:_COORD_START+3*_COORD_WIDTH]=format_fixed(xyz,_COORD_WIDTH,_COORD_DECIMALS).reshape(self.n_atoms,3*_COORD_WIDTH)
+		return(self.header.encode('ascii')+lines.tobytes()+b'END\n')
+
+	def write(self,xyz,file):
+		"""
+		Writes a frame to file, a path or an object opened in binary mode
+		"""
+		data=self.to_bytes(xyz)
+		if hasattr(file,'write'):
+			file.write(data)
+		else:
+			with open(file,'wb') as f:
+				f.write(data)
+
+	def to_buffer(self,xyz):
+		"""
+		Returns the PDB file contents in a io.BytesIO buffer
+		"""
+		return(io.BytesIO(self.to_bytes(xyz)))
@@ -0,0 +1,201 @@
+"""
+Content-addressed on-disk cache of per-frame analysis results.
+
+A result is stored under a key that is a hash of the frame coordinates
+and of the analysis settings (reference pairs, stages, tool versions, etc.),
+so the same frame analyzed with the same settings is never computed twice,
+whichever run or process asks for it.
+Every entry is a separate pickle file, written to a temporary name and renamed,
+so several worker processes can share one cache directory.
+When the directory grows above max_bytes the least recently used entries are removed.
+
+Usage:
+cache=ResultCache('/tmp/dna_param_cache',settings={'ref':ref_text,'stages':'full'})
+key=cache.key(xyz)
+res=cache.get(key)
+if res is None:
+	res=analyze(...)
+	cache.put(key,res)
+"""
+import os
+import hashlib
+import pickle
+import tempfile
+
+import numpy as np
+
+
+class ResultCache(object):
+	"""
+	Size-bounded directory of pickled results keyed by coordinates and settings.
+
+	Attributes
+	----------
+	directory - where the entries are kept.
+	max_bytes - size limit of the directory, None - no limit.
+	settings - anything with a stable repr (dict, tuple of strings and numbers),
+	it is hashed into every key.
+	hits, misses - counters of get calls in this process.
+	"""
+
+	suffix='.pkl'
+
+	def __init__(self,directory,settings=None,max_bytes=2*1024**3,decimals=3):
+		"""
+		directory - cache directory, created if needed.
+		settings - analysis settings that become part of the key.
+		max_bytes - size limit of the directory.
+		decimals - coordinates are rounded to this number of decimals before hashing,
+		PDB files used by X3DNA keep three, so differences below that do not change results.
+		"""
+		self.directory=directory
+		self.max_bytes=max_bytes
+		self.decimals=decimals
+		self.settings=settings
+		self.hits=0
+		self.misses=0
+		self._added=0
+		if not os.path.isdir(directory):
+			try:
+				os.makedirs(directory)
+			except OSError:
+				if not os.path.isdir(directory):
+					raise
+		self._prefix=hashlib.sha1(repr(canonical(settings)).encode('utf-8')).digest()
+		self.evict()
+
+	def key(self,coords):
+		"""
+		Returns the key of a frame, coords - (n_atoms,3) array
+		"""
+		xyz=np.ascontiguousarray(np.round(np.asarray(coords,dtype=np.float64),self.decimals))
+		#-0.0 and 0.0 should give the same key
+		xyz+=0.0
+		h=hashlib.sha1(self._prefix)
+		h.update(str(xyz.shape).encode('ascii'))
+		h.update(xyz.tobytes())
+		return(h.hexdigest())
+
+	def _path(self,key):
+		return(os.path.join(self.directory,key+self.suffix))
+
+	def __contains__(self,key):
+		return(os.path.exists(self._path(key)))
+
+	def get(self,key,default=None):
+		"""
+		Returns the result stored under key, or default if there is none
+		"""
+		path=self._path(key)
+		try:
+			with open(path,'rb') as f:
+				res=pickle.load(f)
+		except (IOError,OSError,EOFError,pickle.UnpicklingError):
+			self.misses+=1
+			return(default)
+		#mark as recently used for eviction
+		try:
+			os.utime(path,None)
+		except OSError:
+			pass
+		self.hits+=1
+		return(res)
+
+	def put(self,key,res):
+		"""
+		Stores res under key
+		"""
+		fd,tmp=tempfile.mkstemp(dir=self.directory,prefix='.tmp_')
+		try:
+			with os.fdopen(fd,'wb') as f:
+				pickle.dump(res,f,protocol=pickle.HIGHEST_PROTOCOL)
+			size=os.path.getsize(tmp)
+			os.rename(tmp,self._path(key))
+		except:
+			if os.path.exists(tmp):
+				os.remove(tmp)
+			raise
+		self._added+=size
+		if self.max_bytes is not None and self._added>self.max_bytes//10:
+			self.evict()
+
+	def entries(self):
+		"""
+		Returns a list of (last use time,size,path) of all entries
+		"""
+		res=[]
+		for name in os.listdir(self.directory):
+			if not name.endswith(self.suffix):
+				continue
+			path=os.path.join(self.directory,name)
+			try:
+				st=os.stat(path)
+			except OSError:
+				continue
+			res.append((max(st.st_atime,st.st_mtime),st.st_size,path))
+		return(res)
+
+	def size(self):
+		"""
+		Returns total size of the entries in bytes
+		"""
+		return(sum(e[1] for e in self.entries()))
+
+	def evict(self,max_bytes=None):
+		"""
+		Removes least recently used entries until the directory is below max_bytes
+		(self.max_bytes by default), returns the number of removed entries.
+		"""
+		self._added=0
+		if max_bytes is None:
+			max_bytes=self.max_bytes
+		if max_bytes is None:
+			return(0)
+		entries=sorted(self.entries())
+		total=sum(e[1] for e in entries)
+		removed=0
+		for t,size,path in entries:
+			if total<=max_bytes:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			total-=size
+			removed+=1
+		return(removed)
+
+	def clear(self):
+		"""
+		Removes all entries
+		"""
+		return(self.evict(0))
+
+	def __repr__(self):
+		return('<ResultCache %s: %d hits, %d misses>'%(self.directory,self.hits,self.misses))
+
+
+def canonical(obj):
+	"""
+	Converts settings to a form with a stable repr (dicts and sets are sorted),
+	the repr of a set depends on the hash seed of the interpreter
+	"""
+	if isinstance(obj,dict):
+		return(tuple(sorted((repr(k),canonical(v)) for k,v in obj.items())))
+	if isinstance(obj,(set,frozenset)):
+		return(tuple(sorted(repr(canonical(v)) for v in obj)))
+	if isinstance(obj,(list,tuple)):
+		return(tuple(canonical(v) for v in obj))
+	return(obj)
+
+
+def file_signature(path):
+	"""
+	Returns (path,size,modification time) of a file or (path,None,None) if it does not exist,
+	used to make versions of external programs part of the settings.
+	"""
+	try:
+		st=os.stat(path)
+	except OSError:
+		return((path,None,None))
+	return((path,st.st_size,int(st.st_mtime)))
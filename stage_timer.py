@@ -0,0 +1,183 @@
+"""
+Timing of analysis stages and control of what is printed.
+
+Every stage of the analysis of a frame (PDB write, find_pair, analyze, parsers, SASA ...)
+is timed with TIMER.stage(name), records (frame, stage, seconds, ok) are kept per process,
+workers send theirs back with the results, and the driver aggregates them per run:
+a JSON lines log with one record per stage call and a summary table per stage.
+
+Output of external programs goes through tool_output: it is printed only at the 'verbose' level
+or when the program failed, 'quiet' also silences progress messages.
+The level is set with set_log_level or the DNA_PARAM_LOG environment variable.
+
+Usage:
+set_log_level('quiet')
+mark=TIMER.mark()
+... analyze_trajectory(...)
+TIMER.write_log('timing.jsonl',TIMER.since(mark))
+print(summary(TIMER.since(mark)))
+"""
+from __future__ import print_function
+
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+#Log levels, messages of a level are printed if it is not above the current one
+LEVELS={'quiet':0,'normal':1,'verbose':2}
+
+_state={'level':LEVELS.get(os.environ.get('DNA_PARAM_LOG','normal'),1)}
+
+def set_log_level(level):
+	"""
+	Sets what is printed: 'quiet' - only failures, 'normal' - progress, 'verbose' - also output of the programs
+	"""
+	if level not in LEVELS:
+		raise ValueError('Unknown log level %s, choose from %s'%(level,', '.join(sorted(LEVELS,key=LEVELS.get))))
+	_state['level']=LEVELS[level]
+
+def get_log_level():
+	return([k for k,v in LEVELS.items() if v==_state['level']][0])
+
+def log(message,level='normal'):
+	"""
+	Prints message if the current log level is at least level
+	"""
+	if LEVELS[level]<=_state['level']:
+		print(message)
+
+def tool_output(stage,out='',err='',returncode=0):
+	"""
+	Output of an external program run in stage: printed at the verbose level,
+	or at any level if the program returned non zero code.
+	"""
+	failed=returncode not in (0,None)
+	if failed:
+		print('%s failed with code %s'%(stage,returncode),file=sys.stderr)
+	if failed or _state['level']>=LEVELS['verbose']:
+		if out:
+			print('OUT:'+out)
+		if err:
+			print('ERR:'+err)
+
+
+class StageTimer(object):
+	"""
+	Collects timing records of stages.
+
+	Attributes
+	----------
+	records - list of dicts with frame, stage, seconds, ok and pid.
+	current_frame - frame the records are attributed to, None outside of frames.
+	"""
+
+	def __init__(self):
+		self.records=[]
+		self.current_frame=None
+
+	@contextmanager
+	def stage(self,name):
+		"""
+		Times the block as stage name, a record with ok=False is kept if it raises
+		"""
+		start=time.time()
+		ok=True
+		try:
+			yield
+		except:
+			ok=False
+			raise
+		finally:
+			self.records.append({'frame':self.current_frame,'stage':name,'seconds':time.time()-start,'ok':ok,'pid':os.getpid()})
+
+	@contextmanager
+	def frame(self,frame):
+		"""
+		Attributes stages in the block to frame, the whole block is recorded as stage 'frame'
+		"""
+		previous=self.current_frame
+		self.current_frame=frame
+		try:
+			with self.stage('frame'):
+				yield
+		finally:
+			self.current_frame=previous
+
+	def mark(self):
+		"""
+		Position in records, to get the records of a run with since
+		"""
+		return(len(self.records))
+
+	def since(self,mark):
+		return(self.records[mark:])
+
+	def pop(self):
+		"""
+		Returns and forgets all records, used by workers to send them with the results
+		"""
+		records=self.records
+		self.records=[]
+		return(records)
+
+	def extend(self,records):
+		self.records.extend(records)
+
+	def write_log(self,filename,records=None):
+		"""
+		Appends records (all by default) to a JSON lines file
+		"""
+		records=self.records if records is None else records
+		with open(filename,'a') as f:
+			for r in records:
+				f.write(json.dumps(r,sort_keys=True)+'\n')
+
+#Timer of this process
+TIMER=StageTimer()
+
+def timed(name):
+	"""
+	Decorator that times every call of a function as stage name
+	"""
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args,**kwargs):
+			with TIMER.stage(name):
+				return(func(*args,**kwargs))
+		return(wrapper)
+	return(decorator)
+
+def read_log(filename):
+	"""
+	Reads a JSON lines log written by write_log into a data frame
+	"""
+	with open(filename,'r') as f:
+		return(pd.DataFrame([json.loads(l) for l in f if l.strip()],columns=['frame','stage','seconds','ok','pid']))
+
+def summary(records):
+	"""
+	Per stage table of calls, failures, total, mean, min and max seconds
+	and the share of the total frame time, sorted by total time
+	"""
+	df=records if isinstance(records,pd.DataFrame) else pd.DataFrame(list(records),columns=['frame','stage','seconds','ok','pid'])
+	if df.empty:
+		return(pd.DataFrame(columns=['calls','failed','total','mean','min','max','share']))
+	df=df.assign(failed=~df['ok'].astype(bool))
+	g=df.groupby('stage')
+	res=pd.DataFrame({'calls':g.size(),'failed':g['failed'].sum(),'total':g['seconds'].sum(),'mean':g['seconds'].mean(),
+		'min':g['seconds'].min(),'max':g['seconds'].max()},columns=['calls','failed','total','mean','min','max'])
+	frame_total=res['total'].get('frame',0.0)
+	res['share']=res['total']/frame_total if frame_total else float('nan')
+	return(res.sort_values('total',ascending=False))
+
+def per_frame(records):
+	"""
+	Table of seconds per frame (rows) and stage (columns)
+	"""
+	df=records if isinstance(records,pd.DataFrame) else pd.DataFrame(list(records),columns=['frame','stage','seconds','ok','pid'])
+	return(df.dropna(subset=['frame']).pivot_table(index='frame',columns='stage',values='seconds',aggfunc='sum'))
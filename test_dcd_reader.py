@@ -0,0 +1,36 @@
+"""
+Frames and slices of DCDReader on md.dcd.
+
+Run with: python -m pytest -q test_dcd_reader.py
+"""
+import os
+
+import numpy as np
+import pytest
+
+from dcd_reader import DCDReader
+
+DCD=os.path.join(os.path.dirname(os.path.abspath(__file__)),'md.dcd')
+
+
+@pytest.fixture(scope='module')
+def dcd():
+	return(DCDReader(DCD))
+
+@pytest.mark.parametrize('key',[slice(None),slice(2,9,3),slice(-2,None),slice(None,-3),slice(-5,-1,2),
+	slice(None,None,-1),slice(5,None,-2),slice(-1,-6,-1),slice(8,2,-3),slice(3,5,-1),slice(100,None,-4)])
+def test_slices(dcd,key):
+	n=dcd.n_frames
+	expected=list(range(n))[key]
+	frames=dcd[key]
+	assert frames.shape==(len(expected),dcd.n_atoms,3)
+	for k,i in enumerate(expected):
+		assert np.array_equal(frames[k],dcd.frame(i))
+
+def test_frames_arguments(dcd):
+	assert np.array_equal(dcd.frames(-2),dcd[-2:])
+	assert np.array_equal(dcd.frames(7,1,-2),dcd[7:1:-2])
+
+def test_frame_out_of_range(dcd):
+	with pytest.raises(IndexError):
+		dcd.frame(dcd.n_frames)
@@ -0,0 +1,87 @@
+"""
+Numerical checks of the in-process base-pair geometry on only_nucl_init.pdb.
+
+The checks are that the standard bases fit the structure,
+paired bases are antiparallel, the step parameters are those of B-DNA in a nucleosome,
+and that rebuilding DNA from parameters and analyzing it gives the parameters back.
+test_x3dna_parameters compares the parameters with X3DNA output recorded in x3dna_reference/:
+find_pair only_nucl_init.pdb only_nucl_init.inp; analyze only_nucl_init.inp
+and bp_step.par copied to x3dna_reference/only_nucl_init_bp_step.par,
+it is skipped while these files are not there.
+
+Run with: python -m pytest -q test_dna_geometry.py
+"""
+import os
+
+import numpy as np
+import pytest
+
+from dna_geometry import BaseTopology, fit_base_frames, base_pair_frames, base_pair_step_params
+from dna_grooves import strand_pairs
+from dna_param import parse_find_pair, parse_bases_param_text
+from dna_rebuild import DNARebuilder
+from dna_shard import load_structure
+
+HERE=os.path.dirname(os.path.abspath(__file__))
+PDB=os.path.join(HERE,'only_nucl_init.pdb')
+X3DNA_REFERENCE=os.path.join(HERE,'x3dna_reference')
+
+#Largest differences from X3DNA: Shear..Stagger, Buckle..Opening, Shift..Rise, Tilt..Twist
+X3DNA_TOLERANCE=np.repeat([0.05,1.0,0.05,0.5],3)
+
+
+@pytest.fixture(scope='module')
+def nucleosome():
+	DNA=load_structure(PDB)
+	top=BaseTopology.from_atomsel(DNA)
+	return(DNA.coords(),top,strand_pairs(top))
+
+def test_base_fit_rmsd(nucleosome):
+	xyz,top,pairs=nucleosome
+	origins,axes,rmsd=fit_base_frames(xyz,top,return_rmsd=True)
+	assert len(top.bases)==294
+	assert np.all(rmsd<0.025)
+
+def test_paired_bases_antiparallel(nucleosome):
+	xyz,top,pairs=nucleosome
+	origins,axes=fit_base_frames(xyz,top)
+	antiparallel=base_pair_frames(origins,axes,pairs)[3]
+	assert antiparallel.all()
+
+def test_step_parameters(nucleosome):
+	xyz,top,pairs=nucleosome
+	names,params=base_pair_step_params(xyz,top,pairs)
+	assert len(names)==147 and all('-' in n for n in names)
+	assert np.isnan(params[0,6:]).all()
+	rise=params[1:,8]
+	twist=params[1:,11]
+	assert abs(rise.mean()-3.3)<0.15
+	assert 33<twist.mean()<36
+	#shear, stretch and stagger of Watson-Crick pairs are small
+	assert np.abs(params[:,:3]).max()<2
+
+def test_rebuild_round_trip(nucleosome):
+	xyz,top,pairs=nucleosome
+	names,params=base_pair_step_params(xyz,top,pairs)
+	params[0,6:]=0
+	builder=DNARebuilder(names)
+	rebuilt=builder.build(params)
+	names2,params2=base_pair_step_params(rebuilt,builder.topology(),builder.pairs())
+	assert names2==names
+	assert np.allclose(params2[1:],params[1:],atol=1e-6)
+	assert np.allclose(params2[0,:6],params[0,:6],atol=1e-6)
+
+def test_x3dna_parameters(nucleosome):
+	inp=os.path.join(X3DNA_REFERENCE,'only_nucl_init.inp')
+	par=os.path.join(X3DNA_REFERENCE,'only_nucl_init_bp_step.par')
+	if not (os.path.exists(inp) and os.path.exists(par)):
+		pytest.skip('X3DNA output for only_nucl_init.pdb is not in %s'%X3DNA_REFERENCE)
+	xyz,top,pairs=nucleosome
+	with open(par) as f:
+		x3dna_names,x3dna=parse_bases_param_text(f.read(),as_array=True)
+	names,params=base_pair_step_params(xyz,top,parse_find_pair(inp))
+	assert names==x3dna_names
+	#no step parameters for the first pair
+	assert np.isnan(x3dna[0,6:]).all()
+	assert np.all(np.abs(params-x3dna)[0,:6]<=X3DNA_TOLERANCE[:6])
+	assert np.all(np.abs(params-x3dna)[1:]<=X3DNA_TOLERANCE)
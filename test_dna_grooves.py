@@ -0,0 +1,54 @@
+"""
+Numerical checks of the in-process groove widths on ideal B-DNA.
+
+The phosphates are those of the Arnott fiber model of B-DNA: radius 8.91 A,
+94.9 deg from the dyad pointing into the minor groove and 2.19 A below the base pair
+on the 5' side. The closest approach of these phosphate helices minus 5.8 A
+gives the textbook widths of 5.65 A (minor) and 11.36 A (major).
+
+Run with: python -m pytest -q test_dna_grooves.py
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from dna_grooves import groove_widths, levels
+from dna_rebuild import DNARebuilder
+
+SEQUENCE='CGCGAATTCGCGCGCGAATTCGCG'
+FIBER_P=(8.91,np.radians(180-94.9),-2.186)
+
+
+@pytest.fixture(scope='module')
+def bdna():
+	r,phi,z=FIBER_P
+	templates=dict((b,OrderedDict([('P',(r*np.cos(phi),r*np.sin(phi),z))])) for b in 'ACGT')
+	builder=DNARebuilder(SEQUENCE,backbone_atoms=templates)
+	params=np.zeros((len(SEQUENCE),12))
+	params[1:,8]=3.38
+	params[1:,11]=36.0
+	return(builder.build(params),builder.topology(),builder.pairs())
+
+def test_levels(bdna):
+	xyz,top,pairs=bdna
+	grid,values=groove_widths(xyz,top,pairs)
+	assert np.array_equal(grid,levels(len(SEQUENCE)))
+	assert values.shape==(len(grid),4)
+	#grooves at the ends are not spanned by phosphates
+	assert np.isnan(values[0]).all() and np.isnan(values[-1]).all()
+
+def test_bdna_widths(bdna):
+	xyz,top,pairs=bdna
+	grid,values=groove_widths(xyz,top,pairs)
+	middle=values[(grid>8)&(grid<len(SEQUENCE)-7)]
+	assert np.allclose(middle[:,0],5.65,atol=0.2)
+	assert np.allclose(middle[:,2],11.36,atol=0.3)
+
+def test_windows_cover_grooves(bdna):
+	#the closest phosphates are 4 pairs back across the minor and 3 ahead across the major groove
+	xyz,top,pairs=bdna
+	grid,values=groove_widths(xyz,top,pairs)
+	grid,narrow=groove_widths(xyz,top,pairs,minor_window=(3,5),major_window=(2,4))
+	middle=(grid>8)&(grid<len(SEQUENCE)-7)
+	assert np.allclose(narrow[middle][:,[0,2]],values[middle][:,[0,2]])
@@ -0,0 +1,572 @@
+"""
+Storage of per-frame analysis results of a trajectory.
+
+Results of X3DNA_analyze and friends (one row per base pair, one column per parameter)
+are kept in a single preallocated float32 array indexed by (frame, base pair, parameter),
+and are filled in place as frames are analyzed.
+The store is saved to and loaded from a binary .npz file,
+and can be converted to the long format data frame used before
+(one row per frame and base pair, BP and Time columns).
+
+Usage:
+store=TrajectoryResults(range(1,nf),bp=range(-73,74))
+analyze_trajectory(range(1,nf),DNA,reff,out=store)
+store.save('MD_DNAparam_1kx5.npz')
+df=store.to_dataframe()
+
+CSVSink and NPZChunkSink take results the same way but write them to disk
+every flush_every frames, so memory does not grow with the length of the trajectory.
+
+FrameResult is the compact form of one frame that workers send to the driver:
+float32 values in the column order of a ResultSchema shared by all frames
+and base-pair names as small integer codes, it is stored without building a data frame.
+rec=FrameResult.from_dataframe(X3DNA_analyze(DNA,reff))
+rec=X3DNA_analyze(DNA,reff,records=True)     # the same, filled from the parsed outputs directly
+df=rec.to_dataframe()
+"""
+import os
+import json
+
+import itertools
+
+import numpy as np
+import pandas as pd
+
+
+###Compact per-frame results.
+#A data frame per frame costs an index, a block manager and a Python string per BPname;
+#FrameResult keeps the numbers in one float32 array and BPname as int16 codes,
+#the column names and the code table are in a ResultSchema that all frames share.
+
+#Names of Watson-Crick and other pairs of the standard bases, codes of BPname.
+#Other names are added to the schema that meets them.
+BP_NAMES=[a+s+b for a,s,b in itertools.product('ACGTU','-+','ACGTU')]
+
+#Schemas of this process, (columns,bp_names) -> ResultSchema
+_schemas={}
+
+
+def _schema(columns,bp_names):
+	"""
+	Returns the ResultSchema of this process for the layout, used to unpickle schemas
+	so that all frames of a run refer to one object
+	"""
+	key=(tuple(columns),tuple(bp_names))
+	if key not in _schemas:
+		_schemas[key]=ResultSchema(columns,bp_names)
+	return(_schemas[key])
+
+
+class ResultSchema(object):
+	"""
+	Column layout of per-frame results.
+
+	Attributes
+	----------
+	columns - names of all columns in the original order, including BPname.
+	params - names of the numeric columns, the order of FrameResult.values.
+	has_names - whether the results have the BPname column.
+	bp_names - code -> base-pair name table.
+	"""
+
+	def __init__(self,columns,bp_names=None):
+		self.columns=list(columns)
+		self.params=[c for c in self.columns if c!='BPname']
+		self.has_names='BPname' in self.columns
+		self.bp_names=list(BP_NAMES if bp_names is None else bp_names)
+		self._codes=dict((n,i) for i,n in enumerate(self.bp_names))
+		self._index=dict((c,j) for j,c in enumerate(self.params))
+
+	@classmethod
+	def for_columns(cls,columns):
+		"""
+		Returns the shared schema of this process for columns
+		"""
+		return(_schema(columns,BP_NAMES))
+
+	def __reduce__(self):
+		return(_schema,(tuple(self.columns),tuple(self.bp_names)))
+
+	def __eq__(self,other):
+		return(isinstance(other,ResultSchema) and self.columns==other.columns and self.bp_names==other.bp_names)
+
+	def __ne__(self,other):
+		return(not self==other)
+
+	def __hash__(self):
+		#the code table may grow, so only columns are hashed
+		return(hash(tuple(self.columns)))
+
+	def index(self,param):
+		"""
+		Position of param in values
+		"""
+		return(self._index[param])
+
+	def encode(self,names):
+		"""
+		Returns int16 codes of base-pair names, unknown names are added to the table
+		"""
+		codes=np.empty(len(names),dtype=np.int16)
+		for i,n in enumerate(names):
+			n=str(n)
+			if n not in self._codes:
+				self._codes[n]=len(self.bp_names)
+				self.bp_names.append(n)
+			codes[i]=self._codes[n]
+		return(codes)
+
+	def decode(self,codes):
+		"""
+		Returns object array of base-pair names for codes
+		"""
+		return(np.array(self.bp_names,dtype=object)[np.asarray(codes,dtype=np.int64)])
+
+
+class FrameResult(object):
+	"""
+	Result of the analysis of one frame in compact form.
+
+	Attributes
+	----------
+	schema - ResultSchema, shared by the frames of a run.
+	values - (n_bp,len(schema.params)) float32 array, NaN where the value is not numeric or missing.
+	codes - (n_bp,) int16 codes of base-pair names, None if there is no BPname column.
+	"""
+
+	__slots__=('schema','values','codes')
+
+	def __init__(self,schema,values,codes=None):
+		self.schema=schema
+		self.values=values
+		self.codes=codes
+
+	def __getstate__(self):
+		return((self.schema,self.values,self.codes))
+
+	def __setstate__(self,state):
+		self.schema,self.values,self.codes=state
+
+	@classmethod
+	def from_dataframe(cls,df,schema=None):
+		"""
+		Converts a data frame as returned by X3DNA_analyze (one row per base pair).
+		Numeric columns are taken as they are, others are converted with NaN for anything non numeric.
+		schema - to reuse, by default the shared schema for the columns of df.
+		"""
+		if schema is None or list(df.columns)!=schema.columns:
+			schema=ResultSchema.for_columns(df.columns)
+		numeric=[c for c,t in zip(df.columns,df.dtypes) if c!='BPname' and getattr(t,'kind','O') in 'biuf']
+		if len(numeric)==len(schema.params):
+			values=np.asarray(df[schema.params].values,dtype=np.float32)
+		else:
+			values=np.empty((len(df),len(schema.params)),dtype=np.float32)
+			for j,c in enumerate(schema.params):
+				values[:,j]=pd.to_numeric(df[c],errors='coerce').values
+		codes=schema.encode(df['BPname'].values) if schema.has_names else None
+		return(cls(schema,values,codes))
+
+	@classmethod
+	def from_arrays(cls,columns,values,bp_names=None):
+		"""
+		Makes a result from values of numeric columns and base-pair names without a data frame.
+		columns - names of the columns, BPname among them keeps its place, otherwise it goes first if bp_names are given.
+		values - (n_bp,number of columns other than BPname) array.
+		"""
+		columns=list(columns)
+		if bp_names is not None and 'BPname' not in columns:
+			columns=['BPname']+columns
+		schema=ResultSchema.for_columns(columns)
+		codes=schema.encode(bp_names) if bp_names is not None else None
+		return(cls(schema,np.asarray(values,dtype=np.float32),codes))
+
+	def __len__(self):
+		return(len(self.values))
+
+	@property
+	def columns(self):
+		return(self.schema.columns)
+
+	def bp_names(self):
+		"""
+		Returns list of base-pair names, None if there are none
+		"""
+		if self.codes is None:
+			return(None)
+		return(list(self.schema.decode(self.codes)))
+
+	def param(self,name):
+		"""
+		Returns (n_bp,) values of a parameter
+		"""
+		return(self.values[:,self.schema.index(name)])
+
+	def values_for(self,params):
+		"""
+		Returns (n_bp,len(params)) values in the order of params, NaN for parameters it does not have
+		"""
+		if list(params)==self.schema.params:
+			return(self.values)
+		res=np.full((len(self.values),len(params)),np.nan,dtype=np.float32)
+		for j,p in enumerate(params):
+			if p in self.schema._index:
+				res[:,j]=self.values[:,self.schema._index[p]]
+		return(res)
+
+	def to_dataframe(self):
+		"""
+		Returns the data frame with the original columns, values are float32
+		"""
+		df=pd.DataFrame(self.values,columns=self.schema.params)
+		if self.schema.has_names:
+			df['BPname']=self.schema.decode(self.codes)
+			df=df[self.schema.columns]
+		return(df)
+
+
+class TrajectoryResults(object):
+	"""
+	Per-frame results of a trajectory analysis.
+
+	Attributes
+	----------
+	frames - frame numbers, (n_frames,) int array.
+	bp - base pair labels, (n_bp,) int array, 1..N by default.
+	params - names of the numeric parameters (columns of the analysis output).
+	columns - names of all columns in the original order, including BPname.
+	bp_names - names of base pairs (BPname column, e.g. A-T), if the analysis provides them.
+	data - (n_frames,n_bp,n_params) float32 array, NaN where nothing is known.
+	filled - (n_frames,) bool array, True for frames that were stored.
+	attrs - dict of JSON serializable metadata saved with the store (settings, reference pairs ...).
+	"""
+
+	def __init__(self,frames,bp=None,params=None):
+		"""
+		frames - frame numbers that will be stored.
+		bp - base pair labels, if None they are 1..N where N comes from the first stored frame.
+		params - parameter names, if None they are taken from the first stored frame.
+		"""
+		self.frames=np.asarray(list(frames),dtype=np.int64)
+		self.bp=None if bp is None else np.asarray(list(bp),dtype=np.int64)
+		self.params=None if params is None else list(params)
+		self.columns=None if params is None else list(params)
+		self.bp_names=None
+		self.data=None
+		self.filled=np.zeros(len(self.frames),dtype=bool)
+		self.attrs={}
+		self._rows=dict((f,i) for i,f in enumerate(self.frames.tolist()))
+		if self.params is not None and self.bp is not None:
+			self._allocate()
+
+	def _allocate(self):
+		self.data=np.full((len(self.frames),len(self.bp),len(self.params)),np.nan,dtype=np.float32)
+
+	def _setup(self,df):
+		"""
+		Takes the layout from the first data frame (or FrameResult) that is stored
+		"""
+		if self.params is None:
+			self.columns=list(df.columns)
+			self.params=[c for c in self.columns if c!='BPname']
+		if self.bp is None:
+			self.bp=np.arange(1,len(df)+1,dtype=np.int64)
+		self._allocate()
+
+	def __len__(self):
+		return(len(self.frames))
+
+	def row(self,frame):
+		"""
+		Returns position of frame in the store
+		"""
+		try:
+			return(self._rows[frame])
+		except KeyError:
+			raise KeyError('frame %s is not in the store'%frame)
+
+	def set_frame(self,frame,df):
+		"""
+		Stores the result for a frame in place.
+
+		df - data frame as returned by X3DNA_analyze (one row per base pair), FrameResult,
+		or an array of shape (n_bp,n_params) in the order of params.
+		Non numeric values become NaN, BPname column is kept separately.
+		"""
+		i=self.row(frame)
+		if isinstance(df,FrameResult):
+			if self.data is None:
+				self._setup(df)
+			if df.codes is not None and self.bp_names is None:
+				self.bp_names=df.bp_names()
+			n=min(len(df),len(self.bp))
+			self.data[i,:n]=df.values_for(self.params)[:n]
+			self.data[i,n:]=np.nan
+		elif isinstance(df,pd.DataFrame):
+			if self.data is None:
+				self._setup(df)
+			if 'BPname' in df.columns and self.bp_names is None:
+				self.bp_names=[str(n) for n in df['BPname']]
+			n=min(len(df),len(self.bp))
+			out=self.data[i]
+			for j,c in enumerate(self.params):
+				if c in df.columns:
+					out[:n,j]=pd.to_numeric(df[c],errors='coerce').values[:n]
+				else:
+					out[:,j]=np.nan
+		else:
+			if self.data is None:
+				raise ValueError('params and bp have to be given to store arrays')
+			self.data[i]=df
+		self.filled[i]=True
+
+	def __setitem__(self,frame,df):
+		self.set_frame(frame,df)
+
+	def __getitem__(self,frame):
+		"""
+		Returns (n_bp,n_params) array for a frame
+		"""
+		return(self.data[self.row(frame)])
+
+	def param(self,name):
+		"""
+		Returns (n_frames,n_bp) array of a parameter
+		"""
+		return(self.data[:,:,self.params.index(name)])
+
+	def save(self,filename):
+		"""
+		Saves the store to a numpy .npz file,
+		the file is replaced at once, so it stays valid if the process is killed while saving.
+		"""
+		arrays=dict(frames=self.frames,filled=self.filled,
+			bp=self.bp if self.bp is not None else np.zeros(0,dtype=np.int64),
+			params=np.array(self.params if self.params else [],dtype=np.str_),
+			columns=np.array(self.columns if self.columns else [],dtype=np.str_),
+			bp_names=np.array(self.bp_names if self.bp_names else [],dtype=np.str_),
+			data=self.data if self.data is not None else np.zeros((0,0,0),dtype=np.float32),
+			attrs=np.array(json.dumps(self.attrs,sort_keys=True)))
+		tmp=filename+'.tmp'
+		with open(tmp,'wb') as f:
+			np.savez(f,**arrays)
+		os.rename(tmp,filename)
+
+	@classmethod
+	def load(cls,filename):
+		"""
+		Loads the store saved by save
+		"""
+		with np.load(filename) as f:
+			store=cls(f['frames'])
+			store.filled=f['filled'].copy()
+			if f['data'].size or len(f['params']):
+				store.bp=f['bp'].copy()
+				store.params=[str(p) for p in f['params']]
+				store.columns=[str(c) for c in f['columns']]
+				store.data=f['data'].copy()
+			if len(f['bp_names']):
+				store.bp_names=[str(n) for n in f['bp_names']]
+			if 'attrs' in f.files:
+				store.attrs=json.loads(str(f['attrs']))
+		return(store)
+
+	def missing(self,frames=None):
+		"""
+		Returns frame numbers that were not stored, among frames if given
+		"""
+		stored=set(self.frames[self.filled].tolist())
+		frames=self.frames.tolist() if frames is None else list(frames)
+		return([f for f in frames if f not in stored])
+
+	def to_dataframe(self,all_frames=False):
+		"""
+		Returns long format data frame: one row per frame and base pair,
+		parameter columns in the original order, plus BP (base pair label)
+		and Time (frame number) columns.
+		all_frames - if True frames that were not stored are output as NaN rows.
+		"""
+		sel=np.ones(len(self.frames),dtype=bool) if all_frames else self.filled
+		if self.data is None:
+			return(pd.DataFrame())
+		nf=int(sel.sum())
+		nbp=len(self.bp)
+		values=self.data[sel].reshape(nf*nbp,len(self.params))
+		df=pd.DataFrame(values,columns=self.params)
+		if self.bp_names is not None and 'BPname' in self.columns:
+			df['BPname']=np.tile(np.array(self.bp_names,dtype=object),nf)
+			df=df[self.columns]
+		df['BP']=np.tile(self.bp,nf)
+		df['Time']=np.repeat(self.frames[sel],nbp)
+		return(df)
+
+
+###Sinks that write results to disk as they arrive.
+#They are used like TrajectoryResults: sink[frame]=df, or sink.write(frame,df),
+#keep only the last flush_every frames in memory and append them to files.
+
+class CSVSink(object):
+	"""
+	Appends per-frame data frames to a long format CSV file,
+	with the same columns as TrajectoryResults.to_dataframe (BP and Time are added).
+
+	Usage:
+	with CSVSink('MD_DNAparam_1kx5.csv',bp=range(-73,74)) as sink:
+		for frame,df in iter_analyze(frames,DNA,reff):
+			sink[frame]=df
+	"""
+
+	def __init__(self,filename,bp=None,flush_every=100,append=False):
+		"""
+		filename - output CSV file, it is overwritten unless append=True.
+		bp - base pair labels, 1..N by default.
+		flush_every - number of frames kept in memory before writing.
+		"""
+		self.filename=filename
+		self.bp=None if bp is None else np.asarray(list(bp),dtype=np.int64)
+		self.flush_every=max(1,int(flush_every))
+		self.n_frames=0
+		self._buffer=[]
+		self._header=not (append and os.path.exists(filename) and os.path.getsize(filename)>0)
+		self._index=0
+		if not append:
+			open(filename,'w').close()
+
+	def write(self,frame,df):
+		df=df.to_dataframe() if isinstance(df,FrameResult) else df.copy()
+		df['BP']=self.bp[:len(df)] if self.bp is not None else np.arange(1,len(df)+1)
+		df['Time']=frame
+		self._buffer.append(df)
+		self.n_frames+=1
+		if len(self._buffer)>=self.flush_every:
+			self.flush()
+
+	__setitem__=write
+
+	def flush(self):
+		"""
+		Appends buffered frames to the file
+		"""
+		if not self._buffer:
+			return
+		df=pd.concat(self._buffer,ignore_index=True)
+		df.index=np.arange(self._index,self._index+len(df))
+		with open(self.filename,'a') as f:
+			df.to_csv(f,header=self._header)
+		self._header=False
+		self._index+=len(df)
+		self._buffer=[]
+
+	def close(self):
+		self.flush()
+
+	def __enter__(self):
+		return(self)
+
+	def __exit__(self,*exc):
+		self.close()
+
+
+class NPZChunkSink(object):
+	"""
+	Writes results to a directory as a sequence of .npz chunks,
+	each one is a small TrajectoryResults store of flush_every frames.
+	load_chunks reads them back into one store.
+
+	Usage:
+	with NPZChunkSink('MD_DNAparam_1kx5_chunks',bp=range(-73,74)) as sink:
+		for frame,df in iter_analyze(frames,DNA,reff):
+			sink[frame]=df
+	store=load_chunks('MD_DNAparam_1kx5_chunks')
+	"""
+
+	def __init__(self,directory,bp=None,params=None,flush_every=100):
+		self.directory=directory
+		self.bp=bp
+		self.params=params
+		self.flush_every=max(1,int(flush_every))
+		self.n_frames=0
+		self._buffer=[]
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self._chunk=len([n for n in os.listdir(directory) if n.startswith('chunk_') and n.endswith('.npz')])
+
+	def write(self,frame,df):
+		self._buffer.append((frame,df))
+		self.n_frames+=1
+		if len(self._buffer)>=self.flush_every:
+			self.flush()
+
+	__setitem__=write
+
+	def flush(self):
+		"""
+		Writes buffered frames as the next chunk
+		"""
+		if not self._buffer:
+			return
+		store=TrajectoryResults([f for f,df in self._buffer],bp=self.bp,params=self.params)
+		for frame,df in self._buffer:
+			store[frame]=df
+		store.save(os.path.join(self.directory,'chunk_%05d.npz'%self._chunk))
+		if self.params is None:
+			self.params=store.params
+			self.bp=store.bp
+		self._chunk+=1
+		self._buffer=[]
+
+	def close(self):
+		self.flush()
+
+	def __enter__(self):
+		return(self)
+
+	def __exit__(self,*exc):
+		self.close()
+
+
+def load_chunks(directory):
+	"""
+	Reads the chunks written by NPZChunkSink into one TrajectoryResults store,
+	frames are sorted.
+	"""
+	names=sorted(n for n in os.listdir(directory) if n.startswith('chunk_') and n.endswith('.npz'))
+	chunks=[TrajectoryResults.load(os.path.join(directory,n)) for n in names]
+	chunks=[c for c in chunks if c.data is not None]
+	if not chunks:
+		return(TrajectoryResults([]))
+	frames=np.concatenate([c.frames for c in chunks])
+	order=np.argsort(frames,kind='mergesort')
+	first=chunks[0]
+	store=TrajectoryResults(frames[order],bp=first.bp,params=first.params)
+	store.columns=first.columns
+	store.bp_names=first.bp_names
+	store.data[:]=np.concatenate([c.data for c in chunks])[order]
+	store.filled[:]=np.concatenate([c.filled for c in chunks])[order]
+	return(store)
+
+def merge_results(stores):
+	"""
+	Combines TrajectoryResults of disjoint sets of frames (e.g. shards of a trajectory
+	analyzed on different nodes) into one store with frames sorted.
+	Only stored frames are taken, attrs of the first store are kept.
+	Raises ValueError if the layouts (base pairs, parameters) differ or a frame is stored twice.
+	"""
+	stores=[s for s in stores if s.data is not None]
+	if not stores:
+		return(TrajectoryResults([]))
+	first=stores[0]
+	for s in stores[1:]:
+		if list(s.params)!=list(first.params) or not np.array_equal(s.bp,first.bp):
+			raise ValueError('Results with different parameters or base pairs can not be merged')
+	frames=np.concatenate([s.frames[s.filled] for s in stores])
+	unique,counts=np.unique(frames,return_counts=True)
+	if (counts>1).any():
+		raise ValueError('Frames stored more than once: %s'%(unique[counts>1].tolist(),))
+	order=np.argsort(frames,kind='mergesort')
+	store=TrajectoryResults(frames[order],bp=first.bp,params=first.params)
+	store.columns=first.columns
+	store.bp_names=first.bp_names
+	store.attrs=dict(first.attrs)
+	store.data[:]=np.concatenate([s.data[s.filled] for s in stores])[order]
+	store.filled[:]=True
+	return(store)
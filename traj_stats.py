@@ -0,0 +1,280 @@
+"""
+Online per base pair statistics of trajectory analysis results.
+
+Mean, variance, min/max and optional histograms of every (base pair, parameter)
+are updated frame by frame (or block by block) in one pass,
+so memory does not depend on the length of the trajectory.
+Mean and variance are updated with Welford/Chan formulas, which are numerically stable
+and allow two accumulators (from different workers or jobs) to be merged exactly.
+Angles that wrap around (Twist, backbone and sugar torsions, pucker phase)
+are averaged as directions: mean is atan2 of the mean sine and cosine,
+spread is the circular standard deviation sqrt(-2 ln R).
+
+Usage:
+stats=BPStats(bp=range(-73,74))
+for frame,df in iter_analyze(range(1,nf),DNA,reff):
+	stats[frame]=df
+stats.to_dataframe().to_csv('MD_DNAparam_avr_1kx5.csv')
+
+part=BPStats.load('job1.npz'); part.merge(BPStats.load('job2.npz'))
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+from dna_geometry import TORSIONS, SUGAR_TORSIONS
+from traj_results import FrameResult
+
+#Parameters that are angles on a circle, _1/_2 strand suffixes are ignored
+CIRCULAR_PARAMS=set(['Twist','P']+list(TORSIONS.keys())+list(SUGAR_TORSIONS.keys()))
+
+STATS=('mean','std','var','min','max','count')
+
+def is_circular(name):
+	"""
+	Whether parameter name (possibly with _1/_2 suffix) is in CIRCULAR_PARAMS
+	"""
+	return(re.sub(r'_[12]$','',name) in CIRCULAR_PARAMS)
+
+
+class BPStats(object):
+	"""
+	Accumulator of per base pair statistics.
+
+	Attributes
+	----------
+	bp - base pair labels, (n_bp,) int array.
+	params - parameter names.
+	circular - (n_params,) bool array, True for angles in degrees averaged on a circle.
+	count - (n_bp,n_params) number of non NaN values seen.
+	mean, m2 - running mean and sum of squared deviations (linear parameters).
+	cos, sin - sums of cosines and sines (circular parameters).
+	min, max - extreme values.
+	hist - dict parameter -> (n_bp,n_bins) counts, for parameters given in bins.
+	bins - dict parameter -> bin edges.
+	"""
+
+	def __init__(self,bp=None,params=None,circular=None,bins=None):
+		"""
+		bp - base pair labels, if None they are 1..N where N comes from the first update.
+		params - parameter names, if None they are taken from the first data frame.
+		circular - names of circular parameters, by default is_circular decides.
+		bins - dict parameter -> histogram bin edges, histograms are kept only for these.
+		"""
+		self.bp=None if bp is None else np.asarray(list(bp),dtype=np.int64)
+		self.params=None if params is None else list(params)
+		self._circular_names=None if circular is None else set(circular)
+		self.bins=dict((k,np.asarray(v,dtype=float)) for k,v in (bins or {}).items())
+		self.count=None
+		self.hist={}
+		if self.bp is not None and self.params is not None:
+			self._allocate()
+
+	def _allocate(self):
+		shape=(len(self.bp),len(self.params))
+		if self._circular_names is None:
+			self.circular=np.array([is_circular(p) for p in self.params],dtype=bool)
+		else:
+			self.circular=np.array([p in self._circular_names for p in self.params],dtype=bool)
+		self.count=np.zeros(shape,dtype=np.int64)
+		self.mean=np.zeros(shape)
+		self.m2=np.zeros(shape)
+		self.cos=np.zeros(shape)
+		self.sin=np.zeros(shape)
+		self.min=np.full(shape,np.inf)
+		self.max=np.full(shape,-np.inf)
+		self.hist=dict((p,np.zeros((len(self.bp),len(self.bins[p])-1),dtype=np.int64)) for p in self.params if p in self.bins)
+
+	def _setup(self,df):
+		if self.params is None:
+			self.params=[c for c in df.columns if c!='BPname']
+		if self.bp is None:
+			self.bp=np.arange(1,len(df)+1,dtype=np.int64)
+		self._allocate()
+
+	def _values(self,df):
+		"""
+		Converts data frame to (n_bp,n_params) float array in the order of params
+		"""
+		if self.count is None:
+			self._setup(df)
+		n=min(len(df),len(self.bp))
+		res=np.full((len(self.bp),len(self.params)),np.nan)
+		for j,c in enumerate(self.params):
+			if c in df.columns:
+				res[:n,j]=pd.to_numeric(df[c],errors='coerce').values[:n]
+		return(res)
+
+	def update(self,df):
+		"""
+		Adds one frame: data frame as returned by X3DNA_analyze, traj_results.FrameResult
+		or (n_bp,n_params) array in the order of params.
+		"""
+		if isinstance(df,FrameResult):
+			if self.count is None:
+				self._setup(df)
+			values=np.full((len(self.bp),len(self.params)),np.nan)
+			n=min(len(df),len(self.bp))
+			values[:n]=df.values_for(self.params)[:n]
+		elif isinstance(df,pd.DataFrame):
+			values=self._values(df)
+		else:
+			values=np.asarray(df,dtype=float)
+		self.update_block(values[np.newaxis])
+
+	def __setitem__(self,frame,df):
+		self.update(df)
+
+	def update_block(self,values):
+		"""
+		Adds a block of frames, (n_frames,n_bp,n_params) array,
+		e.g. TrajectoryResults.data or a chunk of it. NaN values are skipped.
+		"""
+		if self.count is None:
+			raise ValueError('params and bp have to be known to add arrays')
+		values=np.asarray(values,dtype=float)
+		valid=~np.isnan(values)
+		n=valid.sum(axis=0)
+		x=np.where(valid,values,0.0)
+		with np.errstate(invalid='ignore',divide='ignore'):
+			mean=np.where(n>0,x.sum(axis=0)/n,0.0)
+			m2=(np.where(valid,values-mean,0.0)**2).sum(axis=0)
+		rad=np.radians(x)
+		cos=np.where(valid,np.cos(rad),0.0).sum(axis=0)
+		sin=np.where(valid,np.sin(rad),0.0).sum(axis=0)
+		vmin=np.where(valid,values,np.inf).min(axis=0)
+		vmax=np.where(valid,values,-np.inf).max(axis=0)
+		self._combine(n,mean,m2,cos,sin,vmin,vmax)
+		for p,h in self.hist.items():
+			j=self.params.index(p)
+			h+=_histograms(values[:,:,j],self.bins[p])
+
+	def _combine(self,n,mean,m2,cos,sin,vmin,vmax):
+		"""
+		Chan et al. pairwise update of the running moments with those of another sample
+		"""
+		total=self.count+n
+		delta=mean-self.mean
+		with np.errstate(invalid='ignore',divide='ignore'):
+			frac=np.where(total>0,n/np.maximum(total,1).astype(float),0.0)
+		self.mean=self.mean+delta*frac
+		self.m2=self.m2+m2+delta**2*self.count*frac
+		self.count=total
+		self.cos+=cos
+		self.sin+=sin
+		self.min=np.minimum(self.min,vmin)
+		self.max=np.maximum(self.max,vmax)
+
+	def merge(self,other):
+		"""
+		Adds statistics accumulated by another BPStats with the same layout (e.g. in another process),
+		returns self.
+		"""
+		if other.count is None:
+			return(self)
+		if self.count is None:
+			self.bp=other.bp.copy()
+			self.params=list(other.params)
+			self.bins=dict(other.bins)
+			self._circular_names=set(p for p,c in zip(other.params,other.circular) if c)
+			self._allocate()
+		if list(other.params)!=list(self.params) or len(other.bp)!=len(self.bp):
+			raise ValueError('Statistics with different parameters or base pairs can not be merged')
+		self._combine(other.count,other.mean,other.m2,other.cos,other.sin,other.min,other.max)
+		for p,h in self.hist.items():
+			if p in other.hist:
+				h+=other.hist[p]
+		return(self)
+
+	def __iadd__(self,other):
+		return(self.merge(other))
+
+	def stat(self,name):
+		"""
+		Returns (n_bp,n_params) array of a statistic: mean, std, var, min, max or count.
+		For circular parameters mean is the circular mean in -180..180,
+		std is the circular standard deviation sqrt(-2 ln R) in degrees and var is 1-R.
+		"""
+		if name not in STATS:
+			raise ValueError('Unknown statistic %s, choose from %s'%(name,', '.join(STATS)))
+		count=self.count
+		with np.errstate(invalid='ignore',divide='ignore'):
+			if name=='count':
+				return(count.copy())
+			if name=='min' or name=='max':
+				return(np.where(count>0,getattr(self,name),np.nan))
+			R=np.sqrt(self.cos**2+self.sin**2)/count
+			if name=='mean':
+				lin=self.mean
+				circ=np.degrees(np.arctan2(self.sin,self.cos))
+			elif name=='var':
+				lin=self.m2/(count-1)
+				circ=1-R
+			else:
+				lin=np.sqrt(self.m2/(count-1))
+				circ=np.degrees(np.sqrt(-2*np.log(np.minimum(R,1.0))))
+			res=np.where(self.circular,circ,lin)
+			return(np.where(count>0,res,np.nan))
+
+	def to_dataframe(self,stat='mean'):
+		"""
+		Returns data frame with one row per base pair (index BP) and one column per parameter,
+		like groupby(['BP']).agg(np.mean) of the per frame results.
+		stat - statistic to output, see stat, or a list of them to get columns like Twist_std.
+		"""
+		if self.count is None:
+			return(pd.DataFrame())
+		if isinstance(stat,str):
+			df=pd.DataFrame(self.stat(stat),columns=self.params,index=self.bp)
+		else:
+			df=pd.concat([pd.DataFrame(self.stat(s),columns=[p+'_'+s for p in self.params],index=self.bp) for s in stat],axis=1)
+		df.index.name='BP'
+		return(df)
+
+	def histogram(self,param):
+		"""
+		Returns (bin edges, (n_bp,n_bins) counts) for param
+		"""
+		return(self.bins[param],self.hist[param])
+
+	def save(self,filename):
+		"""
+		Saves the accumulator to a numpy .npz file, it can be loaded and merged later
+		"""
+		arrays=dict(bp=self.bp,params=np.array(self.params,dtype=np.str_),circular=self.circular,
+			count=self.count,mean=self.mean,m2=self.m2,cos=self.cos,sin=self.sin,min=self.min,max=self.max)
+		for p in self.hist:
+			arrays['bins:'+p]=self.bins[p]
+			arrays['hist:'+p]=self.hist[p]
+		np.savez(filename,**arrays)
+
+	@classmethod
+	def load(cls,filename):
+		"""
+		Loads the accumulator saved by save
+		"""
+		with np.load(filename) as f:
+			params=[str(p) for p in f['params']]
+			bins=dict((k[5:],f[k]) for k in f.files if k.startswith('bins:'))
+			stats=cls(bp=f['bp'],params=params,circular=[p for p,c in zip(params,f['circular']) if c],bins=bins)
+			for k in ('count','mean','m2','cos','sin','min','max'):
+				setattr(stats,k,f[k].copy())
+			for p in stats.hist:
+				stats.hist[p]=f['hist:'+p].copy()
+		return(stats)
+
+
+def _histograms(values,edges):
+	"""
+	Counts (n_frames,n_bp) values into bins separately for every base pair,
+	returns (n_bp,n_bins) counts. Values outside of edges and NaN are not counted.
+	"""
+	nbins=len(edges)-1
+	nbp=values.shape[1]
+	idx=np.searchsorted(edges,values,side='right')-1
+	#the last edge is included in the last bin, as in numpy.histogram
+	idx[values==edges[-1]]=nbins-1
+	ok=(idx>=0)&(idx<nbins)&~np.isnan(values)
+	flat=(np.arange(nbp)[np.newaxis,:]*nbins+idx)[ok]
+	return(np.bincount(flat,minlength=nbp*nbins).reshape(nbp,nbins))